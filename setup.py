@@ -108,6 +108,7 @@ setup(
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
+        'console_scripts': ['templatelite=templatelite.__main__:main'],
     },
     test_suite='tests',
     tests_require=['flake8']
@@ -1,2 +1,3 @@
 # coding=utf-8
-from .templatelite import *
\ No newline at end of file
+from .templatelite import *
+from .metrics import RenderObserver, HistogramCollector
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# templatelite : Lightweight Templating system
+
+Summary :
+    The templatelite command line
+
+Use Case :
+    As a template author I want to check my templates from the command line, or as a step
+    in my build, so that slow templates are found before they are deployed
+
+Testable Statements :
+    ...
+
+Run as ``templatelite COMMAND ...`` or ``python -m templatelite COMMAND ...``
+"""
+import argparse
+import sys
+
+from templatelite import lint
+
+
+def main(argv=None):
+    """Run a templatelite command"""
+    parser = argparse.ArgumentParser(prog='templatelite', description='templatelite tools')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    check = commands.add_parser('check', help='Find the performance hazards in templates',
+                                description='Find the performance hazards in templates')
+    lint.add_arguments(check)
+    check.set_defaults(run=lint.run)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# templatelite : Lightweight Templating system
+
+Summary :
+    Benchmarks for the templatelite hot paths
+
+Use Case :
+    As a developer I want to be able to measure the speed of templatelite so that I can
+    see the benefit of optimisations and spot regressions
+
+Testable Statements :
+    ...
+
+Run as ``python -m templatelite.bench [--json] [--output FILE] [SCENARIO ...]``
+
+Every scenario reports the operations per second, and the peak memory allocated
+during a single operation (measured with tracemalloc where it is available).
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import templatelite
+from templatelite.version import __version__
+
+# Same table rendered using autoescape, and using the escape filter on every value
+_AUTOESCAPE_TEMPLATE = """<table>
+{% for row in rows %}
+<tr><td>{{ row.name }}</td><td>{{ row.company }}</td><td>{{ row.notes }}</td></tr>
+{% endfor %}
+</table>"""
+
+_FILTER_ESCAPE_TEMPLATE = """<table>
+{% for row in rows %}
+<tr><td>{{ row.name|escape }}</td><td>{{ row.company|escape }}</td><td>{{ row.notes|escape }}</td></tr>
+{% endfor %}
+</table>"""
+
+_SMALL_TEMPLATE = """Dear {{ person.name }},
+{% if person.balance > 0 %}
+Your balance is {{ person.balance }}
+{% else %}
+Your account is clear
+{% endif %}"""
+
+# A section of a large page - repeated with SECTION replaced by different names to build the template
+_LARGE_SECTION = """<h2>{{ SECTION.title|escape }}</h2>
+{% if SECTION.visible %}
+<ul>
+{% for item in SECTION.items %}
+  <li>{{ item.name }} ({{ item.tags|len }})</li>
+{% else %}
+  <li>Nothing here</li>
+{% endfor %}
+</ul>
+{% elif SECTION.hidden %}
+<p>Hidden</p>
+{% endif %}
+"""
+
+_TABLE_TEMPLATE = """<table>
+{% for row in rows %}
+<tr><td>{{ row.id }}</td><td>{{ row.name }}</td><td>{{ row.email }}</td><td>{{ row.city }}</td><td>{{ row.score }}</td></tr>
+{% endfor %}
+</table>"""
+
+_FILTERS_TEMPLATE = """{% for row in rows %}
+{{ row.name|len }} {{ row.name|escape }} {{ row.words|split }} {{ row.code|cut - }} {{ row.words|split , }}
+{% endfor %}"""
+
+
+class _Node(object):
+    """An object in a chain of attributes for the deep lookup scenario"""
+    def __init__(self, child=None, value=None):
+        self.child = child
+        self.value = value
+
+
+class _Profile(object):
+    """An object with a method which is called by each lookup in the repeated lookup scenario"""
+    def __init__(self, name):
+        self.name = name
+
+    def display_name(self):
+        return self.name.title()
+
+
+def _escape_context(rows):
+    """A context of table rows with values which need escaping"""
+    return {'rows': [{'name': 'Tom <{}>'.format(n),
+                      'company': 'Smith & Jones',
+                      'notes': '"quoted" \'text\''} for n in range(rows)]}
+
+
+def _measure(func, repeat, number):
+    """Return the best time for a single call of func"""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def _peak_memory(func):
+    """Return the peak memory (in bytes) allocated during a single call of func - None if it can't be measured"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _result(func, repeat, number):
+    """Measure the speed and the peak memory of func"""
+    seconds = _measure(func, repeat, number)
+    return {'seconds': seconds, 'ops_per_sec': 1.0 / seconds, 'peak_bytes': _peak_memory(func)}
+
+
+def bench_autoescape(rows=1000, repeat=5, number=20):
+    """Compare autoescape against escaping each value with the escape filter"""
+    context = _escape_context(rows)
+
+    auto = templatelite.Renderer(_AUTOESCAPE_TEMPLATE, autoescape='html')
+    manual = templatelite.Renderer(_FILTER_ESCAPE_TEMPLATE)
+
+    if auto.from_context(context) != manual.from_context(context):
+        raise AssertionError('autoescape and escape filter output differ')
+
+    results = {}
+    for name, renderer in (('autoescape', auto), ('escape_filter', manual)):
+        results[name] = _result(lambda: renderer.from_context(context), repeat, number)
+    results['speedup'] = results['escape_filter']['seconds'] / results['autoescape']['seconds']
+    return results
+
+
+def bench_compile_small(repeat=5, number=500):
+    """Compile a small template"""
+    return {'compile': _result(lambda: templatelite.Renderer(_SMALL_TEMPLATE), repeat, number)}
+
+
+def bench_compile_large(sections=200, repeat=5, number=5):
+    """Compile a large template of many sections, each with if, for and filters"""
+    template = ''.join(_LARGE_SECTION.replace('SECTION', 'section_{}'.format(n)) for n in range(sections))
+    return {'compile': _result(lambda: templatelite.Renderer(template), repeat, number)}
+
+
+def bench_deep_lookup(depth=8, lookups=50, repeat=5, number=500):
+    """Resolve deeply dotted names through mappings and objects"""
+    mapping, chain = {'value': 'leaf'}, 'value'
+    node = _Node(value='leaf')
+    attributes = 'value'
+    for _ in range(depth):
+        mapping, chain = {'child': mapping}, 'child.' + chain
+        node, attributes = _Node(child=node), 'child.' + attributes
+
+    template = ''.join('{{ mapping.%s }}{{ node.%s }}\n' % (chain, attributes) for _ in range(lookups))
+    renderer = templatelite.Renderer(template)
+    context = {'mapping': mapping, 'node': node}
+    return {'render': _result(lambda: renderer.from_context(context), repeat, number)}
+
+
+def bench_large_table(rows=5000, repeat=5, number=5):
+    """Render a large table from a for loop"""
+    renderer = templatelite.Renderer(_TABLE_TEMPLATE)
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'email': 'user{}@example.com'.format(n),
+                         'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]}
+    return {'render': _result(lambda: renderer.from_context(context), repeat, number)}
+
+
+def bench_heavy_filters(rows=1000, repeat=5, number=10):
+    """Render a loop where every displayed value is filtered"""
+    renderer = templatelite.Renderer(_FILTERS_TEMPLATE)
+    context = {'rows': [{'name': '<Name {}>'.format(n), 'words': 'a b,c d e,f {}'.format(n),
+                         'code': 'AB-{}-CD'.format(n)} for n in range(rows)]}
+    return {'render': _result(lambda: renderer.from_context(context), repeat, number)}
+
+
+def bench_multi_context(contexts=4, keys=100, repeat=5, number=500):
+    """Render from several context dictionaries which are merged for every render"""
+    names = ['value_{}'.format(n) for n in range(keys)]
+    renderer = templatelite.Renderer(''.join('{{ %s }}' % name for name in names[::10]))
+    context_list = [dict((name, '{}-{}'.format(name, n)) for name in names) for n in range(contexts)]
+    return {'render': _result(lambda: renderer.from_context(*context_list), repeat, number)}
+
+def bench_bytes_output(rows=5000, repeat=5, number=5):
+    """Compare rendering bytes directly against encoding the rendered text"""
+    context = {'rows': [{'id': n, 'name': u'N\u00e4me {}'.format(n), 'email': 'user{}@example.com'.format(n),
+                         'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]}
+    text = templatelite.Renderer(_TABLE_TEMPLATE)
+    encoded = templatelite.Renderer(_TABLE_TEMPLATE, as_bytes=True)
+
+    if text.from_context(context).encode('utf-8') != encoded.from_context(context):
+        raise AssertionError('bytes and encoded text output differ')
+
+    results = {'encode_text': _result(lambda: text.from_context(context).encode('utf-8'), repeat, number),
+               'as_bytes': _result(lambda: encoded.from_context(context), repeat, number)}
+    results['speedup'] = results['encode_text']['seconds'] / results['as_bytes']['seconds']
+    return results
+
+
+def bench_incremental(rows=1000, repeat=5, number=20):
+    """Compare re-rendering a dashboard where only the clock changes, with and without an incremental session"""
+    template = '<h1>{{ title }}</h1>\n' + _TABLE_TEMPLATE + '\nUpdated {{ clock }}'
+    rows = [{'id': n, 'name': 'Name {}'.format(n), 'email': 'user{}@example.com'.format(n),
+             'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]
+    full = templatelite.Renderer(template)
+    session = templatelite.Renderer(template, incremental=True).incremental()
+    clock = [0]
+
+    def context():
+        clock[0] += 1
+        return {'title': 'Dashboard', 'rows': rows, 'clock': clock[0]}
+
+    session.render(context())
+    results = {'full': _result(lambda: full.from_context(context()), repeat, number),
+               'incremental': _result(lambda: session.render(context()), repeat, number)}
+    results['speedup'] = results['full']['seconds'] / results['incremental']['seconds']
+    return results
+
+
+def bench_specialise(rows=100, repeat=5, number=100):
+    """Compare rendering a page with constant site settings, with and without specialising the template"""
+    template = ('<title>{{ site.name|escape }}</title>\n{% if flags.beta %}<p>Beta</p>{% endif %}\n'
+                '{% for row in rows %}<a href="{{ static }}/{{ row.id }}">{{ site.name }}</a>'
+                '{% if flags.legacy %}{{ row.legacy }}{% endif %}\n{% endfor %}')
+    constants = {'site': {'name': 'Example & Co'}, 'flags': {'beta': False, 'legacy': False}, 'static': '/static'}
+    context = {'rows': [{'id': n} for n in range(rows)]}
+    full = templatelite.Renderer(template)
+    specialised = full.specialise(constants)
+
+    results = {'full': _result(lambda: full.from_context(context, constants), repeat, number),
+               'specialised': _result(lambda: specialised.from_context(context), repeat, number)}
+    results['speedup'] = results['full']['seconds'] / results['specialised']['seconds']
+    return results
+
+
+def bench_schema(rows=5000, repeat=5, number=5):
+    """Compare rendering a large table with and without a schema for the rows"""
+    schema = dict(('row.' + name, 'item') for name in ('id', 'name', 'email', 'city', 'score'))
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'email': 'user{}@example.com'.format(n),
+                         'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]}
+    plain = templatelite.Renderer(_TABLE_TEMPLATE)
+    typed = templatelite.Renderer(_TABLE_TEMPLATE, schema=schema)
+
+    results = {'plain': _result(lambda: plain.from_context(context), repeat, number),
+               'schema': _result(lambda: typed.from_context(context), repeat, number)}
+    results['speedup'] = results['plain']['seconds'] / results['schema']['seconds']
+    return results
+
+
+def bench_repeated_lookup(uses=30, repeat=5, number=500):
+    """Compare rendering a page which uses the same dotted name many times, with and without looking it up once"""
+    template = ''.join('<p>{{ user.profile.display_name }} %d</p>\n' % n for n in range(uses))
+    context = {'user': {'profile': _Profile('Tony')}}
+    looked_up = templatelite.Renderer(template)
+    volatile = templatelite.Renderer(template, volatile=['user'])
+
+    results = {'volatile': _result(lambda: volatile.from_context(context), repeat, number),
+               'once': _result(lambda: looked_up.from_context(context), repeat, number)}
+    results['speedup'] = results['volatile']['seconds'] / results['once']['seconds']
+    return results
+
+
+def bench_filter_arguments(rows=1000, repeat=5, number=10):
+    """Render a loop where every displayed value is filtered with constant and context arguments"""
+    template = ("{% for row in rows %}{{ row.csv|split ',' 2 }} {{ row.code|cut settings.char }} "
+                "{{ row.code|cut 0 }}\n{% endfor %}")
+    renderer = templatelite.Renderer(template)
+    context = {'rows': [{'csv': 'a,b,c,{}'.format(n), 'code': 'A-{}-0'.format(n)} for n in range(rows)],
+               'settings': {'char': '-'}}
+    return {'render': _result(lambda: renderer.from_context(context), repeat, number)}
+
+
+# The built in filters, and the value from each row that they are applied to
+_BUILTIN_FILTERS = {'escape': 'text|escape', 'upper': 'text|upper', 'lower': 'text|lower', 'title': 'text|title',
+                    'truncate': 'text|truncate 10', 'join': "items|join ', '", 'default': "empty|default 'none'",
+                    'date': 'when|date', 'strftime': "when|strftime '%Y-%m-%d %H:%M'", 'number': 'amount|number 2',
+                    'currency': 'amount|currency', 'center': 'text|center 30', 'urlencode': 'text|urlencode',
+                    'json': 'items|json'}
+
+
+def bench_builtin_filters(rows=1000, repeat=5, number=10):
+    """Render a loop using each of the built in filters"""
+    context = {'rows': [{'text': '<Name & {}>'.format(n), 'items': [n, 'a', 'b'], 'empty': '',
+                         'when': datetime.datetime(2020, 1, 1 + n % 28, n % 24), 'amount': n * 1234.5}
+                        for n in range(rows)]}
+    results = {}
+    for name, filtered in sorted(_BUILTIN_FILTERS.items()):
+        renderer = templatelite.Renderer('{%% for row in rows %%}{{ row.%s }}\n{%% endfor %%}' % filtered)
+        results[name] = _result(lambda: renderer.from_context(context), repeat, number)
+    return results
+
+
+def bench_filter_chain(rows=1000, repeat=5, number=10):
+    """Render a loop where every displayed value is passed through a chain of filters"""
+    renderer = templatelite.Renderer("{% for row in rows %}{{ row.tags|join ', '|truncate 20|upper|escape }}\n"
+                                     "{{ row.name|lower|center 30 }}\n{% endfor %}")
+    context = {'rows': [{'tags': ['red', 'green', 'blue', str(n)], 'name': 'Name <{}>'.format(n)}
+                        for n in range(rows)]}
+    return {'render': _result(lambda: renderer.from_context(context), repeat, number)}
+
+
+def bench_macros(rows=1000, repeat=5, number=10):
+    """Compare rendering a row snippet as a macro with rendering it with a separate Renderer for each row"""
+    snippet = '<tr><td>{{ row.id }}</td><td>{{ row.name }}</td><td>{{ row.score }}</td></tr>\n'
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'score': n * 1.5} for n in range(rows)]}
+    macro = templatelite.Renderer('{% macro line(row) %}' + snippet + '{% endmacro %}'
+                                  '<table>{% for row in rows %}{{ line(row) }}{% endfor %}</table>')
+    row_renderer = templatelite.Renderer(snippet)
+    page = templatelite.Renderer('<table>{% for row in rows %}{{ row }}{% endfor %}</table>')
+
+    def separate():
+        return page.from_context({'rows': [row_renderer.from_context({'row': row}) for row in context['rows']]})
+
+    results = {'separate': _result(separate, repeat, number),
+               'macro': _result(lambda: macro.from_context(context), repeat, number)}
+    results['speedup'] = results['separate']['seconds'] / results['macro']['seconds']
+    return results
+
+
+def bench_observers(repeat=5, number=2000):
+    """Compare rendering a small template without observers and with a histogram collector"""
+    context = {'person': {'name': 'Tony', 'balance': 42}}
+    plain = templatelite.Renderer(_SMALL_TEMPLATE)
+    observed = templatelite.Renderer(_SMALL_TEMPLATE, name='small', observers=[templatelite.HistogramCollector()])
+
+    results = {'plain': _result(lambda: plain.from_context(context), repeat, number),
+               'observed': _result(lambda: observed.from_context(context), repeat, number)}
+    results['overhead'] = results['observed']['seconds'] / results['plain']['seconds']
+    return results
+
+
+def bench_sandbox(rows=1000, repeat=5, number=10):
+    """Compare rendering a table with and without the sandbox and a loop iteration limit"""
+    template = ('<table>{% for row in rows %}{% if row.score > 10 and row.name != "" %}'
+                '<tr><td>{{ row.id }}</td><td>{{ row.name }}</td></tr>{% endif %}{% endfor %}</table>')
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'score': n} for n in range(rows)]}
+    plain = templatelite.Renderer(template)
+    sandboxed = templatelite.Renderer(template, sandbox=True, max_iterations=rows)
+
+    results = {'plain': _result(lambda: plain.from_context(context), repeat, number),
+               'sandboxed': _result(lambda: sandboxed.from_context(context), repeat, number)}
+    results['overhead'] = results['sandboxed']['seconds'] / results['plain']['seconds']
+    return results
+
+
+def bench_output_limit(rows=5000, repeat=5, number=5):
+    """Compare rendering a large table with and without an output limit - and stopping a runaway render early"""
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'email': 'user{}@example.com'.format(n),
+                         'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]}
+    plain = templatelite.Renderer(_TABLE_TEMPLATE)
+    limited = templatelite.Renderer(_TABLE_TEMPLATE, max_output=10 ** 9)
+    stopped = templatelite.Renderer(_TABLE_TEMPLATE, max_output=1024)
+
+    def runaway():
+        try:
+            stopped.from_context(context)
+        except templatelite.OutputLimitExceeded:
+            pass
+
+    results = {'plain': _result(lambda: plain.from_context(context), repeat, number),
+               'limited': _result(lambda: limited.from_context(context), repeat, number),
+               'stopped': _result(runaway, repeat, number)}
+    results['overhead'] = results['limited']['seconds'] / results['plain']['seconds']
+    return results
+
+
+def bench_deadline(rows=5000, repeat=5, number=5):
+    """Compare rendering a large table with and without a render deadline"""
+    context = {'rows': [{'id': n, 'name': 'Name {}'.format(n), 'email': 'user{}@example.com'.format(n),
+                         'city': 'City {}'.format(n % 100), 'score': n * 1.5} for n in range(rows)]}
+    renderer = templatelite.Renderer(_TABLE_TEMPLATE)
+    monotonic = templatelite.templatelite._monotonic
+
+    results = {'plain': _result(lambda: renderer.from_context(context), repeat, number),
+               'deadline': _result(lambda: renderer.from_context(context, deadline=monotonic() + 60), repeat, number)}
+    results['overhead'] = results['deadline']['seconds'] / results['plain']['seconds']
+    return results
+
+
+def bench_warm(templates=200, repeat=5, number=20):
+    """Compare warming an environment's templates with compiling them on first use, and the lookups afterwards"""
+    sources = dict(('page_{}.html'.format(n), _SMALL_TEMPLATE + '{{ tenant_%d }}' % n) for n in range(templates))
+    names = sorted(sources)
+
+    def lazy():
+        env = templatelite.Environment(loader=templatelite.DictLoader(sources), cache_size=templates)
+        for name in names:
+            env.get_template(name)
+        return env
+
+    def warm():
+        env = templatelite.Environment(loader=templatelite.DictLoader(sources), cache_size=templates)
+        env.warm()
+        return env
+
+    cached, warmed = lazy(), warm()
+
+    def lookups(env):
+        for name in names:
+            env.get_template(name)
+
+    return {'compile_on_use': _result(lazy, repeat, 1),
+            'warm': _result(warm, repeat, 1),
+            'cached_lookup': _result(lambda: lookups(cached), repeat, number),
+            'warmed_lookup': _result(lambda: lookups(warmed), repeat, number)}
+
+
+def _retained_memory(func):
+    """Return the memory (in bytes) still allocated after a single call of func - None if it can't be measured"""
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return retained
+
+
+def bench_memory_footprint(templates=500, sections=3, repeat=5, number=1):
+    """Measure the memory held by each of many compiled templates, with and without compact mode"""
+    section = ''.join(_LARGE_SECTION.replace('SECTION', 'section_{}'.format(n)) for n in range(sections))
+
+    results = {}
+    for name, compact in (('default', False), ('compact', True)):
+        retained = _retained_memory(lambda: [templatelite.Renderer(section + '{{ tenant_%d }}' % n, compact=compact)
+                                             for n in range(templates)])
+        results[name + '_bytes_per_template'] = float(retained) / templates if retained is not None else None
+    if results['compact_bytes_per_template']:
+        results['saving'] = results['default_bytes_per_template'] / results['compact_bytes_per_template']
+    return results
+
+_SCENARIOS = {'autoescape': bench_autoescape,
+              'compile_small': bench_compile_small,
+              'compile_large': bench_compile_large,
+              'deep_lookup': bench_deep_lookup,
+              'large_table': bench_large_table,
+              'heavy_filters': bench_heavy_filters,
+              'multi_context': bench_multi_context,
+              'memory_footprint': bench_memory_footprint,
+              'bytes_output': bench_bytes_output,
+              'incremental': bench_incremental,
+              'specialise': bench_specialise,
+              'schema': bench_schema,
+              'repeated_lookup': bench_repeated_lookup,
+              'filter_arguments': bench_filter_arguments,
+              'builtin_filters': bench_builtin_filters,
+              'filter_chain': bench_filter_chain,
+              'macros': bench_macros,
+              'observers': bench_observers,
+              'sandbox': bench_sandbox,
+              'output_limit': bench_output_limit,
+              'deadline': bench_deadline,
+              'warm': bench_warm}
+
+
+# Smaller sizes for a quick run
+_QUICK_SIZES = {'autoescape': {'rows': 50},
+                'compile_large': {'sections': 10},
+                'large_table': {'rows': 100},
+                'heavy_filters': {'rows': 50},
+                'bytes_output': {'rows': 50},
+                'incremental': {'rows': 50},
+                'schema': {'rows': 100},
+                'filter_arguments': {'rows': 50},
+                'filter_chain': {'rows': 50},
+                'macros': {'rows': 50},
+                'sandbox': {'rows': 50},
+                'output_limit': {'rows': 100},
+                'deadline': {'rows': 100},
+                'warm': {'templates': 10},
+                'builtin_filters': {'rows': 20, 'repeat': 1, 'number': 2},
+                'memory_footprint': {'templates': 20}}
+
+
+def run(scenarios=None, quick=False):
+    """Run the named scenarios (default all) - returns a dictionary of the results
+
+       A quick run times a single small call of each scenario - useful to check the scenarios work
+    """
+    results = {}
+    for name in scenarios or sorted(_SCENARIOS):
+        options = dict(_QUICK_SIZES.get(name, {}), repeat=1, number=1) if quick else {}
+        results[name] = _SCENARIOS[name](**options)
+    return {'templatelite': __version__,
+            'python': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+            'scenarios': results}
+
+
+def _print_results(results):
+    """Print the results as a readable table"""
+    print('templatelite {templatelite} on {python}'.format(**results))
+    for name, scenario in sorted(results['scenarios'].items()):
+        print(name)
+        for key, value in sorted(scenario.items()):
+            if isinstance(value, dict):
+                peak = value['peak_bytes']
+                print('    {:<30} {:>12.1f} ops/sec {:>12} peak'.format(
+                    key, value['ops_per_sec'], '{:,} B'.format(peak) if peak is not None else '-'))
+            elif value is None:
+                print('    {:<30} {:>12}'.format(key, '-'))
+            else:
+                print('    {:<30} {:>12.2f}'.format(key, value))
+
+
+def main(argv=None):
+    """Run the selected benchmarks and report the results"""
+    parser = argparse.ArgumentParser(prog='python -m templatelite.bench',
+                                     description='Benchmark templatelite')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='Scenarios to run (default all) : {}'.format(', '.join(sorted(_SCENARIOS))))
+    parser.add_argument('--json', action='store_true', help='Report the results as JSON')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the JSON results to FILE')
+    parser.add_argument('--quick', action='store_true', help='Time a single call of each scenario')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.scenarios if name not in _SCENARIOS]
+    if unknown:
+        parser.error('Unknown scenario(s) : {}'.format(', '.join(unknown)))
+
+    results = run(args.scenarios, quick=args.quick)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    elif not args.output:
+        _print_results(results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# templatelite : Lightweight Templating system
+
+Summary :
+    Static checks which find the performance hazards in templates
+
+Use Case :
+    As a template author I want to find the constructs which make a template slow to render
+    so that I can fix them before the template is deployed
+
+Testable Statements :
+    ...
+
+Run as ``templatelite check [--context MODULE:NAME] [--import MODULE] PATH ...`` (or
+``python -m templatelite check ...``) - each message is reported as ``path:line: CODE message`` :
+
+    E001 : The template doesn't compile
+    W001 : A loop invariant dotted name is looked up again for every iteration of a loop
+    W002 : A callable is called for every iteration of a loop (only found with a sample context)
+    W003 : A filter is called separately for every iteration of a loop
+    W004 : The ``{% else %}`` of a ``{% for %}`` loop without a ``{% break %}`` - it is always rendered
+    W005 : A huge block of literal text
+"""
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import importlib
+import io
+import os
+import sys
+from collections import namedtuple
+
+import six
+
+if six.PY2:
+    from collections import Mapping
+else:
+    from collections.abc import Mapping
+
+from .templatelite import (Renderer, TemplateSyntaxError, UnrecognisedFilter, UnexpectedFilterArguments,
+                           SandboxError, _Compiler, _builtin_filters)
+
+# Literal text of at least this many characters is reported as a huge literal block
+LARGE_LITERAL = 16 * 1024
+
+# A loop over a sample iterable with fewer items than this isn't reported for its filters
+LARGE_LOOP = 100
+
+# The errors raised by a template which doesn't compile - SyntaxError comes from an expression which isn't valid Python
+_COMPILE_ERRORS = (TemplateSyntaxError, UnrecognisedFilter, UnexpectedFilterArguments, SandboxError, SyntaxError)
+
+# The directives which start and end blocks
+_BLOCK_ENDS = {'for': 'endfor', 'if': 'endif', 'cache': 'endcache', 'macro': 'endmacro'}
+
+# Words in expressions which aren't context variables
+_KEYWORDS = {'in', 'is', 'not', 'True', 'False', 'None', 'and', 'or', 'xor', 'lambda'}
+
+
+class LintMessage(namedtuple('LintMessage', 'path line code message')):
+    """A problem found in a template - line is None if the problem can't be located"""
+    __slots__ = ()
+
+    def __str__(self):
+        return '{path}:{line}: {code} {message}'.format(
+            path=self.path, line=self.line if self.line is not None else '-', code=self.code, message=self.message)
+
+
+def _inline(filter_name, args):
+    """Whether the filter is compiled into an expression rather than called"""
+    return (filter_name in _Compiler._INLINE_FILTERS and not args.strip() and
+            Renderer._filters.get(filter_name) is _builtin_filters.get(filter_name))
+
+
+class _Loop(object):
+    """The state of a for loop while its body is checked"""
+
+    def __init__(self, line, targets, size, jumps):
+        self.line = line
+        self.targets = targets
+        self.size = size
+        self.else_line = None
+        self.has_break = False
+        self.jumps = jumps
+        self.reported = set()
+
+
+class _Checker(object):
+    """Check a single template - a new checker is used for every template"""
+
+    def __init__(self, path, context, large_literal, large_loop):
+        self._path = path
+        self._context = context
+        self._large_literal = large_literal
+        self._large_loop = large_loop
+        self._messages = []
+        self._blocks = []
+        self._loops = []
+        self._bound = {}
+        self._jumping = set()
+        self._for_count = 0
+
+    def _report(self, line, code, message):
+        self._messages.append(LintMessage(self._path, line, code, message))
+
+    def check(self, template_str):
+        """Check the template - returns a list of LintMessages in line order"""
+        try:
+            Renderer(template_str)
+        except _COMPILE_ERRORS as e:
+            line, token = self._failing_token(template_str, e)
+            if isinstance(e, SyntaxError) and token:
+                message = 'Syntax Error : {} \'{}\''.format(
+                    'Empty block ended by' if isinstance(e, IndentationError) else 'Invalid expression in', token)
+            else:
+                message = str(e)
+            self._report(line, 'E001', message)
+            return self._messages
+
+        self._jumping = self._jumping_loops(_Compiler._token_splitter_re.finditer(template_str))
+        line, last_end = 1, 0
+        for match in _Compiler._token_splitter_re.finditer(template_str):
+            text = template_str[last_end:match.start()]
+            self._check_text(line, text)
+            line += text.count('\n')
+
+            token = match.group()
+            self._check_token(line, token.strip())
+            line += token.count('\n')
+            last_end = match.end()
+        self._check_text(line, template_str[last_end:])
+        return sorted(self._messages, key=lambda message: (message.line or 0, message.code))
+
+    def _failing_token(self, template_str, error):
+        """Find the line and text of the token which stops the template compiling - (None, None) if it isn't found
+
+           A missing end directive is reported at the unclosed block. Otherwise the shortest start of the template
+           which fails (once its open blocks are closed) ends with the failing token.
+        """
+        tokens = list(_Compiler._token_splitter_re.finditer(template_str))
+        missing = str(error).startswith('Syntax Error : Missing directive')
+        low, high = (len(tokens), len(tokens)) if missing else (0, len(tokens))
+        while low < high:
+            middle = (low + high) // 2
+            if self._fails(template_str[:tokens[middle].end()], tokens[:middle + 1]):
+                high = middle
+            else:
+                low = middle + 1
+        if low < len(tokens):
+            failing = tokens[low]
+        else:
+            blocks = self._open_blocks(tokens)
+            if not blocks:
+                return None, None
+            failing = blocks[-1][1]
+        return template_str[:failing.start()].count('\n') + 1, failing.group().strip()
+
+    @staticmethod
+    def _open_blocks(tokens):
+        """The (command, token) of each block left open at the end of the tokens - innermost last"""
+        blocks = []
+        for match in tokens:
+            token = match.group().strip()
+            command = token[2:-2].strip('-').strip().split()[:1]
+            if not token.startswith('{%') or not command:
+                continue
+            if command[0] in _BLOCK_ENDS:
+                blocks.append((command[0], match))
+            elif blocks and command[0] == _BLOCK_ENDS[blocks[-1][0]]:
+                blocks.pop()
+        return blocks
+
+    @staticmethod
+    def _jumping_loops(tokens):
+        """The numbers (in the order of their {% for %}) of the loops which contain a {% break %} or {% continue %}"""
+        loops, count, jumping = [], 0, set()
+        for match in tokens:
+            token = match.group().strip()
+            command = token[2:-2].strip('-').strip().split()[:1]
+            if not token.startswith('{%') or not command:
+                continue
+            if command[0] == 'for':
+                count += 1
+                loops.append(count)
+            elif command[0] == 'endfor' and loops:
+                loops.pop()
+            elif command[0] in ('break', 'continue') and loops:
+                jumping.add(loops[-1])
+        return jumping
+
+    def _fails(self, template_str, tokens):
+        """Whether the start of a template fails to compile once every block it leaves open is closed"""
+        closing = ''.join('x{{% {} %}}'.format(_BLOCK_ENDS[command])
+                          for command, _ in reversed(self._open_blocks(tokens)))
+        try:
+            Renderer(template_str + closing)
+        except _COMPILE_ERRORS:
+            return True
+        return False
+
+    def _check_text(self, line, text):
+        if len(text) >= self._large_literal:
+            self._report(line + len(text) - len(text.lstrip('\n')), 'W005',
+                         'Literal block of {:,} characters - move it into a static file, or render the '
+                         'template from a file so that it is memory mapped'.format(len(text)))
+
+    def _check_token(self, line, token):
+        inner_token = token[2:-2].strip('-').strip()
+        if token.startswith('{{'):
+            self._check_displayed(line, inner_token)
+            return
+        if not token.startswith('{%'):
+            return
+
+        command = inner_token.split()[0] if inner_token else ''
+        if command == 'for':
+            m = _Compiler._for_parse_re.match(inner_token + '%}')
+            self._check_expression(line, m.group('iterable'))
+            self._start_loop(line, [target.strip() for target in m.group('target').split(',')],
+                             m.group('iterable').strip())
+        elif command == 'endfor':
+            self._end_loop(self._loops.pop())
+            self._blocks.pop()
+        elif command in ('if', 'cache'):
+            self._blocks.append(command)
+            if command == 'if':
+                self._check_expression(line, inner_token[2:])
+        elif command == 'elif':
+            self._check_expression(line, inner_token[4:])
+        elif command == 'else' and self._blocks[-1] == 'for':
+            self._loops[-1].else_line = line
+        elif command in ('endif', 'endcache', 'endmacro'):
+            self._blocks.pop()
+        elif command == 'macro':
+            self._blocks.append(command)
+        elif command == 'break':
+            self._loops[-1].has_break = True
+
+    def _start_loop(self, line, targets, iterable):
+        """Bind the targets to the first item of the sample iterable, if there is a sample context"""
+        sample, size = self._resolve(iterable.split('.')), None
+        if sample is not None and not isinstance(sample, six.string_types):
+            try:
+                size = len(sample)
+            except TypeError:
+                pass
+            try:
+                item = next(iter(sample), None)
+            except TypeError:
+                item = None
+            if len(targets) == 1:
+                self._bind(targets[0], item)
+            else:
+                values = tuple(item) if isinstance(item, (tuple, list)) and len(item) == len(targets) else ()
+                for index, target in enumerate(targets):
+                    self._bind(target, values[index] if values else None)
+        else:
+            for target in targets:
+                self._bind(target, None)
+        self._blocks.append('for')
+        self._for_count += 1
+        self._loops.append(_Loop(line, set(targets), size, self._for_count in self._jumping))
+
+    def _bind(self, target, value):
+        self._bound.setdefault(target, []).append(value)
+
+    def _end_loop(self, loop):
+        if loop.else_line is not None and not loop.has_break:
+            self._report(loop.else_line, 'W004',
+                         '{{% else %}} of the loop at line {} is always rendered - the loop has no {{% break %}}'
+                         ' (move the else block after {{% endfor %}})'.format(loop.line))
+        for target in loop.targets:
+            self._bound[target].pop()
+
+    def _check_displayed(self, line, variable):
+        if _Compiler._macro_call_re.match(variable):
+            return
+        chain = _Compiler._filter_sep_re.split(variable)
+        self._check_name(line, chain[0].strip())
+        if not self._loops:
+            return
+
+        loop = self._innermost(chain[0].strip())
+        for index, filter_text in enumerate(chain[1:]):
+            filter_name, _, args = filter_text.strip().partition(' ')
+            if _inline(filter_name, args):
+                continue
+            batched = (len(chain) == 2 and filter_name in Renderer._batch_filters and loop is not None and
+                       loop is self._loops[-1] and self._blocks[-1] == 'for' and loop.else_line is None and
+                       not loop.jumps)
+            if not batched:
+                self._check_filter(line, filter_name)
+
+    def _check_expression(self, line, expression):
+        for match in _Compiler._variable_re.finditer(expression):
+            chain = match.group('Variable').split(_Compiler._FILTER_SEP)
+            if chain[0] in _KEYWORDS:
+                continue
+            self._check_name(line, chain[0])
+            if self._loops:
+                for filter_name in chain[1:]:
+                    if not _inline(filter_name, ''):
+                        self._check_filter(line, filter_name)
+
+    def _innermost(self, name):
+        """The innermost loop which binds the root of the dotted name - None if it isn't bound by a loop"""
+        root = name.split('.')[0]
+        for loop in reversed(self._loops):
+            if root in loop.targets:
+                return loop
+        return None
+
+    def _check_filter(self, line, filter_name):
+        loop = self._loops[-1]
+        if loop.size is not None and loop.size < self._large_loop:
+            return
+        if ('filter', filter_name) in loop.reported:
+            return
+        loop.reported.add(('filter', filter_name))
+        self._report(line, 'W003',
+                     'Filter \'{}\' is called for every iteration of the loop at line {} - '
+                     'register a batch filter, or filter the values before rendering'.format(filter_name, loop.line))
+
+    def _check_name(self, line, name):
+        if not self._loops or '.' not in name:
+            return
+        loop = self._loops[-1]
+        if self._innermost(name) is None and ('name', name) not in loop.reported:
+            loop.reported.add(('name', name))
+            self._report(line, 'W001',
+                         'Loop invariant \'{}\' is looked up for every iteration of the loop at line {} - '
+                         'pass the value in the context, or declare it in a schema'.format(name, loop.line))
+
+        callable_part = self._callable_part(name.split('.'))
+        if callable_part is not None and ('call', name) not in loop.reported:
+            loop.reported.add(('call', name))
+            self._report(line, 'W002',
+                         '\'{}\' calls {}() for every iteration of the loop at line {} - '
+                         'pass the result in the context instead'.format(name, callable_part, loop.line))
+
+    def _root_value(self, root):
+        if self._bound.get(root):
+            return True, self._bound[root][-1]
+        if self._context is not None and root in self._context:
+            return True, self._context[root]
+        return False, None
+
+    def _resolve(self, parts):
+        """The value of a dotted name in the sample context - calling callables as the rendered template would"""
+        found, value = self._root_value(parts[0])
+        if not found:
+            return None
+        for part in parts[1:]:
+            if isinstance(value, Mapping):
+                value = value.get(part)
+            elif hasattr(value, part):
+                value = getattr(value, part)
+                if callable(value):
+                    value = value()
+            else:
+                return None
+        return value
+
+    def _callable_part(self, parts):
+        """The first part of a dotted name which is an attribute called at render time - None if there isn't one"""
+        found, value = self._root_value(parts[0])
+        if not found or value is None:
+            return None
+        for index, part in enumerate(parts[1:], 1):
+            if isinstance(value, Mapping):
+                value = value.get(part)
+            elif hasattr(value, part):
+                value = getattr(value, part)
+                if callable(value):
+                    return '.'.join(parts[:index + 1])
+            else:
+                return None
+        return None
+
+
+def check_template(template_str, path='<template>', context=None, large_literal=LARGE_LITERAL, large_loop=LARGE_LOOP):
+    """Check the text of a template - returns a list of LintMessages
+
+        :param template_str: The text of the template
+        :param path: The name used to identify the template in the messages
+        :param context: An optional sample context - used to find the callables which are called within loops, and
+                        the loops which are too small for their filters to matter
+        :param large_literal: The number of characters in a literal block which is reported as huge
+        :param large_loop: The number of items in a sample loop for the filters in the loop to be reported
+    """
+    return _Checker(path, context, large_literal, large_loop).check(template_str)
+
+
+def check_file(path, encoding='utf-8', **options):
+    """Check the template in a file - returns a list of LintMessages"""
+    with io.open(path, 'r', encoding=encoding) as fp:
+        return check_template(fp.read(), path=path, **options)
+
+
+def _template_files(paths, patterns):
+    """The files to check - directories are searched for files matching any of the patterns"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                if any(fnmatch.fnmatch(file_name, pattern) for pattern in patterns):
+                    yield os.path.join(directory, file_name)
+
+
+def _import_object(spec):
+    """Import the object named by module:name"""
+    module, _, name = spec.partition(':')
+    value = importlib.import_module(module)
+    for part in name.split('.') if name else []:
+        value = getattr(value, part)
+    return value
+
+
+def add_arguments(parser):
+    """Add the arguments of the check command to an argument parser"""
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='Template files, or directories to search for templates')
+    parser.add_argument('--pattern', action='append', metavar='GLOB',
+                        help='The file names to check within directories (default *.html)')
+    parser.add_argument('--context', metavar='MODULE:NAME',
+                        help='A sample context dictionary - used to find callables called within loops')
+    parser.add_argument('--import', dest='imports', action='append', default=[], metavar='MODULE',
+                        help='Import a module before checking - e.g. to register custom filters')
+    parser.add_argument('--ignore', default='', metavar='CODES',
+                        help='Comma separated list of message codes to ignore')
+    parser.add_argument('--encoding', default='utf-8', help='The encoding of the template files')
+    parser.add_argument('--large-literal', type=int, default=LARGE_LITERAL, metavar='CHARS',
+                        help='Report literal blocks of at least this many characters (default %(default)s)')
+
+
+def run(args):
+    """Check the templates named by the parsed arguments - returns the exit status (1 if anything is reported)"""
+    sys.path.insert(0, os.getcwd())
+    for module in args.imports:
+        importlib.import_module(module)
+    context = _import_object(args.context) if args.context else None
+    ignore = set(code.strip() for code in args.ignore.split(',') if code.strip())
+
+    status = 0
+    for path in _template_files(args.paths, args.pattern or ['*.html']):
+        for message in check_file(path, encoding=args.encoding, context=context,
+                                  large_literal=args.large_literal):
+            if message.code not in ignore:
+                print(message)
+                status = 1
+    return status
+
+
+def main(argv=None):
+    """Check the templates - the ``templatelite check`` command"""
+    parser = argparse.ArgumentParser(prog='templatelite check',
+                                     description='Find the performance hazards in templates')
+    add_arguments(parser)
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
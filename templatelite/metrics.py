@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# templatelite : Lightweight Templating system
+
+Summary :
+    Observers which receive metrics as templates are compiled and rendered
+
+Use Case :
+    As a developer I want to export the render counts, latencies, output sizes and cache hit rates
+    of each template to my metrics system, so that I can see which templates are slow in production
+
+Testable Statements :
+    ...
+
+An observer is attached to a ``Renderer`` (``observers=[...]``) or to an ``Environment``
+(``add_observer``), which attaches it to every template it creates. A Renderer without
+observers doesn't time anything, so observers cost nothing unless they are used.
+"""
+import bisect
+import threading
+
+
+class RenderObserver(object):
+    """The interface for observers of templates - subclasses override the methods for the metrics they need
+
+        The ``name`` of each template is the name given to ``get_template`` (or the ``name`` given to the
+        Renderer) - None if the template has no name.
+    """
+
+    def compiled(self, name, seconds):
+        """Called when a template has been compiled"""
+        pass
+
+    def rendered(self, name, seconds, size):
+        """Called when a template has been rendered - size is the length of the output (None for ``render_to``)"""
+        pass
+
+    def failed(self, name, seconds, exception):
+        """Called when rendering a template raised an exception"""
+        pass
+
+    def cache_lookup(self, name, hit):
+        """Called when ``Environment.get_template`` looks for the compiled template in its cache"""
+        pass
+
+
+class Histogram(object):
+    """A count of the observed values within each bucket - with the total count, sum, minimum and maximum
+
+        :param bounds: The upper bound of each bucket - values above the largest bound are counted in a final bucket
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count, self.sum, self.min, self.max = 0, 0, None, None
+
+    def observe(self, value):
+        """Add a value to the histogram"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Return an estimate of the percentile - the upper bound of the bucket which holds it (None if empty)"""
+        if not self.count:
+            return None
+        rank, total = self.count * percent / 100.0, 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Return the summary of the histogram"""
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99),
+                'buckets': list(zip(self.bounds + (float('inf'),), self.counts))}
+
+
+class HistogramCollector(RenderObserver):
+    """An observer which keeps histograms of the metrics for each template in memory - intended for local testing
+
+        :param latency_bounds: The bucket bounds (in seconds) for the compile and render times
+        :param size_bounds: The bucket bounds (in characters or bytes) for the output sizes
+
+        ``stats()`` returns a summary of the metrics for each template name.
+    """
+    LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BOUNDS = tuple(256 * 4 ** n for n in range(10))
+
+    def __init__(self, latency_bounds=LATENCY_BOUNDS, size_bounds=SIZE_BOUNDS):
+        self._latency_bounds = latency_bounds
+        self._size_bounds = size_bounds
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    def _metrics(self, name):
+        """The metrics for the named template - must be called with the lock held"""
+        metrics = self._templates.get(name)
+        if metrics is None:
+            metrics = self._templates[name] = {'compile': Histogram(self._latency_bounds),
+                                               'render': Histogram(self._latency_bounds),
+                                               'size': Histogram(self._size_bounds),
+                                               'errors': 0, 'cache_hits': 0, 'cache_misses': 0}
+        return metrics
+
+    def compiled(self, name, seconds):
+        with self._lock:
+            self._metrics(name)['compile'].observe(seconds)
+
+    def rendered(self, name, seconds, size):
+        with self._lock:
+            metrics = self._metrics(name)
+            metrics['render'].observe(seconds)
+            if size is not None:
+                metrics['size'].observe(size)
+
+    def failed(self, name, seconds, exception):
+        with self._lock:
+            metrics = self._metrics(name)
+            metrics['render'].observe(seconds)
+            metrics['errors'] += 1
+
+    def cache_lookup(self, name, hit):
+        with self._lock:
+            self._metrics(name)['cache_hits' if hit else 'cache_misses'] += 1
+
+    def stats(self):
+        """Return a summary of the metrics for each template name"""
+        with self._lock:
+            stats = {}
+            for name, metrics in self._templates.items():
+                lookups = metrics['cache_hits'] + metrics['cache_misses']
+                stats[name] = {'compile': metrics['compile'].as_dict(),
+                               'render': metrics['render'].as_dict(),
+                               'size': metrics['size'].as_dict(),
+                               'errors': metrics['errors'],
+                               'cache_hits': metrics['cache_hits'],
+                               'cache_misses': metrics['cache_misses'],
+                               'cache_hit_rate': float(metrics['cache_hits']) / lookups if lookups else None}
+            return stats
+
+    def reset(self):
+        """Discard all of the metrics"""
+        with self._lock:
+            self._templates.clear()
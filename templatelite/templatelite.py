@@ -12,9 +12,22 @@ Use Case :
 Testable Statements :
     ...
 """
-from collections import deque as deque
+from collections import deque as deque, OrderedDict
 from functools import wraps
+import ast
+import gc
+import hashlib
+import io
+import itertools
+import json
+import keyword
+import mmap
+import os
 import re
+import sys
+import threading
+import time
+import types
 import six
 
 if six.PY2:
@@ -22,21 +35,108 @@ if six.PY2:
 else:
     from collections.abc import Mapping
 
+try:
+    from markupsafe import escape as _markupsafe_escape
+except ImportError:
+    _markupsafe_escape = None
 
-def registerModifier(name):
-    """Helper function to register a modifier function"""
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
 
-    def _outer(f):
-        @wraps(f)
-        def _wrapper(value, *args, **kwargs):
-            return f(value, *args, **kwargs)
 
+def registerModifier(name, pure=False, cache_size=256):
+    """Helper function to register a modifier function
+
+        :param name: The name of the filter as used in templates
+        :param pure: True if the result depends only on the value and arguments - the results are then memoised
+        :param cache_size: The number of results memoised for a pure filter
+
+        The memoised results of a pure filter are held in a single ``LRUCache`` shared by all Renderers (available
+        as the ``cache`` attribute of the registered filter), unless the Renderer is created with a ``filter_cache_size``.
+    """
+
+    def _outer(f):
+        _wrapper = _make_filter(f, pure, cache_size)
         Renderer.register_filter(name, _wrapper)
         return _wrapper
 
     return _outer
 
 
+def registerBatchModifier(name, use_numpy=False):
+    """Helper function to register a batch implementation of a modifier function
+
+        :param name: The name of the filter - the filter must also be registered using ``registerModifier``
+        :param use_numpy: True if the column of values should be passed as a NumPy array (when NumPy is installed)
+
+        The batch function is called with a column of values (and the filter arguments), and must return a
+        sequence of results - one for each value.
+    """
+
+    def _outer(f):
+        Renderer.register_batch_filter(name, f, use_numpy)
+        return f
+
+    return _outer
+
+
+_MISSING = object()
+
+
+def _make_filter(f, pure=False, cache_size=256):
+    """Wrap a filter function ready for registration - memoising the results of pure filters"""
+    if pure:
+        return _memoise_filter(f, LRUCache(maxsize=cache_size))
+
+    @wraps(f)
+    def _wrapper(value, *args, **kwargs):
+        return f(value, *args, **kwargs)
+
+    return _wrapper
+
+
+def _filter_key(value, args, kwargs):
+    """The key for a memoised filter result - the type is included so that (for instance) 1 and True are distinct
+
+       The time zone is included too - aware datetimes in different zones are equal if they are the same instant.
+    """
+    return (value.__class__, value, getattr(value, 'tzinfo', None), args,
+            tuple(sorted(kwargs.items())) if kwargs else ())
+
+
+def _memoise_filter(f, cache):
+    """Wrap a pure filter function so that its results are memoised in the cache"""
+
+    @wraps(f)
+    def _memoised(value, *args, **kwargs):
+        key = _filter_key(value, args, kwargs)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = f(value, *args, **kwargs)
+            cache.set(key, result)
+        return result
+
+    _memoised.cache = cache
+    _memoised.uncached = f
+    return _memoised
+
+
+def _intern_constants(code):
+    """Return the code object with its string constants (and those of any nested code) interned
+
+       Identical literal text in different templates is then only held once. Code objects can only
+       be rebuilt on Python 3.8+, elsewhere the code is returned unchanged.
+    """
+    if not hasattr(code, 'replace'):
+        return code
+    return code.replace(co_consts=tuple(
+        six.moves.intern(const) if type(const) is str else
+        _intern_constants(const) if isinstance(const, types.CodeType) else const
+        for const in code.co_consts))
+
+
 class UnknownContextValue(Exception):
     """Raised when a Context Variable does not exist. This is the dot separated version of the variable name"""
     pass
@@ -57,6 +157,570 @@ class TemplateSyntaxError(Exception):
     pass
 
 
+class TemplateNotFound(Exception):
+    """Raised when a loader cannot find the named template"""
+    pass
+
+
+class ContextSchemaError(Exception):
+    """Raised when a context doesn't have the keys, attributes or methods declared by the template's schema"""
+    pass
+
+
+class EnvironmentFrozen(Exception):
+    """Raised when a filter is registered with an Environment which has already compiled a template"""
+    pass
+
+
+class SandboxError(Exception):
+    """Raised when a sandboxed template uses an expression, attribute or method which the sandbox doesn't allow"""
+    pass
+
+
+class RenderLimitExceeded(Exception):
+    """Raised when rendering a template exceeds one of its limits - the base of the specific limit exceptions"""
+    pass
+
+
+class IterationLimitExceeded(RenderLimitExceeded):
+    """Raised when a loop of a template runs for more than ``max_iterations`` iterations"""
+    pass
+
+
+class OutputLimitExceeded(RenderLimitExceeded):
+    """Raised as soon as the output of a render is larger than ``max_output``"""
+    pass
+
+
+class RenderTimeout(RenderLimitExceeded):
+    """Raised when a loop of a template is still running after the ``deadline`` of the render"""
+    pass
+
+
+class SandboxPolicy(object):
+    """The attribute access policy of a sandboxed template - subclass to change which attributes and methods are allowed
+
+        :param allow_calls: Whether or not the methods found by dotted names are called - by default a sandboxed
+                    template can't call any method.
+
+        Methods which have an ``alters_data`` or ``unsafe_callable`` attribute set to True are never called.
+    """
+
+    def __init__(self, allow_calls=False):
+        self.allow_calls = allow_calls
+
+    def allow_attribute(self, value, name):
+        """Whether or not the attribute of the value can be accessed - private attributes can never be accessed"""
+        return not name.startswith('_')
+
+    def allow_call(self, value, name, method):
+        """Whether or not the method (the attribute name of the value) can be called"""
+        return (self.allow_calls and not getattr(method, 'alters_data', False) and
+                not getattr(method, 'unsafe_callable', False))
+
+
+def _check_schema(path, value, children):
+    """Check that a value has the keys, attributes and methods the schema declares below the dotted path
+
+       Methods aren't called until the template is rendered - so the values they return aren't checked.
+    """
+    for name, (access, grandchildren) in children.items():
+        dotted = path + '.' + name
+        if access == 'item':
+            try:
+                child = value[name]
+            except (KeyError, IndexError, TypeError):
+                six.raise_from(ContextSchemaError(
+                    'Context value \'{}\' is not a key'.format(dotted)), None)
+        elif access == 'attr':
+            try:
+                child = getattr(value, name)
+            except AttributeError:
+                six.raise_from(ContextSchemaError(
+                    'Context value \'{}\' is not an attribute'.format(dotted)), None)
+        else:
+            if access == 'call' and not callable(getattr(value, name, None)):
+                six.raise_from(ContextSchemaError(
+                    'Context value \'{}\' is not a method'.format(dotted)), None)
+            continue
+
+        if grandchildren:
+            _check_schema(dotted, child, grandchildren)
+
+
+class SafeText(str):
+    """A string which has already been made safe for html output - it is never escaped again"""
+
+    def __html__(self):
+        return self
+
+
+def _escape_html(value):
+    """Escape a value for html output
+
+       Values which provide an ``__html__`` method (e.g. ``SafeText``) are already safe and are not escaped again.
+    """
+    if value.__class__ is not str:
+        html = getattr(value, '__html__', None)
+        if html is not None:
+            return html()
+        value = str(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('"', '&#34;').replace("'", '&#39;')
+
+# Use the C accelerated escape from markupsafe if it is installed
+escape_html = _markupsafe_escape if _markupsafe_escape is not None else _escape_html
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+_replace_file = getattr(os, 'replace', os.rename)
+
+
+class _LiteralSpan(object):
+    """A span of literal text within a memory mapped template file
+
+        The text is only decoded when it is needed - when rendering to a stream the bytes
+        are written directly from the file.
+    """
+    __slots__ = ('buffer', 'start', 'end', 'encoding')
+
+    _WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+    # A line separator followed by indentation
+    _indented_re = re.compile(b'[\n\r\x0b\x0c\x1c\x1d\x1e][ \t]')
+
+    def __init__(self, buffer, start, end, encoding):
+        self.buffer, self.start, self.end, self.encoding = buffer, start, end, encoding
+
+    def __len__(self):
+        return self.end - self.start
+
+    def text(self):
+        """The decoded text of the span"""
+        return self.buffer[self.start:self.end].decode(self.encoding)
+
+    def view(self):
+        """The bytes of the span - without copying them"""
+        return memoryview(self.buffer)[self.start:self.end]
+
+    def lstrip(self):
+        """The span without any leading whitespace"""
+        start = self.start
+        while start < self.end and self.buffer[start:start + 1] in self._WHITESPACE:
+            start += 1
+        return _LiteralSpan(self.buffer, start, self.end, self.encoding)
+
+    def rstrip(self):
+        """The span without any trailing whitespace"""
+        end = self.end
+        while end > self.start and self.buffer[end - 1:end] in self._WHITESPACE:
+            end -= 1
+        return _LiteralSpan(self.buffer, self.start, end, self.encoding)
+
+    def skip_newline(self):
+        """The span without a leading newline"""
+        if self.buffer[self.start:self.start + 1] == b'\n':
+            return _LiteralSpan(self.buffer, self.start + 1, self.end, self.encoding)
+        return self
+
+    def indented(self):
+        """Whether or not any line within the span starts with indentation"""
+        return (self.buffer[self.start:self.start + 1] in (b' ', b'\t') or
+                self._indented_re.search(self.buffer, self.start, self.end) is not None)
+
+
+def _join_text(segments):
+    """Join rendered segments which may include literal spans into a single string"""
+    return ''.join(segment.text() if segment.__class__ is _LiteralSpan else segment
+                   for segment in segments)
+
+
+def _deadline_option(kwargs):
+    """The deadline keyword argument of a render - any other keyword argument is an error"""
+    deadline = kwargs.pop('deadline', None)
+    if kwargs:
+        six.raise_from(TypeError('Unexpected keyword argument(s) : {}'.format(', '.join(sorted(kwargs)))), None)
+    return deadline
+
+
+class _CountingStream(object):
+    """A binary stream which counts the bytes written to it - so the observers of render_to are told the size"""
+    __slots__ = ('stream', 'size')
+
+    def __init__(self, stream):
+        self.stream, self.size = stream, 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.stream.write(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+
+class _OutputBudget(object):
+    """The output a single render may still produce - shared by every function of the generated code
+
+       Created for each render, and passed to each function of the generated code as its output_budget argument.
+    """
+    __slots__ = ('remaining', 'limit')
+
+    def __init__(self, limit):
+        self.remaining = self.limit = limit
+
+    def bind(self, segments):
+        """Return the extend and append functions for a list of segments - each one is counted before it is added"""
+        extend, append = segments.extend, segments.append
+
+        def segment_extend(values):
+            self.remaining -= sum(map(len, values))
+            if self.remaining < 0:
+                self._exceeded()
+            extend(values)
+
+        def segment_append(value):
+            self.remaining -= len(value)
+            if self.remaining < 0:
+                self._exceeded()
+            append(value)
+
+        return segment_extend, segment_append
+
+    def _exceeded(self):
+        six.raise_from(OutputLimitExceeded(
+            'Output limit exceeded - the output is larger than {}'.format(self.limit)), None)
+
+
+class LRUCache(object):
+    """An in-process least recently used cache, with an optional time to live
+
+        :param maxsize: The maximum number of entries to keep
+        :param ttl: The number of seconds an entry is valid for - None means entries never expire
+
+        Safe for use from multiple threads. Keys which are not hashable are never cached.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default if there is no valid entry"""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except (KeyError, TypeError):
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < _monotonic():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark as most recently used
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache the value for key - discarding the least recently used entries if full"""
+        expires = _monotonic() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            try:
+                self._entries.pop(key, None)
+            except TypeError:
+                return
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from the cache and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dictionary of the cache statistics"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self._maxsize,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class FileCache(object):
+    """A cache of rendered text stored as files in a local directory, with an optional time to live
+
+        :param directory: The directory to store the cached text in - created if needed
+        :param ttl: The number of seconds an entry is valid for - None means entries never expire
+
+        Entries are shared by all processes using the same directory. Both text and bytes can be cached.
+    """
+    _TEXT, _BYTES = b'T', b'B'
+
+    def __init__(self, directory, ttl=None):
+        self._directory = directory
+        self._ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        """The file name used to store the given key"""
+        return os.path.join(self._directory,
+                            hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.cache')
+
+    def get(self, key, default=None):
+        """Return the text cached for key, or default if there is no valid entry"""
+        path = self._path(key)
+        try:
+            if self._ttl is not None and os.path.getmtime(path) + self._ttl < time.time():
+                self.misses += 1
+                return default
+            with io.open(path, 'rb') as fp:
+                kind, value = fp.read(1), fp.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value if kind == self._BYTES else value.decode('utf-8')
+
+    def set(self, key, value):
+        """Cache the text (or bytes) for key - the file is replaced atomically"""
+        path = self._path(key)
+        temp_path = '{}.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+        with io.open(temp_path, 'wb') as fp:
+            if isinstance(value, six.binary_type):
+                fp.write(self._BYTES + value)
+            else:
+                fp.write(self._TEXT + six.text_type(value).encode('utf-8'))
+        _replace_file(temp_path, path)
+
+    def clear(self):
+        """Remove all entries from the cache and reset the statistics"""
+        for name in os.listdir(self._directory):
+            if name.endswith('.cache'):
+                os.remove(os.path.join(self._directory, name))
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dictionary of the cache statistics"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class DictLoader(object):
+    """Load templates from a dictionary of template names and template text
+
+        :param mapping: The dictionary of templates
+    """
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def get_source(self, name):
+        """Return the text of the named template"""
+        try:
+            return self._mapping[name]
+        except KeyError:
+            six.raise_from(TemplateNotFound('Template \'{}\' not found'.format(name)), None)
+
+    def list_templates(self):
+        """Return a sorted list of the names of the templates"""
+        return sorted(self._mapping)
+
+
+class FileSystemLoader(object):
+    """Load templates from files within a directory
+
+        :param directory: The directory the templates are stored in - template names are paths relative to this directory
+        :param encoding: The encoding of the template files
+    """
+
+    def __init__(self, directory, encoding='utf-8'):
+        self._directory = os.path.abspath(directory)
+        self._encoding = encoding
+
+    def _path(self, name):
+        """The path of the named template - the template must be within the directory"""
+        path = os.path.abspath(os.path.join(self._directory, *name.split('/')))
+        if not path.startswith(os.path.join(self._directory, '')) or not os.path.isfile(path):
+            six.raise_from(TemplateNotFound('Template \'{}\' not found'.format(name)), None)
+        return path
+
+    def get_source(self, name):
+        """Return the text of the named template"""
+        with io.open(self._path(name), 'r', encoding=self._encoding) as fp:
+            return fp.read()
+
+    def list_templates(self):
+        """Return a sorted list of the names of all the templates in the directory"""
+        names = []
+        for directory, _, files in os.walk(self._directory):
+            relative = os.path.relpath(directory, self._directory)
+            for file_name in files:
+                names.append(file_name if relative == os.curdir else
+                             '/'.join(relative.split(os.sep) + [file_name]))
+        return sorted(names)
+
+
+class Environment(object):
+    """A self contained set of filters, a template loader, a cache of compiled templates and the Renderer options
+
+        :param loader: The loader used by ``get_template`` - for instance a ``DictLoader`` or ``FileSystemLoader``
+        :param cache_size: The number of compiled templates kept by ``get_template``
+        :param observers: The observers (see ``RenderObserver``) attached to every Renderer created by this Environment
+        :param options: The options (``errors``, ``autoescape`` etc) for every Renderer created by this Environment
+
+        The Environment starts with a copy of the globally registered filters, so filters registered with
+        ``register_filter`` (or the ``filter`` decorator) are only available to this Environment's templates.
+
+        The filter table is frozen when the first template is compiled - every filter is bound directly into the
+        generated code of each template, so registering a filter afterwards raises ``EnvironmentFrozen``.
+
+        A pre-forking server can compile every template in the parent process with ``warm`` - the children then
+        share the compiled templates rather than each compiling its own copies.
+    """
+    _OPTIONS = {'errors', 'default', 'remove_indentation', 'autoescape', 'collapse_whitespace',
+                'fragment_cache', 'filter_cache_size', 'compact', 'encoding', 'as_bytes', 'incremental',
+                'constants', 'schema', 'volatile', 'sandbox', 'max_iterations', 'max_output'}
+
+    def __init__(self, loader=None, cache_size=256, observers=None, **options):
+        unknown = set(options) - self._OPTIONS
+        if unknown:
+            six.raise_from(TypeError(
+                'Unexpected Environment option(s) : {}'.format(', '.join(sorted(unknown)))), None)
+
+        self.loader = loader
+        self._options = options
+        self._filters = dict(Renderer._filters)
+        self._batch_filters = dict(Renderer._batch_filters)
+        self._frozen = False
+        self._lock = threading.Lock()
+        self._templates = LRUCache(maxsize=cache_size)
+        self._warmed = {}
+        self._observers = list(observers or ())
+
+    @property
+    def frozen(self):
+        """True once a template has been compiled - no more filters can be registered"""
+        return self._frozen
+
+    def _check_not_frozen(self, name):
+        if self._frozen:
+            six.raise_from(EnvironmentFrozen(
+                'Cannot register filter \'{}\' - the Environment has already compiled a template'.format(name)), None)
+
+    def register_filter(self, name, filter_callable, pure=False, cache_size=256):
+        """Register a named filter for this Environment - see ``registerModifier``"""
+        with self._lock:
+            self._check_not_frozen(name)
+            self._filters[name] = _make_filter(filter_callable, pure, cache_size)
+
+    def register_batch_filter(self, name, filter_callable, use_numpy=False):
+        """Register the batch implementation of a named filter for this Environment - see ``registerBatchModifier``"""
+        with self._lock:
+            self._check_not_frozen(name)
+            self._batch_filters[name] = (filter_callable, use_numpy)
+
+    def filter(self, name, pure=False, cache_size=256):
+        """Decorator to register a named filter for this Environment"""
+        def _outer(f):
+            self.register_filter(name, f, pure=pure, cache_size=cache_size)
+            return f
+        return _outer
+
+    def batch_filter(self, name, use_numpy=False):
+        """Decorator to register the batch implementation of a named filter for this Environment"""
+        def _outer(f):
+            self.register_batch_filter(name, f, use_numpy=use_numpy)
+            return f
+        return _outer
+
+    def _freeze(self):
+        """Freeze the filter tables - returns the filters and batch filters to compile with"""
+        with self._lock:
+            self._frozen = True
+            return self._filters, self._batch_filters
+
+    def from_string(self, template_str, **options):
+        """Create a Renderer for the template text using this Environment's filters and options
+
+           Any options given override the Environment's options for this Renderer only.
+        """
+        renderer_options = dict(self._options)
+        renderer_options.update(options)
+        return Renderer(template_str, environment=self, observers=self._observers, **renderer_options)
+
+    def get_template(self, name):
+        """Return the Renderer for the named template - loaded by the loader and compiled on first use"""
+        # Warmed templates are read from a plain dictionary - a lookup doesn't reorder the LRU cache
+        renderer = self._warmed.get(name)
+        if renderer is None:
+            renderer = self._templates.get(name)
+        for observer in self._observers:
+            observer.cache_lookup(name, renderer is not None)
+        if renderer is None:
+            if self.loader is None:
+                six.raise_from(TemplateNotFound(
+                    'Template \'{}\' not found - the Environment has no loader'.format(name)), None)
+            renderer = self.from_string(self.loader.get_source(name), name=name)
+            self._templates.set(name, renderer)
+        return renderer
+
+    def warm(self, names=None, freeze=False):
+        """Compile templates ahead of use - for instance in the parent process of a pre-forking server
+
+           :param names: The names of the templates to compile - by default every template the loader lists
+           :param freeze: Whether or not to move every object in the process into the permanent generation
+                       of the garbage collector once the templates are compiled (``gc.freeze``, Python 3.7+)
+           :returns: The names of the templates compiled
+
+           Warmed templates are kept until ``clear_cache`` is called, whatever the ``cache_size``, and finding
+           them doesn't change any shared structure - so the memory pages which hold them stay shared between
+           forked processes. Freezing stops the garbage collectors of forked processes writing to every object.
+        """
+        if self.loader is None:
+            six.raise_from(ValueError('Cannot warm templates - the Environment has no loader'), None)
+        if names is None:
+            if not hasattr(self.loader, 'list_templates'):
+                six.raise_from(ValueError(
+                    'Cannot warm every template - the Environment\'s loader can\'t list its templates'), None)
+            names = self.loader.list_templates()
+
+        # The dictionary is replaced (rather than changed) so get_template never sees it part way through an update
+        warmed = dict(self._warmed)
+        for name in names:
+            if name not in warmed:
+                warmed[name] = self.from_string(self.loader.get_source(name), name=name)
+        self._warmed = warmed
+
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        return sorted(names)
+
+    def add_observer(self, observer):
+        """Attach an observer to every Renderer created by this Environment - including those already created"""
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Detach an observer from every Renderer created by this Environment"""
+        self._observers.remove(observer)
+
+    def clear_cache(self):
+        """Discard all of the compiled templates kept by ``get_template`` - including the warmed templates"""
+        self._templates.clear()
+        self._warmed = {}
+
+
 class Renderer(object):
     """A General purpose Template renderer
 
@@ -66,6 +730,24 @@ class Renderer(object):
         :param default: The default value to insert into the template if an error
                     occurs.
         :param remove_indentation: Whether or not to remove the left margin indentation.
+        :param autoescape: The escaping applied to all displayed data - either None (no escaping) or 'html'.
+        :param collapse_whitespace: Whether or not to collapse runs of whitespace in the template text.
+        :param fragment_cache: The cache used by ``{% cache %}`` blocks - by default an ``LRUCache`` for this Renderer.
+        :param filter_cache_size: If set the results of pure filters are memoised in caches of this size owned by this Renderer.
+        :param environment: The ``Environment`` whose filters the template uses - by default the globally registered filters.
+        :param compact: Whether or not to keep the compiled template as small as possible - see below.
+        :param use_mmap: Whether or not to memory map the ``template_file`` rather than reading it - see below.
+        :param encoding: The encoding of the ``template_file``, and of the output written by ``render_to``.
+        :param as_bytes: Whether or not the template is compiled to produce bytes encoded with ``encoding``.
+        :param incremental: Whether or not the template is compiled so it can be re-rendered incrementally.
+        :param constants: A dictionary of context variables which are fixed for the life of the Renderer - see ``specialise``.
+        :param schema: A dictionary which declares how each dotted name in the context is accessed - see below.
+        :param volatile: The dotted names which must be looked up every time they are used - see below.
+        :param name: The name of the template reported to the observers.
+        :param observers: The observers (see ``RenderObserver``) which receive the compile and render metrics.
+        :param sandbox: Whether or not the template is sandboxed - True, or the ``SandboxPolicy`` to apply - see below.
+        :param max_iterations: The maximum number of iterations of any single loop - see below.
+        :param max_output: The maximum size of the output of a render - see below.
 
         By using the default values from the class, any data access error in a ``ContextVariable`` will
         cause that context Variable to be rendered into the template as the unconverted context variable name.
@@ -77,44 +759,137 @@ class Renderer(object):
 
         The ``remove_indentation`` flag will strip all left margin indentation from the template as it renders. This setting is suitable for templates
         where any indentation is inconsequential (e.g. html). If the template is intended to create output where indentation needs to be preserved (Restructured Text (.rst), Python Source Code (.py) then ``remove_indentation`` needs to set to false).
-    """
-    # Split template into tokens surrounded by {{ }}, {% %}, or {# #}
-    _token_splitter_re = re.compile( r'({{.*?}}|[ \t]*{%.*?%}|{#.*?#})',
-                                    flags=re.DOTALL)
-#    _token_splitter_re = re.compile(r'(?x)'
-#                                    r'({{.*?}}|                 # Match command tag'
-#                                    r'[ \t]*{%.*?%}|            # Match variable replacement'
-#                                    r'{\#.*?\#}                 # Match comments'
-#                                    r')',
-#                                    flags=re.DOTALL)
 
-    # Split arguments out for filters
-    _split_args_re = re.compile( r"(?P<keyword>[a-zA-Z]\w*?:)?"
-                                 r"(?P<value>((\'.*?\')|"
-                                 r"((?<!\')[^:]+?))"
-                                 r"(?=\s|$))")
+        If ``autoescape`` is set to 'html' then every displayed context variable is html escaped as it is rendered. The escape is compiled
+        directly into the template, so it is much cheaper than applying the ``escape`` filter to every value. Values which are already
+        safe (those passed through the ``safe`` or ``escape`` filters, or any value with an ``__html__`` method) are not escaped again,
+        and the literal text of the template is never escaped.
+
+        Whitespace around any token can be removed by adding a '-' inside the token delimiters : ``{%- ... %}``, ``{{- ... }}``
+        and ``{#- ... #}`` remove all whitespace (including newlines) before the token, and ``{% ... -%}``, ``{{ ... -}}`` and ``{# ... -#}``
+        remove all whitespace after it.
+
+        The ``collapse_whitespace`` flag collapses every run of whitespace in the template text into a single space (or a single newline
+        if the run contains a newline), apart from the content of html ``<pre>``, ``<textarea>``, ``<script>`` and ``<style>`` elements.
+        This is suitable for html templates, and reduces the size of the rendered output.
+
+        All whitespace control happens when the template is compiled, so it has no cost when the template is rendered.
+
+        The output of a ``{% cache 'key' <names> %} ... {% endcache %}`` block is stored in the ``fragment_cache``, keyed on the
+        literal key and the values of the names, and is reused by later renders. Any object with ``get(key)`` and
+        ``set(key, value)`` methods can be used as the cache - see ``LRUCache`` and ``FileCache``.
+
+        Filters registered as pure (see ``registerModifier``) have their results memoised, by default in a cache shared by all
+        Renderers. If ``filter_cache_size`` is set, this Renderer memoises pure filter results in its own caches instead.
+        ``filter_cache_stats`` reports the hit rates for the pure filters used by the template.
+
+        Within a for loop, a displayed value such as ``{{ row.amount|currency }}`` which is derived from the loop target
+        and which uses a filter with a batch implementation (see ``registerBatchModifier``) is computed for the whole loop
+        before the loop starts - the loop then only indexes the pre-computed strings.
+
+        The template is compiled once (by a throwaway compiler) into an immutable ``CompiledTemplate``, which holds no
+        per-render state - a single Renderer can render from many threads at the same time.
+
+        Every filter used by the template is bound directly into the generated code when the template is compiled,
+        so a filter is a single function call at render time.
+
+        The ``compact`` flag is intended for processes which hold many thousands of templates. A compact Renderer
+        doesn't keep the template text or the generated source (``template_str`` and ``template.source`` are None),
+        and the literal text in the generated code is interned, so text which is repeated across templates is only
+        held once.
+
+        The ``use_mmap`` flag is intended for very large template files (for instance big static reports with a
+        few context variables). The file is memory mapped and split into tokens directly from the mapped file;
+        spans of literal text of 64KB or more are kept as offsets into the file rather than being copied into
+        the compiled template. ``render_to`` writes these spans straight from the file to a binary stream, while
+        ``from_context`` decodes them as it renders. A span is only kept as offsets if whitespace control leaves
+        it unchanged - so it must contain no indentation unless ``remove_indentation`` is False, and
+        ``collapse_whitespace`` must not be set.
+
+        If ``as_bytes`` is set the template produces encoded bytes rather than text : the literal text is encoded
+        when the template is compiled, and each displayed value is encoded as it is rendered, so ``from_context``
+        returns bytes without encoding the whole document again, and ``render_to`` writes the encoded segments
+        straight to the stream.
+
+        If ``incremental`` is set each top level block (and each run of text between blocks) is compiled as a
+        separate segment which records the context variables it uses. ``incremental()`` creates an
+        ``IncrementalSession`` which only re-renders the segments whose context variables have changed.
+
+        Context variables given in ``constants`` are folded into the template when it is compiled : displayed values
+        which only use constants become literal text, and ``{% if %}`` and ``{% elif %}`` conditions which only use
+        constants are evaluated, so branches which can never be rendered are removed. ``specialise`` creates a new
+        Renderer for the same template with extra constants.
+
+        The ``schema`` maps dotted names to the way each part is accessed : 'item' (a key of a dictionary),
+        'attr' (an attribute) or 'call' (a method called without arguments) - for instance
+        ``{'user.name': 'item', 'row.total': 'call'}``. A dotted name whose every part is declared is compiled into
+        a direct subscription, attribute access or method call, rather than being resolved at every lookup.
+        The context is checked against the schema once when the template is rendered, and the items of a loop
+        whose target is declared are checked once before the loop starts - a ``ContextSchemaError`` is raised if
+        a declared key, attribute or method is missing, whatever the ``errors`` setting.
+
+        A dotted name which is displayed more than once is only looked up once per render : the value is kept in a
+        local variable where it is first displayed outside of any block, and every later display reads that variable.
+        Methods called by the lookup are therefore only called once. Names in directive expressions are looked up
+        where they are used. Names (and everything below them) listed in ``volatile`` are
+        looked up every time they are used - for instance ``volatile=['clock']`` for a ``clock.now`` method which
+        must be called for each use. Incremental templates always look up every use.
+
+        Each of the ``observers`` is told the time taken to compile the template, and the time taken and the size of
+        the output of each ``from_context`` or ``render_to`` (see ``RenderObserver`` and ``HistogramCollector``).
+        Nothing is timed if there are no observers.
+
+        A ``sandbox`` is intended for templates written by untrusted authors. The expressions of ``{% if %}``,
+        ``{% elif %}`` and ``{% for %}`` may only use context variables, literals, comparisons, boolean operators and
+        simple arithmetic - no calls, subscripts, lambdas or ``**`` - and names beginning with '_' can't be used.
+        These are checked when the template is compiled (a ``SandboxError`` is raised). When the template is rendered
+        each attribute found by a dotted name is checked against the ``SandboxPolicy`` - by default methods aren't
+        called : ``sandbox=SandboxPolicy(allow_calls=True)`` allows them. Dotted names declared by a ``schema`` are
+        accessed as declared. The checks are compiled into the template, so a Renderer without a sandbox is unaffected.
+
+        If ``max_iterations`` is set, the generated code counts the iterations of each loop and raises
+        ``IterationLimitExceeded`` as soon as a loop runs for more than ``max_iterations`` iterations. No more
+        than ``max_iterations`` + 1 items are ever taken from the iterable.
+
+        If ``max_output`` is set, the output of each render is counted (in characters, or bytes if ``as_bytes`` is set)
+        as it is produced, and ``OutputLimitExceeded`` is raised as soon as it is larger than ``max_output`` - before
+        the output is joined, so a runaway template is stopped without building the whole document.
+    """
+    _filters = {}
 
-    # Parse the target and iterables for a for loop, if statement and if else
-    _for_parse_re = re.compile(
-        r"^for\s+?(?P<target>.+)\s+?in\s+(?P<iterable>.+?)(%})")
-    _if_parse_re = re.compile(r'if\s+?(?P<expression>.+?)(%})')
-    _elif_parse_re = re.compile(r'elif\s+?(?P<expression>.+?)(%})')
+    _batch_filters = {}
 
-    # Find variables within expressions - name.name.name|name is valid
-    _variable_re = re.compile( r'\b(?P<Variable>(?<!\'>)'
-                               r'([a-zA-Z]\w*)(\.[a-zA-Z]\w*)*'
-                               r'([|][a-zA-Z]\w*)?(?!\')(?=\W|$)'
-                               r')')
+    # Registration replaces the filter dictionaries (rather than changing them) so that a
+    # template being compiled in another thread always sees a consistent set of filters
+    _registry_lock = threading.Lock()
 
-    _filters = {}
+    _AUTOESCAPE_MODES = {None, 'html'}
 
-    _FILTER_SEP = '|'
+    __slots__ = ('_template_str', '_template', '_options', '_name', '_observers')
 
     def __init__(self, template_str=None,
                  template_fp=None,
                  template_file = '',
                  errors=False, default=None,
-                 remove_indentation=True):
+                 remove_indentation=True,
+                 autoescape=None,
+                 collapse_whitespace=False,
+                 fragment_cache=None,
+                 filter_cache_size=None,
+                 environment=None,
+                 compact=False,
+                 use_mmap=False,
+                 encoding='utf-8',
+                 as_bytes=False,
+                 incremental=False,
+                 constants=None,
+                 schema=None,
+                 volatile=None,
+                 name=None,
+                 observers=None,
+                 sandbox=False,
+                 max_iterations=None,
+                 max_output=None):
         """A General purpose Template renderer
 
             :param template_str: The Template to render
@@ -123,7 +898,21 @@ class Renderer(object):
             :param default: The default value to insert into the template if an error
                         occurs. If None the
         """
-        if template_fp:
+        self._options = dict(errors=errors, default=default, remove_indentation=remove_indentation,
+                             autoescape=autoescape, collapse_whitespace=collapse_whitespace,
+                             fragment_cache=fragment_cache, filter_cache_size=filter_cache_size,
+                             environment=environment, compact=compact, encoding=encoding,
+                             as_bytes=as_bytes, incremental=incremental, constants=constants,
+                             schema=schema, volatile=volatile, name=name, observers=observers,
+                             sandbox=sandbox, max_iterations=max_iterations, max_output=max_output)
+        self._name = name
+        self._observers = observers if observers is not None else ()
+
+        if use_mmap:
+            if not template_file:
+                six.raise_from(ValueError('use_mmap needs a template_file'), None)
+            template_str = self._map_file(template_file, encoding)
+        elif template_fp:
             template_str = template_fp.read()
         elif template_file:
             with open(template_file, 'r') as fp:
@@ -131,40 +920,664 @@ class Renderer(object):
         else:
             template_str = template_str if template_str else ''
 
-        self._template_str = template_str
-
-        if not self._template_str:
+        if not template_str:
             six.raise_from(ValueError('Template cannot be blank/empty'), None)
 
-        self._indent = 4
-        self._extend = False
-        self._source_parts = []
-        self._source = None
-        self._errors = errors
+        if autoescape not in self._AUTOESCAPE_MODES:
+            six.raise_from(ValueError(
+                'Invalid autoescape mode \'{}\''.format(autoescape)), None)
 
-        self._errors = errors
-        self._ignore_indentation = remove_indentation
-        self._default = default
-        self._render = self._compile()
+        if sandbox is True:
+            sandbox = SandboxPolicy()
+        elif not sandbox:
+            sandbox = None
+
+        if environment is not None:
+            filters, batch_filters = environment._freeze()
+        else:
+            filters, batch_filters = self._filters, self._batch_filters
+
+        start = _monotonic()
+        compiler = _Compiler(filters=filters,
+                             batch_filters=batch_filters,
+                             remove_indentation=remove_indentation,
+                             autoescape=autoescape,
+                             collapse_whitespace=collapse_whitespace,
+                             filter_cache_size=filter_cache_size,
+                             compact=compact,
+                             encoding=encoding,
+                             as_bytes=as_bytes,
+                             segmented=incremental,
+                             constants=dict(constants) if constants else None,
+                             schema=schema,
+                             volatile=volatile,
+                             sandbox=sandbox,
+                             max_iterations=max_iterations,
+                             max_output=max_output)
+        self._template = compiler.compile(template_str,
+                                          errors=errors, default=default,
+                                          fragment_cache=fragment_cache)
+        for observer in self._observers:
+            observer.compiled(name, _monotonic() - start)
+        self._template_str = None if compact or use_mmap else template_str
+
+    @staticmethod
+    def _map_file(template_file, encoding):
+        """Memory map the template file - the encoding must be compatible with ascii for the file to be split into tokens"""
+        if u'{%}#'.encode(encoding) != b'{%}#':
+            six.raise_from(ValueError(
+                'Cannot memory map a template with the encoding \'{}\''.format(encoding)), None)
+        with open(template_file, 'rb') as fp:
+            if not os.fstat(fp.fileno()).st_size:
+                return ''
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def template_str(self):
+        """The text of the template - None for a compact Renderer"""
+        return self._template_str
+
+    @property
+    def template(self):
+        """The immutable compiled template"""
+        return self._template
 
     @classmethod
     def register_filter(cls, name, filter_callable):
         """Register a named modifier - internal use only"""
-        cls._filters[name] = filter_callable
+        with cls._registry_lock:
+            filters = dict(cls._filters)
+            filters[name] = filter_callable
+            cls._filters = filters
 
     @classmethod
-    def execute_filter(cls, filter_name='', token='', value=None, args=(), kwargs={}):
-        """Generic class method to execute a named filter
+    def register_batch_filter(cls, name, filter_callable, use_numpy=False):
+        """Register the batch implementation of a named modifier - internal use only"""
+        with cls._registry_lock:
+            batch_filters = dict(cls._batch_filters)
+            batch_filters[name] = (filter_callable, use_numpy)
+            cls._batch_filters = batch_filters
+
+    def filter_cache_stats(self):
+        """Return the cache statistics for each of the pure filters used by the template
+
+           The statistics are from this Renderer's own caches if it has them, otherwise from the shared caches.
+        """
+        return self._template.filter_cache_stats()
+
+    def from_context(self, *contexts, **kwargs):
+        """Public I/f Render the template based on one or more dictionaries - returns bytes if compiled with as_bytes
+
+           :param deadline: The time (a value of ``time.monotonic()``) by which the render must finish - any loop
+                       still running after the deadline raises ``RenderTimeout``.
+        """
+        if not self._observers:
+            return self._template.from_context(*contexts, **kwargs)
+        return self._observe(self._template.from_context, len, *contexts, **kwargs)
+
+    def render_to(self, stream, *contexts, **kwargs):
+        """Render the template based on one or more dictionaries, writing the encoded output to a binary stream
+
+           :param deadline: The time by which the render must finish - as for ``from_context``
+        """
+        if not self._observers:
+            self._template.render_to(stream, *contexts, **kwargs)
+        else:
+            stream = _CountingStream(stream)
+            self._observe(self._template.render_to, lambda output: stream.size, stream, *contexts, **kwargs)
+
+    def _observe(self, render, size, *args, **kwargs):
+        """Render the template - telling the observers how long it took, and the size of the output
+
+           size is called with the result of render, and returns the size of the output.
+        """
+        start = _monotonic()
+        try:
+            output = render(*args, **kwargs)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            seconds = _monotonic() - start
+            for observer in self._observers:
+                observer.failed(self._name, seconds, e)
+            six.reraise(*exc_info)
+
+        seconds = _monotonic() - start
+        for observer in self._observers:
+            observer.rendered(self._name, seconds, size(output))
+        return output
+
+    def specialise(self, constants):
+        """Create a new Renderer for this template with the constant context variables folded into it
+
+           :param constants: A dictionary of the context variables which are fixed - added to any
+                       constants this Renderer already has
+        """
+        if self._template_str is None:
+            six.raise_from(ValueError(
+                'Cannot specialise a compact or memory mapped Renderer - the template text is not kept'), None)
+        options = dict(self._options)
+        options['constants'] = dict(options['constants'] or {})
+        options['constants'].update(constants)
+        return Renderer(self._template_str, **options)
+
+    def incremental(self):
+        """Create an IncrementalSession which re-renders only the changed segments of the template"""
+        if self._template._segments is None:
+            six.raise_from(ValueError('The Renderer must be created with incremental=True'), None)
+        return IncrementalSession(self._template)
+
+
+class CompiledTemplate(object):
+    """An immutable compiled template - created by a Renderer
+
+        Holds the generated render function and everything it needs at render time; nothing is changed
+        by rendering, so a CompiledTemplate can be shared by any number of threads.
+    """
+
+    __slots__ = ('_render', '_source', '_namespace', '_targets', '_locals', '_errors', '_default',
+                 '_filters', '_used_filters', '_filter_caches', '_filter_sites', '_fragment_cache',
+                 '_spans', '_encoding', '_as_bytes', '_segments', '_constants', '_schema', '_schema_roots',
+                 '_sandbox', '_max_output')
+
+    def __init__(self, render, source, namespace, targets, locals, errors, default,
+                 filters, used_filters, filter_caches, filter_sites, fragment_cache,
+                 spans=False, encoding='utf-8', as_bytes=False, segments=None, constants=None, schema=None,
+                 sandbox=None, max_output=None):
+        setattr_ = super(CompiledTemplate, self).__setattr__
+        setattr_('_render', render)
+        setattr_('_source', source)
+        setattr_('_namespace', namespace)
+        setattr_('_targets', frozenset(targets))
+        setattr_('_locals', frozenset(locals))
+        setattr_('_errors', errors)
+        setattr_('_default', default)
+        setattr_('_filters', filters)
+        setattr_('_used_filters', frozenset(used_filters))
+        setattr_('_filter_caches', filter_caches)
+        setattr_('_filter_sites', filter_sites)
+        setattr_('_fragment_cache', fragment_cache)
+        setattr_('_spans', spans)
+        setattr_('_encoding', encoding)
+        setattr_('_as_bytes', as_bytes)
+        setattr_('_segments', segments)
+        setattr_('_constants', constants or {})
+        setattr_('_schema', schema or {})
+        setattr_('_schema_roots', frozenset(self._locals.intersection(self._schema)))
+        setattr_('_sandbox', sandbox)
+        setattr_('_max_output', max_output)
+
+    def __setattr__(self, name, value):
+        six.raise_from(AttributeError('CompiledTemplate is immutable'), None)
+
+    @property
+    def source(self):
+        """The generated python source of the render function - None if the template was compiled as compact"""
+        return self._source
+
+    def _filter_token(self, traceback):
+        """Find the token which used the filter that raised an exception
+
+           Filters are called directly by the generated code - so the failing token is found from the
+           line of the generated code being executed, and the filter functions being executed.
+        """
+        lineno, codes = None, set()
+        while traceback is not None:
+            if traceback.tb_frame.f_globals is self._namespace:
+                lineno, codes = traceback.tb_lineno, set()
+            else:
+                codes.add(traceback.tb_frame.f_code)
+            traceback = traceback.tb_next
+
+        sites = self._filter_sites.get(lineno, ())
+        for token, func in sites:
+            # Find the original filter function within any wrappers
+            while hasattr(func, 'uncached') or hasattr(func, '__wrapped__'):
+                func = getattr(func, 'uncached', None) or func.__wrapped__
+            if getattr(func, '__code__', None) in codes:
+                return token
+        return sites[0][0] if sites else None
+
+    def filter_cache_stats(self):
+        """Return the cache statistics for each of the pure filters used by the template
+
+           The statistics are from this Renderer's own caches if it has them, otherwise from the shared caches.
+        """
+        stats = {}
+        for filter_name in self._used_filters:
+            if filter_name in self._filter_caches:
+                stats[filter_name] = self._filter_caches[filter_name].stats()
+            elif hasattr(self._filters[filter_name], 'cache'):
+                stats[filter_name] = self._filters[filter_name].cache.stats()
+        return stats
+
+    def _dodots(self, token='', value=None, parts=None, context={}, bound=False):
+        """Process a expression - i.e. access to a data item within the context
+
+           A wrapper around self._resolvedots so that errors are dealt with as
+           requested by the caller
+
+           Executed at run time only
+
+           :param token: The full token for error reporting only - remove ??
+           :param value: The actual value of the first/only part of the name
+           :param parts: The separated parts of the dotted name - including the name of the value
+           :param as_string: Whether this should return a string of a value - remove ??
+           :param context:  The operational context for this template
+           :param bound: True if the first name is a parameter of the macro being rendered - so it is never missing
+        """
+        # If the first name isn't in the context and isn't in the targets wrap produce a 'default' value
+        if not bound and parts[0] not in context and parts[0] not in self._targets:
+            return self._missing(token)
+
+        # Try to resolve any further dotte dess
+        current_value = value
+
+        parts = parts[1:] if len(parts) > 1 else []
+
+        for sub_item in parts:
+            if isinstance(current_value, Mapping):
+                try:
+                    current_value = current_value[sub_item]
+                    continue
+                except KeyError:
+                    return self._missing(token)
+
+            if hasattr(current_value, sub_item):
+                if callable(getattr(current_value, sub_item)):
+                    current_value = getattr(current_value, sub_item)()
+                    continue
+                else:
+                    current_value = getattr(current_value, sub_item)
+                    continue
+            else:
+                return self._missing(token)
+        else:
+            return current_value
+
+    def _sandboxed_dots(self, token='', value=None, parts=None, context={}, bound=False):
+        """Process an expression within a sandboxed template - as _dodots, but every attribute which is
+           accessed and every method which is called must be allowed by the sandbox policy
 
-           Run at execute time
+           Executed at run time only
         """
-        func = cls._filters[filter_name]
+        if not bound and parts[0] not in context and parts[0] not in self._targets:
+            return self._missing(token)
+
+        policy, current_value = self._sandbox, value
+        for sub_item in parts[1:]:
+            if isinstance(current_value, Mapping):
+                try:
+                    current_value = current_value[sub_item]
+                    continue
+                except KeyError:
+                    return self._missing(token)
+
+            if not policy.allow_attribute(current_value, sub_item):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : Access to \'{}\' is not allowed in \'{}\''.format(sub_item, token)), None)
+            if not hasattr(current_value, sub_item):
+                return self._missing(token)
+
+            attribute = getattr(current_value, sub_item)
+            if callable(attribute):
+                if not policy.allow_call(current_value, sub_item, attribute):
+                    six.raise_from(SandboxError(
+                        'Sandbox Error : Calling \'{}\' is not allowed in \'{}\''.format(sub_item, token)), None)
+                attribute = attribute()
+            current_value = attribute
+        return current_value
+
+    def _missing(self, token):
+        """The value of a context variable which can't be found - raises UnknownContextValue if errors are requested"""
+        if self._errors:
+            six.raise_from(UnknownContextValue('Unknown context variable \'{}\''.format(token)), None)
+        return '' if not token.startswith('{{') else (self._default if self._default else token)
+
+    def from_context(self, *contexts, **kwargs):
+        """Render the template based on one or more dictionaries - with an optional deadline"""
+        deadline = _deadline_option(kwargs)
+        if self._spans and not self._as_bytes:
+            return self._render_contexts(contexts, deadline, _join_text)
+        return self._render_contexts(contexts, deadline)
+
+    def render_to(self, stream, *contexts, **kwargs):
+        """Render the template based on one or more dictionaries, writing the encoded output to a binary stream
+
+           Literal spans of a memory mapped template are written directly from the file.
+        """
+        deadline = _deadline_option(kwargs)
+        if self._as_bytes:
+            self._render_contexts(contexts, deadline, stream.writelines)
+            return
+
+        encoding = self._encoding
+
+        def write(segments):
+            text = []
+            for segment in segments:
+                if segment.__class__ is _LiteralSpan:
+                    stream.write(''.join(text).encode(encoding))
+                    stream.write(segment.view())
+                    text = []
+                else:
+                    text.append(segment)
+            stream.write(''.join(text).encode(encoding))
+
+        self._render_contexts(contexts, deadline, write)
+
+    def _render_contexts(self, contexts, deadline, *join):
+        """Render the template, and join (or write) the rendered segments"""
+        return self._call(self._render, self, self._context(contexts), *join, **self._render_state(deadline))
+
+    def _context(self, contexts):
+        """Merge the contexts into a single context, and check it has all of the context variables if needed"""
+        this_context = {}
+        for context in contexts:
+            this_context.update(context)
+        this_context.update(self._constants)
+
+        for var_name in self._locals:
+            if var_name in this_context:
+                continue
+
+            if self._errors:
+                raise UnknownContextValue('Unknown context variable \'{}\''.format(var_name))
+
+        for var_name in self._schema_roots:
+            if var_name not in this_context:
+                six.raise_from(ContextSchemaError(
+                    'Missing context variable \'{}\''.format(var_name)), None)
+            _check_schema(var_name, this_context[var_name], self._schema[var_name])
+
+        return this_context
+
+    def _render_state(self, deadline):
+        """The state of a single render - passed to the functions of the generated code as keyword arguments"""
+        if self._max_output is not None:
+            return {'render_deadline': deadline, 'output_budget': _OutputBudget(self._max_output)}
+        return {'render_deadline': deadline}
+
+    def _validate_items(self, items, targets):
+        """Check the items of a loop against the schema for the loop targets - returns the items as a list
+
+           Executed at run time - once before the loop starts
+        """
+        items = list(items)
+        for item in items:
+            values = zip(targets, item) if len(targets) > 1 else ((targets[0], item),)
+            for name, value in values:
+                if name in self._schema:
+                    _check_schema(name, value, self._schema[name])
+        return items
+
+    def _deadline_items(self, items, deadline, message):
+        """Read the items of a loop which has batch filtered columns - checking the deadline as each one is read
+
+           Executed at run time - once before the loop starts
+        """
+        if deadline is None:
+            return list(items)
+        checked = []
+        for item in items:
+            if _monotonic() > deadline:
+                raise RenderTimeout(message)
+            checked.append(item)
+        return checked
+
+    def _call(self, render, *args, **kwargs):
+        """Call a generated render function - reporting filter errors against the template token"""
         try:
-            return func(value, *args, **kwargs)
+            return render(*args, **kwargs)
         except UnexpectedFilterArguments:
+            token = self._filter_token(sys.exc_info()[2])
+            if token is None:
+                raise
             six.raise_from(UnexpectedFilterArguments(
-                "Unexpected filter arguments in \'{token}\'".format(
-                    token=token, args=''.join(args), kwargs=' '.join(kwargs))), None)
+                "Unexpected filter arguments in \'{token}\'".format(token=token)), None)
+
+
+class _ConstantScope(object):
+    """Stands in for the CompiledTemplate when expressions which only use constants are evaluated during compilation"""
+    _dodots = CompiledTemplate.__dict__['_dodots']
+    _sandboxed_dots = CompiledTemplate.__dict__['_sandboxed_dots']
+    _missing = CompiledTemplate.__dict__['_missing']
+
+    def __init__(self, targets, errors, default, sandbox=None):
+        self._targets, self._errors, self._default, self._sandbox = targets, errors, default, sandbox
+
+
+class IncrementalSession(object):
+    """Re-render a template, reusing the output of the segments whose context variables haven't changed
+
+        Created by ``Renderer.incremental()``. Each top level ``{% for %}``, ``{% if %}`` and ``{% cache %}``
+        block, and each run of text and displayed values between them, is a separate segment of the template;
+        a segment is only rendered again if one of the context variables it uses has changed since the previous
+        render. A context variable is unchanged if it is the same object as, or is equal to, its previous value -
+        so changed data must be passed as new objects, or named in the ``changed`` argument of ``render``.
+
+        A session keeps the output of the previous render, so it must only be used by one thread at a time.
+    """
+
+    def __init__(self, template):
+        self._template = template
+        self._values = {}
+        self._outputs = None
+        self._changes = []
+
+    @staticmethod
+    def _unchanged(previous, value):
+        """Whether or not a context variable has the same value as the previous render"""
+        if previous is value:
+            return True
+        try:
+            return bool(previous == value)
+        except Exception:
+            return False
+
+    def render(self, *contexts, **kwargs):
+        """Render the template based on one or more dictionaries
+
+           :param changed: The names of the context variables which have changed - by default every
+                       context variable is compared with its value in the previous render.
+           :param deadline: The time by which the render must finish - as for ``Renderer.from_context``
+        """
+        changed = kwargs.pop('changed', None)
+        deadline = _deadline_option(kwargs)
+
+        template = self._template
+        context = template._context(contexts)
+        if changed is None:
+            changed = [name for name in template._locals
+                       if not self._unchanged(self._values.get(name, _MISSING), context.get(name, _MISSING))]
+        changed = frozenset(changed)
+
+        outputs, changes, state = [], [], template._render_state(deadline)
+        for index, (segment, names) in enumerate(template._segments):
+            if self._outputs is not None and not (names & changed):
+                outputs.append(self._outputs[index])
+                continue
+            output = template._call(segment, template, context, **state)
+            if self._outputs is None or output != self._outputs[index]:
+                changes.append((index, output))
+            outputs.append(output)
+
+        self._outputs, self._changes = outputs, changes
+        self._values = dict((name, context.get(name, _MISSING)) for name in template._locals)
+        return (b'' if template._as_bytes else '').join(outputs)
+
+    @property
+    def changes(self):
+        """The segments changed by the last render - a list of (segment index, output) pairs"""
+        return list(self._changes)
+
+    @property
+    def segments(self):
+        """The output of each segment of the template from the last render"""
+        return tuple(self._outputs or ())
+
+
+class _ContextReference(object):
+    """A filter argument which is a dotted context variable - looked up when the template is rendered"""
+    __slots__ = ('parts',)
+
+    def __init__(self, name):
+        self.parts = name.split('.')
+
+
+class _Compiler(object):
+    """Compile a template into a CompiledTemplate
+
+       A new compiler is used for every template, so all of the state needed during
+       compilation is thrown away once the template is compiled.
+    """
+    # Split template into tokens surrounded by {{ }}, {% %}, or {# #}
+    _token_splitter_re = re.compile( r'({{.*?}}|[ \t]*{%.*?%}|{#.*?#})',
+                                    flags=re.DOTALL)
+    _buffer_token_re = re.compile(br'{{.*?}}|[ \t]*{%.*?%}|{#.*?#}', flags=re.DOTALL)
+
+    # Literal text in a memory mapped template of at least this many bytes is kept as offsets into the file
+    _LARGE_LITERAL = 64 * 1024
+#    _token_splitter_re = re.compile(r'(?x)'
+#                                    r'({{.*?}}|                 # Match command tag'
+#                                    r'[ \t]*{%.*?%}|            # Match variable replacement'
+#                                    r'{\#.*?\#}                 # Match comments'
+#                                    r')',
+#                                    flags=re.DOTALL)
+
+    # Find elements where whitespace must be preserved, and runs of whitespace to collapse
+    _preserve_ws_re = re.compile(r'<(?P<close>/?)(?P<tag>pre|textarea|script|style)\b[^>]*>',
+                                 flags=re.IGNORECASE)
+    _whitespace_re = re.compile(r'\s+')
+
+    # Split arguments out for filters - quoted strings, numbers, dotted context variables or any other literal word
+    _split_args_re = re.compile(r"""\s*(?:(?P<keyword>[a-zA-Z_]\w*):)?
+                                   (?:(?P<string>'[^']*'|"[^"]*")|
+                                      (?P<number>[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)(?=\s|$)|
+                                      (?P<reference>[a-zA-Z_]\w*(?:\.[a-zA-Z_]\w*)+)(?=\s|$)|
+                                      (?P<word>\S+))""", flags=re.VERBOSE)
+
+    # Words which are filter arguments with a python value
+    _ARG_WORDS = {'True': True, 'False': False, 'None': None}
+
+    # Parse the target and iterables for a for loop, if statement and if else
+    _for_parse_re = re.compile(
+        r"^for\s+?(?P<target>.+)\s+?in\s+(?P<iterable>.+?)(%})")
+    _if_parse_re = re.compile(r'if\s+?(?P<expression>.+?)(%})')
+    _cache_parse_re = re.compile(
+        r'^cache\s+(?P<key>\'[^\']*\'|"[^"]*")(?P<vary>[^%]*)(%})')
+    _elif_parse_re = re.compile(r'elif\s+?(?P<expression>.+?)(%})')
+    _macro_parse_re = re.compile(r'^macro\s+(?P<name>[a-zA-Z_]\w*)\s*\((?P<params>[^)]*)\)\s*(%})')
+
+    # A displayed call of a macro - name(arguments)
+    _macro_call_re = re.compile(r'^(?P<name>[a-zA-Z_]\w*)\s*\((?P<args>.*)\)$', flags=re.DOTALL)
+
+    # Find variables within expressions - name.name.name|name|name is valid
+    _variable_re = re.compile( r'\b(?P<Variable>(?<!\'>)'
+                               r'([a-zA-Z]\w*)(\.[a-zA-Z]\w*)*'
+                               r'([|][a-zA-Z]\w*)*(?!\')(?=\W|$)'
+                               r')')
+
+    # String literals within expressions - names within them aren't context variables
+    _string_literal_re = re.compile(r'''(?:'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")''')
+
+    _FILTER_SEP = '|'
+
+    # Split a context variable from its chain of filters - ignoring any '|' within quoted filter arguments
+    _filter_sep_re = re.compile(r'''\|(?=(?:[^'"]|'[^']*'|"[^"]*")*$)''')
+
+    # Filter names which can be used directly as the names the filters are bound to in the generated code
+    _identifier_re = re.compile(r'^[a-zA-Z_]\w*$')
+
+    # The comment which marks the filters called on a line of the generated code
+    _site_comment_re = re.compile(r'  # filters (?P<site>\d+)$')
+
+    # Directives which start a block - each top level block is a separate segment of a segmented template
+    _BLOCK_DIRECTIVES = {'for', 'if', 'cache'}
+
+    # Filters whose output is already safe - autoescape doesn't need to escape these again
+    _SAFE_FILTERS = {'safe', 'escape', 'json'}
+
+    # Built in filters which are compiled into an expression when they are used without arguments
+    _INLINE_FILTERS = {'upper': 'str({}).upper()', 'lower': 'str({}).lower()', 'title': 'str({}).title()',
+                       'len': 'len({})'}
+
+    # The syntax tree nodes which are allowed in the expressions of a sandboxed template - no calls, attributes,
+    # subscripts, comprehensions, lambdas or powers
+    _SANDBOX_NODES = {'Expression', 'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'UAdd', 'USub',
+                      'BinOp', 'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod',
+                      'Compare', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Is', 'IsNot',
+                      'IfExp', 'Name', 'Load', 'Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Tuple', 'List'}
+
+    # The names allowed in a sandboxed expression - every context variable is checked as 'value'
+    _SANDBOX_NAMES = {'value', 'True', 'False', 'None'}
+
+    # Literal sequences which can't be repeated in a sandboxed expression - 'x' * 10000000000
+    _SANDBOX_SEQUENCES = {'Constant', 'Str', 'Bytes', 'Tuple', 'List'}
+
+    _SANDBOX_DESCRIPTIONS = {'Call': 'Calls are', 'Attribute': 'Attribute access is', 'Subscript': 'Subscripts are',
+                             'Pow': '\'**\' is', 'Lambda': 'Lambdas are', 'Name': 'Unknown names are'}
+
+    # The generated code for each kind of access declared by a schema
+    _SCHEMA_ACCESS = {'item': '[{!r}]', 'attr': '.{}', 'call': '.{}()'}
+
+    def __init__(self, filters, batch_filters, remove_indentation=True, autoescape=None,
+                 collapse_whitespace=False, filter_cache_size=None, compact=False, encoding='utf-8',
+                 as_bytes=False, segmented=False, constants=None, schema=None, volatile=None,
+                 sandbox=None, max_iterations=None, max_output=None):
+        self._filters = filters
+        self._batch_filters = batch_filters
+        self._ignore_indentation = remove_indentation
+        self._autoescape = autoescape
+        self._collapse_whitespace = collapse_whitespace
+        self._filter_cache_size = filter_cache_size
+        self._compact = compact
+        self._encoding = encoding
+        self._as_bytes = as_bytes
+        self._segmented = segmented
+        self._constants = constants
+        self._schema = self._schema_tree(schema) if schema else {}
+        self._volatile = tuple(volatile or ())
+        self._sandbox = sandbox
+        self._max_iterations = max_iterations
+        self._max_output = max_output
+        self._repeated = set()
+        self._jumping_loops = set()
+        self._trimmed_after = set()
+        self._lookups = {}
+        self._macro = None
+        self._macros = {}
+        self._macro_locals = set()
+        self._fold_stack = []
+        self._segment_locals = set()
+        self._span_count = 0
+        self._filter_caches = {}
+        self._used_filters = set()
+        self._namespace = {'escape_html': escape_html, 'islice': itertools.islice,
+                           'IterationLimitExceeded': IterationLimitExceeded,
+                           'monotonic': _monotonic, 'RenderTimeout': RenderTimeout}
+        self._bound_filters = {}
+        self._sites = []
+        self._pending_sites = []
+        self._indent = 4
+        self._extend = False
+        self._source_parts = []
+
+    def _schema_tree(self, schema):
+        """Build a tree of the schema - {root: {name: [access, {name: [access, {...}]}]}}"""
+        tree = {}
+        for path, access in schema.items():
+            if access not in self._SCHEMA_ACCESS:
+                six.raise_from(ValueError(
+                    'Invalid schema access \'{}\' for \'{}\''.format(access, path)), None)
+            parts = path.split('.')
+            if len(parts) < 2 or not all(self._identifier_re.match(part) for part in parts):
+                six.raise_from(ValueError('Invalid schema path \'{}\''.format(path)), None)
+
+            children = tree.setdefault(parts[0], {})
+            for part in parts[1:-1]:
+                children = children.setdefault(part, [None, {}])[1]
+            children.setdefault(parts[-1], [None, {}])[0] = access
+        return tree
 
     def _end_block(self, dedent=False):
         """Record the end of the block in the source code"""
@@ -184,24 +1597,132 @@ class Renderer(object):
 
             Find all potential name within the expression (which might be filtered)
             and pass them to be compiled - filter out known keywords
-            Pass the rest of the expression as is.
+            Pass the rest of the expression as is - in a sandboxed template the rest of the
+            expression must only use the operators the sandbox allows.
         """
         s = ''
+        checked = ''
         last_end = 0
+        self._expression_constant = True
+        literals = [literal.span() for literal in self._string_literal_re.finditer(expression_text)]
         for match in self._variable_re.finditer(expression_text):
+            if any(start <= match.start('Variable') < end for start, end in literals):
+                continue
             to = match.start('Variable')
             s += expression_text[last_end:to]
+            checked += expression_text[last_end:to]
             var = match.group('Variable')
             if var in ['in', 'is', 'not', 'True', 'False', 'and', 'or', 'xor',
                        'lambda']:
                 s += var
+                checked += var
             else:
+                self._expression_constant = self._expression_constant and self._is_constant(var)
                 s += self._compile_filtered_token(var)
+                checked += 'value'
             last_end = match.end('Variable')
         else:
             s += expression_text[last_end:]
+            checked += expression_text[last_end:]
+
+        if self._sandbox is not None:
+            self._check_sandboxed(checked, expression_text)
         return s
 
+    def _check_sandboxed(self, checked, expression_text):
+        """Check that an expression (with every context variable replaced by 'value') only uses the allowed operators"""
+        try:
+            tree = ast.parse(checked.strip(), mode='eval')
+        except SyntaxError:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Invalid expression \'{}\''.format(expression_text.strip())), None)
+
+        for node in ast.walk(tree):
+            name = node.__class__.__name__
+            if name not in self._SANDBOX_NODES or (name == 'Name' and node.id not in self._SANDBOX_NAMES):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : {} not allowed in the expression \'{}\''.format(
+                        self._SANDBOX_DESCRIPTIONS.get(name, '\'{}\' is'.format(name)),
+                        expression_text.strip())), None)
+            if name == 'BinOp' and node.op.__class__.__name__ == 'Mult' and any(
+                    operand.__class__.__name__ in self._SANDBOX_SEQUENCES and
+                    (operand.__class__.__name__ != 'Constant' or isinstance(operand.value, (str, bytes)))
+                    for operand in (node.left, node.right)):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : Repeating a sequence is not allowed in the expression \'{}\''.format(
+                        expression_text.strip())), None)
+            if name == 'BinOp' and node.op.__class__.__name__ == 'Mod' and self._is_string_literal(node.left):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : String formatting is not allowed in the expression \'{}\''.format(
+                        expression_text.strip())), None)
+
+    @staticmethod
+    def _is_string_literal(node):
+        """Whether a syntax tree node is a str or bytes literal - '%50000000d' % 1 allocates a huge string"""
+        name = node.__class__.__name__
+        return name in ('Str', 'Bytes') or (name == 'Constant' and isinstance(node.value, (six.text_type, bytes)))
+
+    def _is_constant(self, variable):
+        """Whether or not a context variable (which may be dotted or filtered) is one of the constants"""
+        root = variable.split(self._FILTER_SEP)[0].split('.')[0].strip()
+        return self._constants is not None and root in self._constants and root not in self._targets
+
+    def _snapshot(self):
+        """Record the context variables and filter sites - so a folded expression leaves no trace"""
+        return set(self._locals), set(self._segment_locals), list(self._pending_sites)
+
+    def _restore(self, snapshot):
+        self._locals, self._segment_locals, self._pending_sites = set(snapshot[0]), set(snapshot[1]), list(snapshot[2])
+
+    def _evaluate(self, expression):
+        """Evaluate compiled source which only uses constants - returns whether it succeeded, and the value"""
+        names = dict(self._namespace)
+        names.update(self._constants)
+        names.update(template=self._constant_scope, context=self._constants, escape=escape_html)
+        try:
+            return True, eval(expression, names)
+        except Exception:
+            return False, None
+
+    def _compile_condition(self, expression_text, dead=False):
+        """Compile the expression of an if or elif
+
+           Returns the source and the value of the condition - the value is None unless it only uses
+           constants. A condition in a dead branch (after a branch which is always taken) is always False.
+        """
+        snapshot = self._snapshot()
+        expression = self._compile_expression(expression_text)
+        if dead:
+            self._restore(snapshot)
+            return 'False', False
+        if self._constants is None or not self._expression_constant:
+            return expression, None
+
+        succeeded, value = self._evaluate(expression)
+        if not succeeded:
+            return expression, None
+        self._restore(snapshot)
+        return repr(bool(value)), bool(value)
+
+    def _fold_branch(self, value):
+        """Start a branch of an if statement - the branch is discarded if its condition is always False"""
+        if value is True:
+            self._fold_stack[-1]['taken'] = True
+        elif value is False:
+            self._block_source.append(' ' * self._indent + 'pass\n')
+            self._fold_stack[-1]['discard'] = (self._block_source, self._snapshot(), set(self._targets))
+            self._block_source = []
+
+    def _end_discard(self):
+        """End the current branch of an if statement - restoring the state if the branch was discarded"""
+        fold = self._fold_stack[-1]
+        if fold['discard'] is not None:
+            self._block_source, snapshot, targets = fold['discard']
+            self._restore(snapshot)
+            self._targets.intersection_update(targets)
+            fold['discard'] = None
+            self._extend = False
+
     def _compile_if(self, statement_token):
         """ Compile an If stateement
 
@@ -214,12 +1735,14 @@ class Renderer(object):
             six.raise_from(TemplateSyntaxError(
                 'Syntax Error : Invalid if statement \'{{% {}\''.format(
                     statement_token)), None)
-        expression = self._compile_expression(m.group('expression'))
+        expression, value = self._compile_condition(m.group('expression'))
         self._block_stack.append(('if', None))
         self._end_block()
         self._block_source.append(
-            ' ' * self._indent + 'if {}'.format(expression) + ':\n')
+            ' ' * self._indent + 'if {}'.format(expression) + ':' + self._site_comment() + '\n')
         self._start_block(indent=True)
+        self._fold_stack.append({'taken': False, 'discard': None})
+        self._fold_branch(value)
 
     def _compile_elif(self, statement_token):
         """ Compile an elif stateement
@@ -242,12 +1765,14 @@ class Renderer(object):
             six.raise_from(TemplateSyntaxError(
                 'Syntax Error : Invalid elif statement \'{{% {}\''.format(
                     statement_token)), None)
-        expression = self._compile_expression(m.group('expression'))
         self._block_stack.append(('elif', None))
         self._end_block(dedent=True)
+        self._end_discard()
+        expression, value = self._compile_condition(m.group('expression'), dead=self._fold_stack[-1]['taken'])
         self._block_source.append(
-            ' ' * self._indent + 'elif {}'.format(expression) + ':\n')
+            ' ' * self._indent + 'elif {}'.format(expression) + ':' + self._site_comment() + '\n')
         self._start_block(indent=True)
+        self._fold_branch(value)
 
     def _compile_endif(self, token):
         """ Compile an endif stateement
@@ -262,6 +1787,8 @@ class Renderer(object):
 
         if start_block[0] == 'if' or start_block[0] == 'elif':
             self._end_block(dedent=True)
+            self._end_discard()
+            self._fold_stack.pop()
         else:
             six.raise_from(TemplateSyntaxError(
                 'Syntax Error : Unexpected directive - found \'{{% endif %}}\' outside an \'{{% if %}}\' block'.format(
@@ -290,10 +1817,87 @@ class Renderer(object):
                     'Syntax Error : Unexpected directive - found \'{{% else %}}\' expected \'{{% endif %}}\''.format(
                         token)), None)
 
-            self._end_block(dedent=True)
-            self._block_source.append(' ' * self._indent + 'else' + ':\n')
-            self._block_stack.append((last_block[0], 'else'))
-            self._start_block(indent=True)
+            self._end_block(dedent=True)
+            if last_block[0] != 'for':
+                self._end_discard()
+            self._block_source.append(' ' * self._indent + 'else' + ':\n')
+            self._block_stack.append((last_block[0], 'else'))
+            if last_block[0] == 'for':
+                self._loop_stack[-1]['else'] = True
+            self._start_block(indent=True)
+            if last_block[0] != 'for':
+                self._fold_branch(False if self._fold_stack[-1]['taken'] else None)
+        else:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Unexpected directive - found \'{{% else %}}\' inside {{% {} %}} block'.format(
+                    last_block[0])), None)
+
+    def _compile_macro(self, statement_token):
+        """ Compile a macro statement
+
+            Check the syntax of the macro statement : macro <name>(<parameters>)
+
+            A macro is compiled into a separate function, which is called with the template, the
+            context and the arguments - so the body is compiled into its own source, with its own
+            context variables. The parameters are treated as targets within the body.
+        """
+        m = self._macro_parse_re.match(statement_token)
+        if not m:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Invalid macro statement \'{{% {}\''.format(
+                    statement_token)), None)
+        if self._block_stack:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Unexpected directive - found \'{{% {}\' inside {{% {} %}} block'.format(
+                    statement_token, self._block_stack[-1][0])), None)
+
+        params = [param.strip() for param in m.group('params').split(',') if param.strip()]
+        for param in params:
+            if not self._identifier_re.match(param):
+                six.raise_from(TemplateSyntaxError(
+                    'Syntax Error : Invalid parameter in macro \'{}\''.format(param)), None)
+
+        self._end_block()
+        self._block_stack.append(('macro', None))
+        self._macro = (m.group('name'), params, set(params) - self._targets, self._block_source,
+                       self._locals, self._segment_locals, self._indent)
+        self._targets.update(params)
+        self._block_source, self._locals, self._segment_locals, self._indent = [], set(), set(), 4
+
+    def _compile_endmacro(self, token):
+        """Compile endmacro statement
+
+           Check current in a macro block
+           add the source of the macro function, and restore the enclosing source
+        """
+        if not self._block_stack or self._block_stack[-1][0] != 'macro':
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Unexpected directive - found \'{% endmacro %}\' outside \'{% macro %}\' block'), None)
+
+        self._block_stack.pop()
+        self._end_block()
+        name, params, new_targets, block_source, locals, segment_locals, indent = self._macro
+        self._function_source('macro_' + name, self._locals, self._block_source, params, refund=True)
+        self._macros[name] = frozenset(self._locals)
+        self._macro_locals.update(self._locals)
+        self._targets.difference_update(new_targets)
+        self._block_source, self._locals, self._segment_locals, self._indent = block_source, locals, segment_locals, indent
+        self._macro = None
+
+    def _compile_macro_call(self, variable):
+        """Compile a displayed call of a macro - returns None if the variable isn't a call"""
+        m = self._macro_call_re.match(variable)
+        if not m:
+            return None
+        if m.group('name') not in self._macros:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Unknown macro \'{}\' - a macro must be defined before it is used'.format(
+                    m.group('name'))), None)
+
+        self._segment_locals.update(self._macros[m.group('name')])
+        args = self._compile_expression(m.group('args')) if m.group('args').strip() else ''
+        return 'macro_{name}(template, context{args}{state})'.format(
+            name=m.group('name'), args=', ' + args if args else '', state=self._state_arguments())
 
     def _compile_for(self, for_statement_token):
         """ Compile for statement
@@ -317,15 +1921,63 @@ class Renderer(object):
                 six.raise_from(TemplateSyntaxError(
                     'Syntax Error : Invalid target in for loop \'{}\''.format(
                         target)), None)
+            if self._sandbox is not None and not self._identifier_re.match(target):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : Invalid target in for loop \'{}\''.format(target)), None)
             self._targets.add(target)
 
-        self._block_stack.append(('for', None))
         self._end_block()
+        iterable = self._compile_expression(m.group('iterable'))
+        self._block_stack.append(('for', None))
+        targets = [target.strip() for target in targets]
+        self._loop_count += 1
+        if self._max_iterations is not None:
+            # Never take more than one item past the limit - so a loop over a huge iterable fails straight away
+            iterable = 'islice({iterable}, {limit})'.format(iterable=iterable, limit=self._max_iterations + 1)
+            self._block_source.append(' ' * self._indent + 'loop_{}_count = 0\n'.format(self._loop_count))
+        if any(target in self._schema for target in targets):
+            iterable = 'template._validate_items({iterable}, {targets!r})'.format(
+                iterable=iterable, targets=tuple(targets))
+        comment = self._site_comment()
+        self._loop_stack.append({'name': 'loop_{}'.format(self._loop_count),
+                                 'targets': set(targets),
+                                 'target': m.group('target'),
+                                 'iterable': iterable,
+                                 'comment': comment,
+                                 'header': len(self._block_source),
+                                 'indent': self._indent,
+                                 'columns': [],
+                                 'statement': for_statement_token,
+                                 'else': False})
         self._block_source.append(
-            ' ' * self._indent + 'for {targets} in {iterable}:\n'.format(
+            ' ' * self._indent + 'for {targets} in {iterable}:{comment}\n'.format(
                 targets=m.group('target'),
-                iterable=self._compile_expression(m.group('iterable'))))
+                iterable=iterable,
+                comment=comment))
         self._start_block(indent=True)
+        if self._max_iterations is not None:
+            self._iteration_check(self._loop_stack[-1]['name'], for_statement_token)
+        self._deadline_check(for_statement_token)
+
+    def _deadline_check(self, for_statement_token):
+        """Check the deadline of the render (if it has one) at the start of a loop body"""
+        self._block_source.append(self._deadline_source(' ' * self._indent, for_statement_token))
+
+    @staticmethod
+    def _deadline_source(indent, for_statement_token):
+        """The source which raises RenderTimeout if the render has a deadline which has passed"""
+        return (indent + 'if render_deadline is not None and monotonic() > render_deadline:\n' +
+                indent + '    raise RenderTimeout({message!r})\n'.format(
+                    message='Render deadline exceeded in \'{{% {}\''.format(for_statement_token)))
+
+    def _iteration_check(self, name, for_statement_token):
+        """Count the iterations at the start of a loop body - raising IterationLimitExceeded if there are too many"""
+        indent = ' ' * self._indent
+        self._block_source.append(indent + '{name}_count += 1\n'.format(name=name))
+        self._block_source.append(indent + 'if {name}_count > {limit}:\n'.format(name=name, limit=self._max_iterations))
+        self._block_source.append(indent + '    raise IterationLimitExceeded({message!r})\n'.format(
+            message='Iteration limit exceeded - more than {} iterations of \'{{% {}\''.format(
+                self._max_iterations, for_statement_token)))
 
     def _compile_endfor(self, token):
         """Compile endfor statement
@@ -340,11 +1992,167 @@ class Renderer(object):
 
         if start_block[0] == 'for':
             self._end_block(dedent=True)
+            self._end_loop(self._loop_stack.pop())
         else:
             six.raise_from(TemplateSyntaxError(
                 'Syntax Error : Unexpected directive - found \'{{% endfor %}}\' outside \'{{% for %}}\' block'.format(
                     token)), None)
 
+    def _end_loop(self, loop):
+        """Complete a for loop which has batch filtered columns
+
+           The columns are computed before the loop over a list of the iterable's items, and the loop
+           is changed to enumerate those items so that the columns can be indexed.
+        """
+        if not loop['columns']:
+            return
+
+        # The deadline is checked as the items are read, and after each column is computed
+        indent = ' ' * loop['indent']
+        message = 'Render deadline exceeded in \'{{% {}\''.format(loop['statement'])
+        lines = [indent + '{name}_items = template._deadline_items({iterable}, render_deadline, {message!r})'
+                          '{comment}\n'.format(name=loop['name'], iterable=loop['iterable'], message=message,
+                                                comment=loop['comment'])]
+        for column, wrapper, filter_name, token, value, args in loop['columns']:
+            batch, convert = self._bind_batch_filter(filter_name)
+            self._pending_sites.append((token, self._batch_filters[filter_name][0]))
+            values = '{batch}({convert}[{value} for {targets} in {name}_items]{convert_end}{args})'.format(
+                batch=batch, value=value, convert=convert + '(' if convert else '', convert_end=')' if convert else '',
+                targets=loop['target'], name=loop['name'], args=args)
+            if self._as_bytes:
+                values = '[{encoded} for {column}_value in {values}]'.format(
+                    encoded=self._wrap(wrapper, column + '_value'), column=column, values=values)
+            else:
+                values = 'list(map({wrapper}, {values}))'.format(wrapper=wrapper, values=values)
+            lines.append(
+                indent + '{column} = {values}{comment}\n'.format(
+                    column=column, values=values, comment=self._site_comment()))
+            lines.append(self._deadline_source(indent, loop['statement']))
+        lines.append(indent + 'for {name}_index, ({targets}) in enumerate({name}_items):\n'.format(
+            name=loop['name'], targets=loop['target']))
+        self._block_source[loop['header']] = ''.join(lines)
+
+    def _compile_column(self, token, wrapper):
+        """Compile a displayed value in a loop as an index into a column of batch filtered values
+
+           The value must be derived from the target of an enclosing loop, and use a filter which has a batch
+           implementation. Returns None if the value can't be computed as a column.
+        """
+        variable = token[2:-2].strip()
+        chain = self._filter_sep_re.split(variable)
+        if len(chain) != 2:
+            return None
+
+        dotted_name, filter_name = chain
+        filter_name = filter_name.split()[0] if filter_name.strip() else ''
+        if filter_name not in self._batch_filters:
+            return None
+
+        # A column reads the whole iterable before anything is output - so an output limit couldn't stop it early
+        if self._max_output is not None:
+            return None
+
+        # Only a value which is displayed for every item can be computed up front - not one inside an
+        # {% if %}, {% cache %} or inner loop, or in a loop which can break or continue
+        loop = self._loop_stack[-1]
+        root = dotted_name.strip().split('.')[0]
+        if root not in loop['targets'] or self._block_stack[-1] != ('for', None) or loop['name'] in self._jumping_loops:
+            return None
+
+        # The same value is only computed once for each loop
+        for existing in loop['columns']:
+            if existing[1:4] == (wrapper, filter_name, token):
+                return '{column}[{name}_index]'.format(column=existing[0], name=loop['name'])
+
+        # Compile the filter and the value separately so the filter is applied to the column
+        parts, ((filter_name, pargs, kwargs),) = self._parse_filtered_token(token)
+        if any(arg.__class__ is _ContextReference and arg.parts[0] in self._targets
+               for arg in pargs + tuple(kwargs.values())):
+            return None
+        column = '{}_column_{}'.format(loop['name'], len(loop['columns']))
+        loop['columns'].append((column, wrapper, filter_name, token,
+                                self._compile_value(token, parts), self._call_args(pargs, kwargs)))
+        self._used_filters.add(filter_name)
+        return '{column}[{name}_index]'.format(column=column, name=loop['name'])
+
+    def _compile_cache(self, statement_token):
+        """Compile a cache statement
+
+           Check the syntax of the cache statement : cache '<key>' <names>
+
+           Output a lookup of the fragment in the cache, and start a block which
+           renders the fragment into its own list of segments if it isn't found.
+        """
+        m = self._cache_parse_re.match(statement_token)
+        if not m:
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Invalid cache statement \'{{% {}\''.format(
+                    statement_token)), None)
+
+        key = [repr(m.group('key')[1:-1])] + [
+            self._compile_filtered_token(name) for name in m.group('vary').split()]
+
+        self._cache_count += 1
+        fragment = 'fragment_{}'.format(self._cache_count)
+        self._block_stack.append(('cache', None))
+        self._fragment_stack.append(fragment)
+        self._end_block()
+
+        indent = ' ' * self._indent
+        self._block_source.append(
+            indent + '{fragment}_key = ({key},){comment}\n'.format(
+                fragment=fragment, key=', '.join(key), comment=self._site_comment()))
+        self._block_source.append(
+            indent + '{fragment} = fragment_cache.get({fragment}_key)\n'.format(fragment=fragment))
+        self._block_source.append(
+            indent + 'if {fragment} is None:\n'.format(fragment=fragment))
+        self._start_block(indent=True)
+        self._block_source.append(
+            ' ' * self._indent + '{fragment}_segments = []\n'.format(fragment=fragment))
+        self._block_source.append(
+            ' ' * self._indent + 'segment_extend, segment_append = {}\n'.format(
+                self._bind_segments(fragment + '_segments')))
+
+    def _compile_endcache(self, token):
+        """Compile an endcache statement
+
+           Check currently in a cache block
+           Restore the enclosing segments, store the rendered fragment in the cache, and end the block
+        """
+        try:
+            start_block = self._block_stack.pop()
+        except IndexError:
+            start_block = ('','')
+
+        if start_block[0] != 'cache':
+            six.raise_from(TemplateSyntaxError(
+                'Syntax Error : Unexpected directive - found \'{% endcache %}\' outside \'{% cache %}\' block'),
+                None)
+
+        fragment = self._fragment_stack.pop()
+        self._end_block()
+        indent = ' ' * self._indent
+        self._block_source.append(
+            indent + 'segment_extend, segment_append = {}\n'.format(
+                self._bind_segments(self._fragment_stack[-1] + '_segments' if self._fragment_stack else 'segments')))
+        self._block_source.append(
+            indent + '{fragment} = {empty}.join({fragment}_segments)\n'.format(
+                fragment=fragment, empty="b''" if self._as_bytes else "''"))
+        if self._max_output is not None:
+            # The fragment is counted again when it is added to the enclosing segments
+            self._block_source.append(indent + 'output_budget.remaining += len({})\n'.format(fragment))
+        self._block_source.append(
+            indent + 'fragment_cache.set({fragment}_key, {fragment})\n'.format(fragment=fragment))
+        self._end_block(dedent=True)
+        self._block_source.append(
+            ' ' * self._indent + 'segment_append({fragment})\n'.format(fragment=fragment))
+
+    def _bind_segments(self, segments):
+        """The source of the extend and append functions for a list of segments - counted if the output is limited"""
+        if self._max_output is not None:
+            return 'output_budget.bind({})'.format(segments)
+        return '{segments}.extend, {segments}.append'.format(segments=segments)
+
     def _add_line(self, text, section_lines=None):
         section_lines = self._block_source if section_lines is None else section_lines
 
@@ -353,7 +2161,74 @@ class Renderer(object):
                 ' ' * self._indent + 'segment_extend([')
             self._extend = True
 
-        self._block_source.append(text + ',')
+        comment = self._site_comment()
+        self._block_source.append(text + ',' + (comment + '\n' if comment else ''))
+
+    def _site_comment(self):
+        """Return a comment marking the filters called on the current line of the generated code
+
+           Filters are called directly, so the comment is used to find the template token when
+           a filter raises an exception. Returns an empty string if no filters are called.
+        """
+        if not self._pending_sites:
+            return ''
+        self._sites.append(tuple(self._pending_sites))
+        self._pending_sites = []
+        return '  # filters {}'.format(len(self._sites) - 1)
+
+    def _bind_name(self, prefix, filter_name):
+        """The name a filter is bound to in the namespace of the generated code"""
+        key = (prefix, filter_name)
+        if key not in self._bound_filters:
+            suffix = filter_name if self._identifier_re.match(filter_name) else str(len(self._bound_filters))
+            self._bound_filters[key] = '{}_{}'.format(prefix, suffix)
+        return self._bound_filters[key]
+
+    def _bind_filter(self, filter_name):
+        """Bind a filter into the namespace of the generated code, so it is called directly
+
+           If this template has its own filter caches, a pure filter is bound as a new memoised
+           wrapper of the filter using this template's cache.
+        """
+        bound = self._bind_name('filter', filter_name)
+        if bound not in self._namespace:
+            func = self._filters[filter_name]
+            if self._filter_cache_size and hasattr(func, 'uncached'):
+                self._filter_caches[filter_name] = LRUCache(maxsize=self._filter_cache_size)
+                func = _memoise_filter(func.uncached, self._filter_caches[filter_name])
+            self._namespace[bound] = func
+        return bound
+
+    def _bind_batch_filter(self, filter_name):
+        """Bind the batch implementation of a filter into the namespace of the generated code
+
+           Returns the bound name, and the name of the function which converts the column if needed
+        """
+        bound = self._bind_name('batch', filter_name)
+        func, use_numpy = self._batch_filters[filter_name]
+        self._namespace[bound] = func
+        if use_numpy and _numpy is not None:
+            self._namespace['numpy_asarray'] = _numpy.asarray
+            return bound, 'numpy_asarray'
+        return bound, ''
+
+    def _call_args(self, pargs, kwargs):
+        """The source of the extra arguments in a filter call
+
+           Constant arguments are literals in the generated code, and context variables are looked up
+           when the filter is called.
+        """
+        def argument(arg):
+            if arg.__class__ is _ContextReference:
+                return self._compile_value('.'.join(arg.parts), arg.parts)
+            return repr(arg)
+
+        source = ''.join(', ' + argument(arg) for arg in pargs)
+        names = sorted(kwargs)
+        source += ''.join(', {}={}'.format(name, argument(kwargs[name]))
+                          for name in names if not keyword.iskeyword(name))
+        unpacked = ['{!r}: {}'.format(name, argument(kwargs[name])) for name in names if keyword.iskeyword(name)]
+        return source + (', **{{{}}}'.format(', '.join(unpacked)) if unpacked else '')
 
     def _compile_token_stream(self, token_stream):
         """Compile the main chunk of the template
@@ -361,7 +2236,7 @@ class Renderer(object):
         last_token_directive = False
 
         # Simple jump table - no locations but consistent names is important
-        command_jmp_table = {'for','endfor','if','elif','else','endif'}
+        command_jmp_table = {'for','endfor','if','elif','else','endif','cache','endcache','macro','endmacro'}
 
         # Container for the source of this section
         self._block_source = []
@@ -369,16 +2244,29 @@ class Renderer(object):
         # Mark the start of the block
         self._start_block()
         self._extend = False
-        for token in token_stream:
+        block_segment = False
+        for index, token in enumerate(token_stream):
             if not token:
                 continue
 
+            # A segmented template has a segment for each top level block, and each run of text between them
+            if self._segmented and not self._block_stack:
+                starts_block = (token.__class__ is not _LiteralSpan and token.strip().startswith('{%') and
+                                token.strip()[2:].split()[0] in self._BLOCK_DIRECTIVES)
+                if starts_block or block_segment:
+                    self._new_segment()
+                block_segment = starts_block
+
+            if token.__class__ is _LiteralSpan:
+                last_token_directive = self._compile_text(token, last_token_directive)
+                continue
+
             if token.startswith('{#'):
-                last_token_directive = True
+                last_token_directive = index not in self._trimmed_after
                 continue
 
             if token.strip().startswith('{%'):
-                last_token_directive = True
+                last_token_directive = index not in self._trimmed_after
                 inner_token = token.strip()[2:].strip()
 
                 command = inner_token.split()[0]
@@ -392,6 +2280,11 @@ class Renderer(object):
                         six.raise_from(TemplateSyntaxError(
                             'Syntax Error : Unexpected directive - found \'{token}\' outside \'{{% for %}}\' block'.format(
                                 token=token)), None)
+                    inner_blocks = [block[0] for block in self._block_stack]
+                    if 'cache' in inner_blocks[len(inner_blocks) - inner_blocks[::-1].index('for'):]:
+                        six.raise_from(TemplateSyntaxError(
+                            'Syntax Error : Unexpected directive - found \'{token}\' inside \'{{% cache %}}\' block'.format(
+                                token=token.strip())), None)
                     self._end_block()
                     self._block_source.append(' ' * self._indent + inner_token[:-2].strip() + '\n')
                     continue
@@ -402,27 +2295,134 @@ class Renderer(object):
 
             if token.startswith('{{'):
                 inner_token = token.strip()[2:-2].strip()
-                value = 'str({})'.format(self._compile_filtered_token(token))
+                value = self._compile_displayed_token(token)
                 self._add_line(value)
 
             else:
-                # All '\n in must be preserved apart from the first one (after a directive)
-                # All left indentation (after a \n) must be removed
-                lines = token.splitlines(True)
-                for line in lines:
-                    if line == '\n' and last_token_directive:
-                        last_token_directive = False
-                        continue
+                last_token_directive = self._compile_text(token, last_token_directive)
+
+        self._end_block()
 
-                    token = line if not self._ignore_indentation else line.lstrip(' \t')
+    def _compile_text(self, token, after_directive):
+        """Compile literal text - returns whether a newline after the last directive is still to be removed
 
-                    self._add_line(repr(token))
+           A large literal span from a memory mapped template is kept as offsets into the
+           file if the whitespace handling leaves it unchanged, and it isn't in a {% cache %} or {% macro %} block.
+        """
+        if token.__class__ is _LiteralSpan:
+            span = token.skip_newline() if after_directive else token
+            if ((span is not token or not after_directive) and
+                    len(span) >= self._LARGE_LITERAL and not self._fragment_stack and not self._segmented and
+                    self._macro is None and
+                    not (self._ignore_indentation and span.indented())):
+                self._span_count += 1
+                name = 'span_{}'.format(self._span_count)
+                self._namespace[name] = span.view() if self._as_bytes else span
+                self._add_line(name)
+                return False
+            token, after_directive = span.text(), after_directive and span is token
+
+        # All '\n in must be preserved apart from the first one (after a directive)
+        # All left indentation (after a \n) must be removed
+        # The remaining text is added as a single literal
+        lines = token.splitlines(True)
+        text = []
+        for line in lines:
+            if line == '\n' and after_directive:
+                after_directive = False
+                continue
 
-        if self._extend:
-            self._block_source.append('])\n')
+            text.append(line if not self._ignore_indentation else line.lstrip(' \t'))
+
+        literal = ''.join(text)
+        if literal:
+            self._add_line(repr(literal.encode(self._encoding) if self._as_bytes else literal))
+        return after_directive
+
+    def _tokenise(self, template):
+        """Split the template into a stream of tokens - alternating between text and tokens
+
+           A memory mapped template is split directly from the file - large spans of text
+           are kept as offsets into the file.
+        """
+        if isinstance(template, six.string_types):
+            return self._token_splitter_re.split(template)
+
+        tokens, last_end = [], 0
+        for match in self._buffer_token_re.finditer(template):
+            tokens.append(self._buffer_text(template, last_end, match.start()))
+            tokens.append(match.group().decode(self._encoding))
+            last_end = match.end()
+        tokens.append(self._buffer_text(template, last_end, len(template)))
+        return tokens
+
+    def _buffer_text(self, buffer, start, end):
+        """The text between two tokens in a memory mapped template"""
+        if end - start >= self._LARGE_LITERAL and not self._collapse_whitespace:
+            return _LiteralSpan(buffer, start, end, self._encoding)
+        return buffer[start:end].decode(self._encoding)
+
+    def _whitespace_control(self, tokens):
+        """Apply all whitespace control to the stream of tokens
+
+           The token stream alternates between text and tokens, so the text either side
+           of a token is always at the neighbouring index.
+
+           Strip the '-' markers from the tokens, and remove the whitespace from the
+           neighbouring text; optionally collapse the whitespace within the text. The tokens
+           trimmed after are recorded - the newline after them has already been removed.
+        """
+        self._trimmed_after = set()
+        for index in range(1, len(tokens), 2):
+            token = tokens[index]
+            stripped = token.lstrip(' \t')
+            inner = stripped[2:-2]
+            trim_before, trim_after = inner.startswith('-'), inner.endswith('-')
+            if not (trim_before or trim_after):
+                continue
+
+            inner = inner[1:] if trim_before else inner
+            inner = inner[:-1] if trim_after else inner
+            tokens[index] = stripped[:2] + inner + stripped[-2:]
+            if trim_before:
+                tokens[index - 1] = tokens[index - 1].rstrip()
+            else:
+                tokens[index] = token[:len(token) - len(stripped)] + tokens[index]
+            if trim_after:
+                tokens[index + 1] = tokens[index + 1].lstrip()
+                self._trimmed_after.add(index)
+
+        if self._collapse_whitespace:
+            preserve = 0
+            for index in range(0, len(tokens), 2):
+                tokens[index], preserve = self._collapse(tokens[index], preserve)
+
+        return tokens
+
+    def _collapse(self, text, preserve):
+        """Collapse runs of whitespace in the text, outside any whitespace preserving elements
 
-    def _compile(self):
-        """Compile a template into an executable function
+           preserve is the depth of preserving elements at the start of the text - the
+           depth at the end of the text is returned along with the collapsed text
+        """
+        parts = []
+        last_end = 0
+        for match in self._preserve_ws_re.finditer(text):
+            chunk = text[last_end:match.end()]
+            parts.append(chunk if preserve else self._whitespace_re.sub(self._collapse_run, chunk))
+            preserve = max(0, preserve - 1) if match.group('close') else preserve + 1
+            last_end = match.end()
+        chunk = text[last_end:]
+        parts.append(chunk if preserve else self._whitespace_re.sub(self._collapse_run, chunk))
+        return ''.join(parts), preserve
+
+    @staticmethod
+    def _collapse_run(match):
+        """Replace a run of whitespace with a single newline or space"""
+        return '\n' if '\n' in match.group() else ' '
+
+    def compile(self, template_str, errors=False, default=None, fragment_cache=None):
+        """Compile a template into an immutable CompiledTemplate
 
             Build a prolog of the function declaration, local variables
 
@@ -436,17 +2436,21 @@ class Renderer(object):
         self._targets = set()
         self._locals = set()
         self._block_stack = deque()
+        self._cache_count = 0
+        self._fragment_stack = []
+        self._loop_stack = []
+        self._loop_count = 0
 
-        # Function boilerplate - define the function and setup standard modules
-        self._source_parts.append('def render(renderer, context):\n')
-        self._source_parts.append(' ' * indent + 'segments=[]\n')
-        self._source_parts.append(
-            ' ' * indent + 'segment_extend = segments.extend\n')
-        self._source_parts.append(
-            ' ' * indent + 'segment_append = segments.append\n')
+        self._segments = []
+        self._segment_locals = set()
+        self._constant_scope = _ConstantScope(self._targets, errors, default, self._sandbox)
+        self._errors, self._default = errors, default
 
         # Break the temp in a steam of tokens
-        tokens = (x for x in self._token_splitter_re.split(self._template_str))
+        tokens = self._whitespace_control(self._tokenise(template_str))
+        if not self._segmented:
+            self._repeated = self._repeated_names(tokens)
+        self._jumping_loops = self._find_jumping_loops(tokens)
 
         self._compile_token_stream(tokens)
 
@@ -456,161 +2460,325 @@ class Renderer(object):
                 'Syntax Error : Missing directive \'{{% end{} %}}\''.format(
                     last_token[0])), None)
 
-        for local_var in self._locals:
-            self._source_parts.append(
-                ' ' * indent + '{var_name} = context.get({var_name!r},None)\n'.format(var_name=local_var))
-
-        self._source_parts.extend(self._block_source)
-
-        self._source_parts.append(
-            ' ' * indent + 'return \'\'.join(segments)\n')
+        if self._cache_count and fragment_cache is None:
+            fragment_cache = LRUCache()
+
+        join = "b''.join" if self._as_bytes else "''.join"
+        if self._segmented:
+            # Each segment is a separate function - render joins the output of all of the segments
+            self._new_segment()
+            names = []
+            for index, (body, segment_locals) in enumerate(self._segments):
+                names.append('segment_{}'.format(index))
+                self._function_source(names[-1], segment_locals, body)
+            self._source_parts.append('def render(template, context, join={}{}):\n'.format(
+                join, self._state_parameters()))
+            self._source_parts.append(' ' * indent + 'return join([{}])\n'.format(
+                ''.join('{}(template, context{}), '.format(name, self._state_arguments()) for name in names)))
+        else:
+            self._function_source('render', self._locals, self._block_source)
 
-        self._source = ''.join(self._source_parts)
-        globals_source = {}
+        source = ''.join(self._source_parts)
         try:
-            six.exec_(self._source, globals_source)
-            return globals_source['render']
+            code = compile(source, '<template>', 'exec')
+            six.exec_(_intern_constants(code) if self._compact else code, self._namespace)
         except Exception as e:
             six.raise_from(e, None)
 
-    def _compile_filtered_token(self, token):
-        """Compile a context variable access with a filter
+        filter_sites = {}
+        for lineno, line in enumerate(source.splitlines(), 1):
+            m = self._site_comment_re.search(line)
+            if m:
+                sites = self._sites[int(m.group('site'))]
+                if self._compact:
+                    sites = tuple((six.moves.intern(str(token)), func) for token, func in sites)
+                filter_sites[lineno] = sites
+
+        segments = tuple((self._namespace[name], frozenset(segment_locals))
+                         for name, (body, segment_locals) in zip(names, self._segments)) if self._segmented else None
+
+        return CompiledTemplate(render=self._namespace['render'],
+                                source=None if self._compact else source,
+                                namespace=self._namespace,
+                                targets=self._targets,
+                                locals=self._locals | self._macro_locals,
+                                errors=errors,
+                                default=default,
+                                filters=self._filters,
+                                used_filters=self._used_filters,
+                                filter_caches=self._filter_caches,
+                                filter_sites=filter_sites,
+                                fragment_cache=fragment_cache,
+                                spans=bool(self._span_count),
+                                encoding=self._encoding,
+                                as_bytes=self._as_bytes,
+                                segments=segments,
+                                constants=dict((name, value) for name, value in (self._constants or {}).items()
+                                               if name in self._locals or name in self._macro_locals),
+                                schema=self._schema,
+                                sandbox=self._sandbox,
+                                max_output=self._max_output)
+
+    def _function_source(self, name, locals, body, params=(), refund=False):
+        """Add the source of a render function - with the function boilerplate and the context variables it uses"""
+        indent = ' ' * 4
+        self._source_parts.append('def {}(template, context, {}join={}.join{}):\n'.format(
+            name, ''.join(param + ', ' for param in params), "b''" if self._as_bytes else "''",
+            self._state_parameters()))
+        self._source_parts.append(indent + 'segments=[]\n')
+        if self._max_output is not None:
+            self._source_parts.append(indent + 'segment_extend, segment_append = output_budget.bind(segments)\n')
+        else:
+            self._source_parts.append(indent + 'segment_extend = segments.extend\n')
+            self._source_parts.append(indent + 'segment_append = segments.append\n')
+        if self._autoescape:
+            self._source_parts.append(indent + 'escape = escape_html\n')
+        if self._cache_count:
+            self._source_parts.append(indent + 'fragment_cache = template._fragment_cache\n')
+
+        for local_var in locals:
+            self._source_parts.append(
+                indent + '{var_name} = context.get({var_name!r},None)\n'.format(var_name=local_var))
+
+        self._source_parts.extend(body)
+        if self._max_output is not None and refund:
+            # The caller counts the output again when it adds it to its own segments
+            self._source_parts.append(indent + 'output = join(segments)\n')
+            self._source_parts.append(indent + 'output_budget.remaining += len(output)\n')
+            self._source_parts.append(indent + 'return output\n')
+        else:
+            self._source_parts.append(indent + 'return join(segments)\n')
+
+    def _state_parameters(self):
+        """The parameters of a generated function for the state of the render"""
+        return ', render_deadline=None' + (', output_budget=None' if self._max_output is not None else '')
+
+    def _state_arguments(self):
+        """The arguments which pass the state of the render on to another generated function"""
+        return ', render_deadline=render_deadline' + (
+            ', output_budget=output_budget' if self._max_output is not None else '')
 
-           Handles filter with and without args
+    def _new_segment(self):
+        """Start a new top level segment of a segmented template"""
+        self._end_block()
+        if self._block_source:
+            self._segments.append((self._block_source, self._segment_locals))
+        self._block_source, self._segment_locals = [], set()
+
+    def _compile_displayed_token(self, token):
+        """Compile a displayed context variable - i.e. the contents of a {{ }} token
+
+           The value is converted to a string, and escaped if autoescape is on and
+           the value isn't already known to be safe.
         """
-        variable = token.strip() if not token.startswith('{{') else token[2:-2].strip()
-        if self._FILTER_SEP in variable:
+        variable = token[2:-2].strip()
+        call = self._compile_macro_call(variable)
+        if call is not None:
+            return call
+
+        chain = self._filter_sep_re.split(variable)
+        last_filter = chain[-1].split() if len(chain) > 1 else []
+        if self._autoescape and not (last_filter and last_filter[0] in self._SAFE_FILTERS):
+            wrapper = 'escape'
+        else:
+            wrapper = 'str'
 
-            # Split toekn in contexxt variable and filter details
-            dotted_name, filter_name = variable.split(self._FILTER_SEP)
-            dotted_name, filter_name = dotted_name.rstrip(), filter_name.lstrip()
+        if self._is_constant(variable):
+            snapshot = self._snapshot()
+            succeeded, value = self._evaluate(self._wrap(wrapper, self._compile_filtered_token(token)))
+            self._restore(snapshot)
+            if succeeded:
+                # Only the plain value is written into the source - a subclass such as Markup isn't in the namespace
+                return repr(bytes(value) if isinstance(value, bytes) else six.text_type(value))
 
-            # Split off any arguments - working from the first space
-            if ' ' in filter_name:
-                first_space = filter_name.find(' ')
-                filter_name, args = filter_name[:first_space], filter_name[first_space + 1:]
-            else:
-                filter_name, args = filter_name, None
+        column = self._compile_column(token, wrapper) if self._loop_stack else None
+        if column is not None:
+            return column
+
+        return self._wrap(wrapper, self._compile_filtered_token(token))
+
+    def _wrap(self, wrapper, expression):
+        """The source which converts a displayed value to text - or to encoded bytes if the template produces bytes"""
+        if self._as_bytes:
+            return '{}({}).encode({!r})'.format(wrapper, expression, self._encoding)
+        return '{}({})'.format(wrapper, expression)
+
+    def _parse_filtered_token(self, token):
+        """Split a context variable access into the dotted name parts and the chain of filters
+
+           Each filter in the chain is a tuple of the filter name, and the positional and keyword arguments -
+           the chain is empty if there are no filters
+        """
+        variable = token.strip() if not token.startswith('{{') else token[2:-2].strip()
+        chain = self._filter_sep_re.split(variable)
+        dotted_name, filters = chain[0].strip(), []
 
-            pargs, kwargs = self._split_args(args) if args else ((), {})
+        for filter_text in chain[1:]:
+            # Split off any arguments - working from the first space
+            filter_name, _, args = filter_text.strip().partition(' ')
+            pargs, kwargs = self._split_args(args) if args.strip() else ((), {})
 
-            if filter_name not in self.__class__._filters:
+            if filter_name not in self._filters:
                 six.raise_from(
                 UnrecognisedFilter('Unknown filter \'{}\''.format(filter_name)),
                 None)
-        else:
-            filter_name = None
-            dotted_name = variable
-            pargs, kwargs = (), {}
+            filters.append((filter_name, pargs, kwargs))
 
         parts = [dotted_name] if '.' not in dotted_name else dotted_name.split('.')
+        return parts, filters
+
+    def _compile_value(self, token, parts):
+        """Compile the access to the data item for the dotted name parts
 
-        var = 'renderer._dodots(token={token!r}, value={value}, parts={parts!r} , context=context)'.format(
-                    value=parts[0],
-                    parts=parts[:],
-                    token = token)
+           A sandboxed template can't use private names, and its dotted names are resolved by
+           _sandboxed_dots, which applies the sandbox policy.
+        """
+        if self._sandbox is not None:
+            if not all(self._identifier_re.match(part) for part in parts):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : Invalid name \'{}\''.format('.'.join(parts))), None)
+            if any(part.startswith('_') for part in parts):
+                six.raise_from(SandboxError(
+                    'Sandbox Error : Private names are not allowed in \'{}\''.format('.'.join(parts))), None)
 
         if parts[0] not in self._targets:
             self._locals.add(parts[0])
+            self._segment_locals.add(parts[0])
+
+        value = self._typed_access(parts)
+        if value is None:
+            value = 'template.{dots}(token={token!r}, value={value}, parts={parts!r} , context=context{bound})'.format(
+                        dots='_dodots' if self._sandbox is None else '_sandboxed_dots',
+                        value=parts[0],
+                        parts=parts[:],
+                        token = token,
+                        bound=', bound=True' if self._macro is not None and parts[0] in self._macro[1] else '')
+        return self._lookup(token, parts, value)
+
+    def _find_jumping_loops(self, tokens):
+        """Find the loops which contain a {% break %} or {% continue %} - named as _compile_for names them"""
+        loops, count, jumping = [], 0, set()
+        for token in tokens:
+            if token.__class__ is _LiteralSpan or not token.strip().startswith('{%'):
+                continue
+            command = token.strip()[2:-2].strip()
+            if command.split()[:1] == ['for']:
+                count += 1
+                loops.append('loop_{}'.format(count))
+            elif command == 'endfor' and loops:
+                loops.pop()
+            elif command in ('break', 'continue') and loops:
+                jumping.add(loops[-1])
+        return jumping
+
+    def _repeated_names(self, tokens):
+        """Find the dotted names displayed more than once in the template - ignoring names derived from loop targets"""
+        counts, targets = {}, set()
+        for token in tokens:
+            if token.__class__ is _LiteralSpan or not token.strip().startswith(('{{', '{%')):
+                continue
+            inner_token = token.strip()[2:].strip()
+            m = self._for_parse_re.match(inner_token)
+            if m:
+                targets.update(target.strip() for target in m.group('target').split(','))
+            if not token.strip().startswith('{{'):
+                continue
+            for match in self._variable_re.finditer(inner_token):
+                name = match.group('Variable').split(self._FILTER_SEP)[0]
+                if '.' in name:
+                    counts[name] = counts.get(name, 0) + 1
+        return set(name for name, count in counts.items() if count > 1 and name.split('.')[0] not in targets)
+
+    def _lookup(self, token, parts, value):
+        """Keep a dotted name which is used more than once in a local - set where it is first used outside a block
+
+           The error value of a lookup depends on the token, so the local is only shared by the same kind of token.
+           Names within directive expressions are never kept - 'user and user.name' relies on user.name only
+           being looked up when user is set.
+        """
+        name = '.'.join(parts)
+        if name not in self._repeated or self._macro is not None or not token.startswith('{{'):
+            return value
 
-        if filter_name is not None:
-            return 'renderer.__class__.execute_filter( filter_name={filter_name!r},token={token!r},value={var},args={pargs!r}, kwargs={kwargs!r})'.format(
-                cls_name=self.__class__.__name__,
-                filter_name=filter_name,
-                token=token,
-                var=var,
-                pargs=pargs,
-                kwargs=kwargs)
-        else:
-            return var
-
-        # Todo Extend for publicly defined filters ?
-
-    def _dodots(self, token='', value=None, parts=None, context={}):
-        """Process a expression - i.e. access to a data item within the context
-
-           A wrapper around self._resolvedots so that errors are dealt with as
-           requested by the caller
+        as_string = not self._errors and not self._default
+        key = (name, token if as_string else True)
+        if key in self._lookups:
+            return self._lookups[key]
 
-           Executed at run time only
+        if (self._block_stack or self._is_constant(name) or
+                any(name == volatile or name.startswith(volatile + '.') for volatile in self._volatile)):
+            return value
 
-           :param token: The full token for error reporting only - remove ??
-           :param value: The actual value of the first/only part of the name
-           :param parts: The separated parts of the dotted name - including the name of the value
-           :param as_string: Whether this should return a string of a value - remove ??
-           :param context:  The operational context for this template
-        """
-        as_string = token.startswith('{{')
+        self._lookups[key] = 'lookup_{}'.format(len(self._lookups))
+        self._end_block()
+        self._block_source.append(' ' * self._indent + '{} = {}\n'.format(self._lookups[key], value))
+        return self._lookups[key]
 
-        # If the first name isn't in the context and isn't in the targets wrap produce a 'default' value
-        if parts[0] not in context and parts[0] not in self._targets:
-            if self._errors:
-                six.raise_from(UnknownContextValue('Unknown context variable \'{}\''.format(token)),None)
-            else:
-                return '' if not as_string else (self._default if self._default else token)
+    def _typed_access(self, parts):
+        """Compile the direct access to a dotted name whose every part is declared by the schema - None if it isn't"""
+        if parts[0] not in self._schema:
+            return None
 
-        # Try to resolve any further dotte dess
-        current_value = value
+        children, source = self._schema[parts[0]], [parts[0]]
+        for part in parts[1:]:
+            access, children = children.get(part, (None, None))
+            if access is None:
+                return None
+            source.append(self._SCHEMA_ACCESS[access].format(part))
+        return ''.join(source)
 
-        parts = parts[1:] if len(parts) > 1 else []
+    def _compile_filtered_token(self, token):
+        """Compile a context variable access with a chain of filters
 
-        for sub_item in parts:
-            if isinstance(current_value, Mapping):
-                try:
-                    current_value = current_value[sub_item]
-                    continue
-                except KeyError:
-                    if self._errors:
-                        six.raise_from(UnknownContextValue('Unknown context variable \'{}\''.format(token)),None)
-                    else:
-                        return '' if not as_string else (self._default if self._default else token)
+           Handles filter with and without args - a chain of filters is compiled into nested calls,
+           with the first filter innermost.
+        """
+        parts, filters = self._parse_filtered_token(token)
 
-            if hasattr(current_value, sub_item):
-                if callable(getattr(current_value, sub_item)):
-                    current_value = getattr(current_value, sub_item)()
-                    continue
-                else:
-                    current_value = getattr(current_value, sub_item)
-                    continue
-            else:
-                if self._errors:
-                    six.raise_from(UnknownContextValue('Unknown context variable \'{}\''.format(token)), None)
-                else:
-                    return '' if not as_string else (self._default if self._default else token)
+        # A missing value is looked up as in an expression - so it reaches the default filter as '' rather than
+        # as the text of the token
+        if token.startswith('{{') and any(filter_name == 'default' for filter_name, _, _ in filters):
+            var = self._compile_value('.'.join(parts), parts)
         else:
-            return current_value
+            var = self._compile_value(token, parts)
+
+        for filter_name, pargs, kwargs in filters:
+            self._used_filters.add(filter_name)
+            if (filter_name in self._INLINE_FILTERS and not pargs and not kwargs and
+                    self._filters[filter_name] is _builtin_filters.get(filter_name)):
+                var = self._INLINE_FILTERS[filter_name].format(var)
+                continue
+            bound = self._bind_filter(filter_name)
+            self._pending_sites.append((token, self._namespace[bound]))
+            var = '{bound}({var}{args})'.format(bound=bound, var=var, args=self._call_args(pargs, kwargs))
+        return var
 
     @classmethod
     def _split_args(self, args):
         """Helper method - Convert filter arguments into positional and keyword arguments
 
-            Split filter arguments into positional and keyword arguments
+            Split filter arguments into positional and keyword arguments, and convert each argument
+            into its python value : quoted strings, ints and floats, True/False/None, dotted context
+            variables (a _ContextReference) - any other word is a literal string.
         """
-        matches = [m for m in Renderer._split_args_re.finditer(args)]
-        p_args = tuple(
-            [m.group('value').strip("\'") for m in matches if m.group('keyword') is None])
-        kw_args = dict(
-            [(m.group('keyword'), str(m.group('value').strip("\'"))) for m in matches if
-             m.group('keyword') is not None])
-        return p_args, kw_args
-
-    def from_context(self, *contexts):
-        """Public I/f Render the template based on one or more dictionaries"""
-
-        this_context = {}
-        for context in contexts:
-            this_context.update(context)
-
-        for var_name in self._locals:
-            if var_name in this_context:
-                continue
+        p_args, kw_args = [], {}
+        for m in _Compiler._split_args_re.finditer(args.strip()):
+            if m.group('string') is not None:
+                value = m.group('string')[1:-1]
+            elif m.group('number') is not None:
+                number = m.group('number')
+                value = float(number) if any(c in number for c in '.eE') else int(number)
+            elif m.group('reference') is not None:
+                value = _ContextReference(m.group('reference'))
+            else:
+                value = _Compiler._ARG_WORDS.get(m.group('word'), m.group('word'))
 
-            if self._errors:
-                raise UnknownContextValue('Unknown context variable \'{}\''.format(var_name))
+            if m.group('keyword') is None:
+                p_args.append(value)
+            else:
+                kw_args[m.group('keyword')] = value
+        return tuple(p_args), kw_args
 
-        if not self._render:
-            return None
-        return self._render(self, this_context)
 
 @registerModifier('len')
 def variable_length(var, *args, **kwargs):
@@ -619,12 +2787,19 @@ def variable_length(var, *args, **kwargs):
         raise UnexpectedFilterArguments
     return len(var)
 
+@registerBatchModifier('len')
+def column_length(values, *args, **kwargs):
+    """Returns the length of every value in the column"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return list(map(len, values))
+
 @registerModifier('split')
 def variable_split(var, *args, **kwargs):
     """Returns a compiled call to capitalize"""
-    if len(args) > 1 or kwargs:
+    if len(args) > 2 or kwargs or (len(args) == 2 and not isinstance(args[1], int)):
         raise UnexpectedFilterArguments
-    split_arg = (args[0],) if args else tuple()
+    split_arg = (str(args[0]),) + args[1:] if args else tuple()
     return str(var).split(*split_arg)
 
 
@@ -633,8 +2808,216 @@ def variable_cut(var, *args, **kwargs):
     """Returns a compiled call to the cut filter"""
     if 0 > len(args) > 1 or kwargs:
         raise UnexpectedFilterArguments
-    return str(var).replace(args[0], '')
+    return str(var).replace(str(args[0]), '')
+
+
+@registerModifier('escape')
+def variable_escape(var, *args, **kwargs):
+    """Html escape the value - the result is marked as safe"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return SafeText(escape_html(var))
+
+
+@registerBatchModifier('escape')
+def column_escape(values, *args, **kwargs):
+    """Html escape every value in the column"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return [SafeText(escape_html(value)) for value in values]
+
+
+@registerModifier('safe')
+def variable_safe(var, *args, **kwargs):
+    """Mark the value as safe - it wont be escaped by autoescape"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return SafeText(var)
+
+
+
+def _filter_arguments(args, kwargs, names, defaults):
+    """Match the filter arguments to the named parameters - raises UnexpectedFilterArguments if they don't match
+
+       Parameters with a default of _MISSING must be given.
+    """
+    if not args and not kwargs:
+        values = defaults
+    else:
+        if len(args) > len(names) or not set(kwargs).issubset(names[len(args):]):
+            raise UnexpectedFilterArguments
+        values = list(args) + [kwargs.get(name, default)
+                               for name, default in zip(names[len(args):], defaults[len(args):])]
+    if any(value is _MISSING for value in values):
+        raise UnexpectedFilterArguments
+    return values
+
+
+@registerModifier('upper')
+def variable_upper(var, *args, **kwargs):
+    """Convert the value to upper case"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return str(var).upper()
+
+
+@registerBatchModifier('upper')
+def column_upper(values, *args, **kwargs):
+    """Convert every value in the column to upper case"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return [str(value).upper() for value in values]
+
+
+@registerModifier('lower')
+def variable_lower(var, *args, **kwargs):
+    """Convert the value to lower case"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return str(var).lower()
+
+
+@registerBatchModifier('lower')
+def column_lower(values, *args, **kwargs):
+    """Convert every value in the column to lower case"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return [str(value).lower() for value in values]
+
+
+@registerModifier('title')
+def variable_title(var, *args, **kwargs):
+    """Convert the value to title case"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    return str(var).title()
+
+
+@registerModifier('truncate')
+def variable_truncate(var, *args, **kwargs):
+    """Truncate the value to at most length characters - ending with end if it is truncated"""
+    length, end = _filter_arguments(args, kwargs, ('length', 'end'), (_MISSING, '...'))
+    if not isinstance(length, six.integer_types) or isinstance(length, bool):
+        raise UnexpectedFilterArguments
+    end = str(end)
+    text = str(var)
+    if len(text) <= length:
+        return text
+    return text[:max(length - len(end), 0)] + end
+
+
+@registerModifier('join')
+def variable_join(var, *args, **kwargs):
+    """Join the items of the value into a string - separated by sep"""
+    sep, = _filter_arguments(args, kwargs, ('sep',), ('',))
+    return str(sep).join(map(str, var))
+
+
+@registerModifier('default')
+def variable_default(var, *args, **kwargs):
+    """Replace a value which is None or an empty string"""
+    value, = _filter_arguments(args, kwargs, ('value',), ('',))
+    return value if var is None or var == '' else var
+
+
+@registerModifier('date', pure=True, cache_size=1024)
+def variable_date(var, *args, **kwargs):
+    """Format a date, time or datetime - by default as '01 Jan 2020'"""
+    format_, = _filter_arguments(args, kwargs, ('format',), ('%d %b %Y',))
+    return var.strftime(format_)
+
+
+@registerModifier('strftime', pure=True, cache_size=1024)
+def variable_strftime(var, *args, **kwargs):
+    """Format a date, time or datetime with the given format"""
+    format_, = _filter_arguments(args, kwargs, ('format',), (_MISSING,))
+    return var.strftime(format_)
+
+
+# The formatters for numbers - created once for each number of decimal places
+_number_formats = {None: '{:,}'.format}
+
+
+def _number_format(places):
+    """Return the formatter which groups the thousands of a number, with the given number of decimal places"""
+    try:
+        return _number_formats[places]
+    except KeyError:
+        if not isinstance(places, int):
+            raise UnexpectedFilterArguments
+        _number_formats[places] = '{{:,.{}f}}'.format(places).format
+        return _number_formats[places]
+
+
+@registerModifier('number')
+def variable_number(var, *args, **kwargs):
+    """Format a number with grouped thousands, and optionally a fixed number of decimal places"""
+    places, = _filter_arguments(args, kwargs, ('places',), (None,))
+    return _number_format(places)(var)
+
+
+@registerBatchModifier('number')
+def column_number(values, *args, **kwargs):
+    """Format every number in the column"""
+    places, = _filter_arguments(args, kwargs, ('places',), (None,))
+    return list(map(_number_format(places), values))
+
+
+def _currency_formatter(args, kwargs):
+    """Return the function which formats an amount with the currency symbol and decimal places from the arguments"""
+    symbol, places = _filter_arguments(args, kwargs, ('symbol', 'places'), ('$', 2))
+    number = _number_format(places)
+
+    def currency(amount):
+        return '-' + symbol + number(-amount) if amount < 0 else symbol + number(amount)
+    return currency
+
+
+@registerModifier('currency')
+def variable_currency(var, *args, **kwargs):
+    """Format an amount of money - by default as '$1,234.50'"""
+    return _currency_formatter(args, kwargs)(var)
+
+
+@registerBatchModifier('currency')
+def column_currency(values, *args, **kwargs):
+    """Format every amount in the column"""
+    return list(map(_currency_formatter(args, kwargs), values))
+
+
+@registerModifier('center')
+def variable_center(var, *args, **kwargs):
+    """Center the value in a string of the given width"""
+    width, fill = _filter_arguments(args, kwargs, ('width', 'fill'), (_MISSING, ' '))
+    if not isinstance(width, six.integer_types) or isinstance(width, bool) or len(str(fill)) != 1:
+        raise UnexpectedFilterArguments
+    return str(var).center(width, str(fill))
+
+
+@registerModifier('urlencode')
+def variable_urlencode(var, *args, **kwargs):
+    """Quote a value for use in a url - a mapping (or sequence of pairs) is encoded as a query string"""
+    if args or kwargs:
+        raise UnexpectedFilterArguments
+    if isinstance(var, (Mapping, list, tuple)):
+        return six.moves.urllib.parse.urlencode(var)
+    return six.moves.urllib.parse.quote_plus(str(var))
+
+
+# Characters which are escaped in json output so that it is safe within html and <script> elements
+_json_escapes = (('<', '\\u003c'), ('>', '\\u003e'), ('&', '\\u0026'), ("'", '\\u0027'))
+
+
+@registerModifier('json')
+def variable_json(var, *args, **kwargs):
+    """Convert the value to json which is safe within html - the result is marked as safe"""
+    if args or not set(kwargs).issubset({'indent', 'sort_keys'}):
+        raise UnexpectedFilterArguments
+    text = json.dumps(var, **kwargs)
+    for char, escaped in _json_escapes:
+        text = text.replace(char, escaped)
+    return SafeText(text)
 
-# To Do Test cut, implement center, date and other filters
 
-# Todo Rework Filter system to allow registration of filters
+# The filters above - a built in filter can be compiled inline unless it has been replaced
+_builtin_filters = dict(Renderer._filters)
@@ -11,7 +11,16 @@ Use Case :
 Testable Statements :
     ...
 """
+import gc
+import io
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 import re
 import click
@@ -537,6 +546,1631 @@ inside loop
                                          remove_indentation=True)
         self.assertEqual( renderer.from_context({'l':[0,1,2,3,4,5,6]}).strip(), '0123456')
 
+class AutoEscape(unittest.TestCase):
+    def test_050_000_invalid_mode(self):
+        """Unknown autoescape mode is rejected"""
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_str='{{ name }}', autoescape='xml')
+
+    def test_050_001_values_escaped(self):
+        """Displayed values are html escaped"""
+        renderer = templatelite.Renderer(template_str='<b>{{ name }}</b>', autoescape='html')
+        self.assertEqual(renderer.from_context({'name': '<Tom & "Jerry">'}),
+                         '<b>&lt;Tom &amp; &#34;Jerry&#34;&gt;</b>')
+
+    def test_050_002_no_escape_by_default(self):
+        """Without autoescape values are rendered unchanged"""
+        renderer = templatelite.Renderer(template_str='<b>{{ name }}</b>')
+        self.assertEqual(renderer.from_context({'name': '<i>'}), '<b><i></b>')
+
+    def test_050_003_safe_filter(self):
+        """Values passed through the safe filter are not escaped"""
+        renderer = templatelite.Renderer(template_str='{{ name|safe }}', autoescape='html')
+        self.assertEqual(renderer.from_context({'name': '<i>'}), '<i>')
+
+    def test_050_004_safe_value(self):
+        """Values which are already safe are not escaped"""
+        renderer = templatelite.Renderer(template_str='{{ name }}', autoescape='html')
+        self.assertEqual(renderer.from_context({'name': templatelite.SafeText('<i>')}), '<i>')
+
+    def test_050_005_escape_filter_not_doubled(self):
+        """The escape filter and autoescape don't escape twice"""
+        renderer = templatelite.Renderer(template_str='{{ name|escape }}', autoescape='html')
+        self.assertEqual(renderer.from_context({'name': '&'}), '&amp;')
+
+    def test_050_006_non_string_values(self):
+        """Non string values are converted and escaped"""
+        renderer = templatelite.Renderer(template_str='{% for n in l %}{{ n }}{% endfor %}', autoescape='html')
+        self.assertEqual(renderer.from_context({'l': [1, 2]}), '12')
+
+
+class WhitespaceControl(unittest.TestCase):
+    def test_060_000_trim_directives(self):
+        """Whitespace trimmed before directives"""
+        template = "<ul>\n  {%- for n in l %}\n  <li>{{ n }}</li>\n  {%- endfor %}\n</ul>"
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': [1, 2]}), '<ul><li>1</li><li>2</li></ul>')
+
+    def test_060_001_trim_variables(self):
+        """Whitespace trimmed either side of a displayed variable"""
+        renderer = templatelite.Renderer(template_str='a  \n {{- x -}} \n  b')
+        self.assertEqual(renderer.from_context({'x': 1}), 'a1b')
+
+    def test_060_002_trim_comments(self):
+        """Whitespace trimmed after a comment"""
+        renderer = templatelite.Renderer(template_str='a{# comment -#}\n\n  b')
+        self.assertEqual(renderer.from_context({}), 'ab')
+
+    def test_060_003_trim_after_keeps_blank_lines(self):
+        """Blank lines within the text after a trimmed directive are kept"""
+        renderer = templatelite.Renderer(template_str='{% if x -%}\nabc\n\nxyz{% endif %}')
+        self.assertEqual(renderer.from_context({'x': True}), 'abc\n\nxyz')
+
+    def test_060_004_untrimmed_directive_newline(self):
+        """Without a marker the first blank line after a directive is removed - as it always has been"""
+        renderer = templatelite.Renderer(template_str='{% if a %}x\n\ny\n{% endif %}\nend')
+        self.assertEqual(renderer.from_context({'a': True}), 'x\ny\nend')
+
+    def test_060_010_collapse_whitespace(self):
+        """Runs of whitespace collapsed"""
+        renderer = templatelite.Renderer(template_str='<p>a   b\n\n   c</p>  <p>  {{ x }}  </p>',
+                                         collapse_whitespace=True, remove_indentation=False)
+        self.assertEqual(renderer.from_context({'x': 1}), '<p>a b\nc</p> <p> 1 </p>')
+
+    def test_060_011_collapse_whitespace_preserved_elements(self):
+        """Whitespace within pre elements is preserved"""
+        renderer = templatelite.Renderer(template_str='<div>  <pre>  x\n\n  {{ x }}  </pre>  </div>',
+                                         collapse_whitespace=True, remove_indentation=False)
+        self.assertEqual(renderer.from_context({'x': 1}), '<div> <pre>  x\n\n  1  </pre> </div>')
+
+
+class FragmentCache(unittest.TestCase):
+    template = "{% cache 'nav' uid %}<nav>{{ name }}</nav>{% endcache %}|{{ page }}"
+
+    def test_070_000_invalid_cache_missing_key(self):
+        """Invalid cache statement - missing the key"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, r"Syntax Error : Invalid cache statement \'\{% cache %\}\'"):
+            templatelite.Renderer(template_str='{% cache %}{% endcache %}')
+
+    def test_070_001_invalid_missing_endcache(self):
+        """Invalid template - missing endcache"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, r"Syntax Error : Missing directive \'{% endcache %}\'"):
+            templatelite.Renderer(template_str="{% cache 'a' %}")
+
+    def test_070_002_invalid_lone_endcache(self):
+        """Invalid template - endcache without cache"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, r"Syntax Error : Unexpected directive - found \'{% endcache %}\' outside \'{% cache %}\' block"):
+            templatelite.Renderer(template_str="{% endcache %}")
+
+    def test_070_003_invalid_break_in_cache(self):
+        """Invalid template - break inside a cache block"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, r"Syntax Error : Unexpected directive - found \'{% break %}\' inside \'{% cache %}\' block"):
+            templatelite.Renderer(template_str="{% for n in l %}{% cache 'a' %}{% break %}{% endcache %}{% endfor %}")
+
+    def test_070_004_invalid_else_in_cache(self):
+        """Invalid template - else inside a cache block"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, r"Syntax Error : Unexpected directive - found \'{% else %}\' inside {% cache %} block"):
+            templatelite.Renderer(template_str="{% cache 'a' %}{% else %}{% endcache %}")
+
+    def test_070_010_fragment_reused(self):
+        """Cached fragment is reused while the vary values are unchanged"""
+        renderer = templatelite.Renderer(template_str=self.template)
+        self.assertEqual(renderer.from_context({'uid': 1, 'name': 'a', 'page': 1}), '<nav>a</nav>|1')
+        self.assertEqual(renderer.from_context({'uid': 1, 'name': 'b', 'page': 2}), '<nav>a</nav>|2')
+        self.assertEqual(renderer.from_context({'uid': 2, 'name': 'c', 'page': 3}), '<nav>c</nav>|3')
+
+    def test_070_011_nested_fragments(self):
+        """Cache blocks can be nested"""
+        template = "{% cache 'outer' a %}[{{ a }}{% cache 'inner' %}{{ b }}{% endcache %}]{% endcache %}"
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'a': 1, 'b': 1}), '[11]')
+        self.assertEqual(renderer.from_context({'a': 2, 'b': 2}), '[21]')
+
+    def test_070_012_fragment_in_loop(self):
+        """Cache block inside a for loop keyed on the loop target"""
+        template = "{% for n in l %}{% cache 'row' n %}{{ n }}{{ x }}{% endcache %}{% endfor %}"
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': [1, 2, 1], 'x': 'a'}), '1a2a1a')
+        self.assertEqual(renderer.from_context({'l': [3, 2], 'x': 'b'}), '3b2a')
+
+    def test_070_020_lru_eviction(self):
+        """LRU cache discards the least recently used entry"""
+        cache = templatelite.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_070_021_lru_ttl(self):
+        """LRU cache entries expire"""
+        cache = templatelite.LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+    def test_070_022_lru_unhashable(self):
+        """LRU cache ignores keys which can't be hashed"""
+        cache = templatelite.LRUCache()
+        cache.set(('a', []), 1)
+        self.assertIsNone(cache.get(('a', [])))
+
+    def test_070_030_file_cache(self):
+        """Fragments stored in a file cache are shared between renderers"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        first = templatelite.Renderer(template_str=self.template, fragment_cache=templatelite.FileCache(directory))
+        second = templatelite.Renderer(template_str=self.template, fragment_cache=templatelite.FileCache(directory))
+        self.assertEqual(first.from_context({'uid': 1, 'name': u'\u00e9', 'page': 1}), u'<nav>\u00e9</nav>|1')
+        self.assertEqual(second.from_context({'uid': 1, 'name': 'b', 'page': 2}), u'<nav>\u00e9</nav>|2')
+
+
+class PureFilters(unittest.TestCase):
+    calls = []
+
+    @classmethod
+    def setUpClass(cls):
+        @templatelite.registerModifier('test_pure_upper', pure=True, cache_size=16)
+        def pure_upper(var, *args, **kwargs):
+            cls.calls.append(var)
+            return str(var).upper() + ''.join(args)
+
+        @templatelite.registerModifier('test_pure_none', pure=True)
+        def pure_none(var, *args, **kwargs):
+            cls.calls.append(var)
+            return None
+
+        cls.pure_upper = staticmethod(pure_upper)
+
+    def setUp(self):
+        del self.calls[:]
+        self.pure_upper.cache.clear()
+
+    def test_080_000_results_memoised(self):
+        """Pure filter only called once for each distinct value"""
+        renderer = templatelite.Renderer(template_str='{% for n in l %}{{ n|test_pure_upper }}{% endfor %}')
+        self.assertEqual(renderer.from_context({'l': ['a', 'b', 'a', 'a']}), 'ABAA')
+        self.assertEqual(renderer.from_context({'l': ['b', 'a']}), 'BA')
+        self.assertEqual(self.calls, ['a', 'b'])
+
+    def test_080_001_arguments_in_key(self):
+        """Pure filter memoised separately for different arguments and types"""
+        renderer = templatelite.Renderer(template_str="{{ n|test_pure_upper x }}{{ n|test_pure_upper y }}{% for m in l %}{{ m|test_pure_upper }}{% endfor %}")
+        self.assertEqual(renderer.from_context({'n': 'a', 'l': [1, True, 1]}), 'AxAy1TRUE1')
+        self.assertEqual(self.calls, ['a', 'a', 1, True])
+
+    def test_080_002_unhashable_values(self):
+        """Pure filter still applied to values which can't be memoised"""
+        renderer = templatelite.Renderer(template_str='{{ n|test_pure_upper }}')
+        self.assertEqual(renderer.from_context({'n': ['a']}), "['A']")
+        self.assertEqual(renderer.from_context({'n': ['a']}), "['A']")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_080_003_none_results_memoised(self):
+        """A None result is memoised"""
+        renderer = templatelite.Renderer(template_str='{% for n in l %}{{ n|test_pure_none }}{% endfor %}')
+        self.assertEqual(renderer.from_context({'l': [1, 1]}), 'NoneNone')
+        self.assertEqual(self.calls, [1])
+
+    def test_080_010_shared_stats(self):
+        """Stats reported from the shared cache"""
+        renderer = templatelite.Renderer(template_str='{% for n in l %}{{ n|test_pure_upper }}{{ n|len }}{% endfor %}')
+        renderer.from_context({'l': ['a', 'b', 'a', 'a']})
+        stats = renderer.filter_cache_stats()
+        self.assertEqual(list(stats), ['test_pure_upper'])
+        self.assertEqual((stats['test_pure_upper']['hits'], stats['test_pure_upper']['misses']), (2, 2))
+        self.assertEqual(stats['test_pure_upper']['hit_rate'], 0.5)
+
+    def test_080_011_renderer_caches(self):
+        """Renderer with its own filter caches"""
+        template = '{% for n in l %}{{ n|test_pure_upper }}{% endfor %}'
+        first = templatelite.Renderer(template_str=template, filter_cache_size=8)
+        second = templatelite.Renderer(template_str=template, filter_cache_size=8)
+        self.assertEqual(first.from_context({'l': ['a', 'a']}), 'AA')
+        self.assertEqual(second.from_context({'l': ['a', 'a']}), 'AA')
+        self.assertEqual(self.calls, ['a', 'a'])
+        self.assertEqual(first.filter_cache_stats()['test_pure_upper']['hits'], 1)
+        self.assertEqual(self.pure_upper.cache.stats()['hits'], 0)
+
+    def test_080_012_renderer_caches_argument_errors(self):
+        """Argument errors reported from a filter memoised in the Renderer"""
+        @templatelite.registerModifier('test_pure_noargs', pure=True)
+        def pure_noargs(var, *args, **kwargs):
+            if args:
+                raise templatelite.UnexpectedFilterArguments
+            return var
+
+        renderer = templatelite.Renderer(template_str='{{ n|test_pure_noargs 1 }}', filter_cache_size=8)
+        with six.assertRaisesRegex(self, templatelite.UnexpectedFilterArguments, r"Unexpected filter arguments in '{{ n\|test_pure_noargs 1 }}'"):
+            renderer.from_context({'n': 1})
+
+
+class BatchFilters(unittest.TestCase):
+    calls = []
+
+    @classmethod
+    def setUpClass(cls):
+        @templatelite.registerModifier('test_batch_double')
+        def double(var, *args, **kwargs):
+            cls.calls.append(('scalar', var))
+            return var * 2
+
+        @templatelite.registerBatchModifier('test_batch_double', use_numpy=True)
+        def double_column(values, *args, **kwargs):
+            if args or kwargs:
+                raise templatelite.UnexpectedFilterArguments
+            cls.calls.append(('batch', list(values)))
+            return [value * 2 for value in values]
+
+    def setUp(self):
+        del self.calls[:]
+
+    def test_090_000_column_computed_once(self):
+        """Batch filter called once for the whole loop"""
+        template = '{% for row in rows %}{{ row.amount|test_batch_double }},{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'rows': [{'amount': 1}, {'amount': 2}, {'amount': 3}]}), '2,4,6,')
+        self.assertEqual(self.calls, [('batch', [1, 2, 3])])
+
+    def test_090_001_multiple_targets(self):
+        """Batch filter on a loop with multiple targets, and a generator as the iterable"""
+        template = '{% for n, m in pairs %}{{ m|test_batch_double }}{{ n }}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'pairs': zip('ab', [1, 2])}), '2a4b')
+
+    def test_090_002_nested_loops(self):
+        """The target of an outer loop used within an inner loop is filtered individually - the inner loop may be empty"""
+        template = '{% for n in outer %}{% for m in inner %}{{ n|test_batch_double }}{{ m|test_batch_double }},{% endfor %}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'outer': [1, 2], 'inner': [3]}), '26,46,')
+        self.assertEqual([call[0] for call in self.calls], ['batch', 'scalar', 'batch', 'scalar'])
+
+    def test_090_003_loop_else_not_batched(self):
+        """Values in a for loop else block are filtered individually"""
+        template = '{% for n in l %}{{ n|test_batch_double }}{% else %}[{{ n|test_batch_double }}]{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': [1, 2]}), '24[4]')
+        self.assertEqual(self.calls, [('batch', [1, 2]), ('scalar', 2)])
+
+    def test_090_004_non_target_not_batched(self):
+        """Values not derived from the loop target are filtered individually"""
+        template = '{% for n in l %}{{ x|test_batch_double }}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': [1, 2], 'x': 5}), '1010')
+        self.assertEqual(self.calls, [('scalar', 5), ('scalar', 5)])
+
+    def test_090_005_break(self):
+        """Loops with batch filtered values can still break"""
+        template = '{% for n in l %}{% if n == 2 %}{% break %}{% endif %}{{ n|test_batch_double }}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': [1, 2, 3]}), '2')
+
+    def test_090_006_argument_errors(self):
+        """Argument errors reported from batch filters"""
+        template = '{% for n in l %}{{ n|test_batch_double 1 }}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        with six.assertRaisesRegex(self, templatelite.UnexpectedFilterArguments, r"Unexpected filter arguments in '{{ n\|test_batch_double 1 }}'"):
+            renderer.from_context({'l': [1]})
+
+    def test_090_007_builtin_len(self):
+        """The len filter has a batch implementation"""
+        template = '{% for n in l %}{{ n|len }}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'l': ['a', 'bb']}), '12')
+
+    def test_090_008_conditional_not_batched(self):
+        """Values which might not be displayed are filtered individually - a guard still protects the filter"""
+        template = '{% for row in rows %}{% if row.items %}{{ row.items|len }}{% endif %}{% endfor %}'
+        renderer = templatelite.Renderer(template_str=template)
+        self.assertEqual(renderer.from_context({'rows': [{'items': None}, {'items': [1, 2]}]}), '2')
+
+        for template in ('{% for n in l %}{% if n %}{{ n|test_batch_double }}{% endif %}{% endfor %}',
+                         '{% for n in l %}{% if not n %}{% continue %}{% endif %}{{ n|test_batch_double }}{% endfor %}',
+                         '{% for n in l %}{{ n|test_batch_double }}{% if n == 2 %}{% break %}{% endif %}{% endfor %}'):
+            del self.calls[:]
+            renderer = templatelite.Renderer(template_str=template)
+            self.assertEqual(renderer.from_context({'l': [1, 2]}), '24')
+            self.assertEqual(self.calls, [('scalar', 1), ('scalar', 2)])
+
+
+class ThreadSafety(unittest.TestCase):
+    threads = 32
+    renders = 50
+
+    def _run_threads(self, target):
+        """Start all of the threads together, and collect any failures"""
+        start = threading.Event()
+        failures = []
+
+        def run(index):
+            start.wait()
+            try:
+                target(index)
+            except Exception as e:
+                failures.append((index, e))
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return failures
+
+    def test_300_000_compiled_template_immutable(self):
+        """The compiled template can't be changed"""
+        renderer = templatelite.Renderer(template_str='{{ name }}')
+        with self.assertRaises(AttributeError):
+            renderer.template._render = None
+
+    def test_300_001_shared_renderer(self):
+        """One renderer used by many threads at the same time"""
+        template = """{% for row in rows %}{{ row.name }}={{ row.name|len }}{% if row.n > 2 %}+{% endif %},{% endfor %}
+{% cache 'footer' %}footer{% endcache %}|{{ thread|escape }}"""
+        renderer = templatelite.Renderer(template_str=template, filter_cache_size=8)
+
+        def render(index):
+            for n in range(self.renders):
+                rows = [{'name': 'x' * (index + i), 'n': i} for i in range(n % 5)]
+                expected = ''.join('{}={}{},'.format('x' * (index + i), index + i, '+' if i > 2 else '')
+                                   for i in range(n % 5)) + 'footer|<{}>'.format(index)
+                result = renderer.from_context({'rows': rows, 'thread': '<{}>'.format(index)})
+                assert result == expected.replace('<', '&lt;').replace('>', '&gt;'), (result, expected)
+
+        self.assertEqual(self._run_threads(render), [])
+
+    def test_300_002_concurrent_compile_and_register(self):
+        """Templates compiled while filters are being registered"""
+        def compile_and_register(index):
+            templatelite.registerModifier('test_thread_{}'.format(index))(lambda var, *args, **kwargs: var)
+            for n in range(self.renders):
+                renderer = templatelite.Renderer(template_str='{{ v|len }}{{ v|test_thread_%d }}' % index)
+                assert renderer.from_context({'v': 'abc'}) == '3abc'
+
+        self.assertEqual(self._run_threads(compile_and_register), [])
+
+
+class Environments(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_110_000_environment_filters(self):
+        """Filters registered with an Environment are only available to its templates"""
+        env = templatelite.Environment()
+
+        @env.filter('test_env_reverse')
+        def reverse(var, *args, **kwargs):
+            return var[::-1]
+
+        self.assertEqual(env.from_string('{{ v|test_env_reverse }}').from_context({'v': 'abc'}), 'cba')
+        with self.assertRaises(templatelite.UnrecognisedFilter):
+            templatelite.Renderer(template_str='{{ v|test_env_reverse }}')
+
+    def test_110_001_builtin_filters(self):
+        """An Environment starts with the globally registered filters"""
+        env = templatelite.Environment()
+        self.assertEqual(env.from_string('{{ v|len }}').from_context({'v': 'abc'}), '3')
+
+    def test_110_002_frozen_after_compile(self):
+        """Filters can't be registered once a template has been compiled"""
+        env = templatelite.Environment()
+        self.assertFalse(env.frozen)
+        env.from_string('{{ v }}')
+        self.assertTrue(env.frozen)
+        with self.assertRaises(templatelite.EnvironmentFrozen):
+            env.register_filter('test_env_late', lambda var: var)
+
+    def test_110_003_options(self):
+        """Environment options apply to every template, and can be overridden"""
+        env = templatelite.Environment(autoescape='html')
+        self.assertEqual(env.from_string('{{ v }}').from_context({'v': '<'}), '&lt;')
+        self.assertEqual(env.from_string('{{ v }}', autoescape=None).from_context({'v': '<'}), '<')
+        with self.assertRaises(TypeError):
+            templatelite.Environment(not_an_option=True)
+
+    def test_110_004_dict_loader(self):
+        """Templates are loaded and compiled once"""
+        env = templatelite.Environment(loader=templatelite.DictLoader({'hello': 'Hello {{ name }}'}))
+        renderer = env.get_template('hello')
+        self.assertIs(env.get_template('hello'), renderer)
+        self.assertEqual(renderer.from_context({'name': 'Tony'}), 'Hello Tony')
+        with self.assertRaises(templatelite.TemplateNotFound):
+            env.get_template('missing')
+
+    def test_110_005_file_system_loader(self):
+        """Templates are loaded from files within the directory only"""
+        os.makedirs(os.path.join(self.tmpdir, 'emails'))
+        with open(os.path.join(self.tmpdir, 'emails', 'hello.txt'), 'w') as fp:
+            fp.write('Hello {{ name }}')
+
+        loader = templatelite.FileSystemLoader(self.tmpdir)
+        self.assertEqual(loader.list_templates(), ['emails/hello.txt'])
+        env = templatelite.Environment(loader=loader)
+        self.assertEqual(env.get_template('emails/hello.txt').from_context({'name': 'Tony'}), 'Hello Tony')
+        with self.assertRaises(templatelite.TemplateNotFound):
+            env.get_template('../hello.txt')
+
+    def test_110_006_filters_bound_in_source(self):
+        """Filters are called directly by the generated code"""
+        renderer = templatelite.Renderer(template_str='{{ v|split }}')
+        self.assertIn('filter_split(', renderer.template.source)
+        self.assertNotIn('execute_filter', renderer.template.source)
+
+    def test_110_007_filter_arguments_error_in_if(self):
+        """The failing token is reported when several filters are used on one line"""
+        @templatelite.registerModifier('test_env_fails')
+        def fails(var, *args, **kwargs):
+            raise templatelite.UnexpectedFilterArguments
+
+        renderer = templatelite.Renderer(template_str='{% if v|len > 1 and v|test_env_fails %}yes{% endif %}')
+        with six.assertRaisesRegex(self, templatelite.UnexpectedFilterArguments,
+                                   r"Unexpected filter arguments in 'v\|test_env_fails'"):
+            renderer.from_context({'v': 'abc'})
+
+
+class CompactTemplates(unittest.TestCase):
+    def test_130_000_compact_renders(self):
+        """A compact template renders the same output"""
+        template = '{% for n in items %}{{ n }}-{{ n|len }},{% endfor %}'
+        context = {'items': ['a', 'bb']}
+        self.assertEqual(templatelite.Renderer(template_str=template, compact=True).from_context(context),
+                         templatelite.Renderer(template_str=template).from_context(context))
+
+    def test_130_001_compact_drops_text(self):
+        """A compact template doesn't keep the template text or the generated source"""
+        renderer = templatelite.Renderer(template_str='Hello {{ name }}', compact=True)
+        self.assertIsNone(renderer.template_str)
+        self.assertIsNone(renderer.template.source)
+        self.assertEqual(templatelite.Renderer(template_str='Hello {{ name }}').template_str, 'Hello {{ name }}')
+
+    def test_130_002_no_instance_dict(self):
+        """Renderers and compiled templates have no per instance dictionary"""
+        renderer = templatelite.Renderer(template_str='Hello {{ name }}')
+        self.assertFalse(hasattr(renderer, '__dict__'))
+        self.assertFalse(hasattr(renderer.template, '__dict__'))
+
+    @unittest.skipUnless(hasattr(types.CodeType, 'replace'), 'Code objects can only be rebuilt on Python 3.8+')
+    def test_130_003_literals_interned(self):
+        """Literal text shared by compact templates is only held once"""
+        text = 'A long piece of shared literal text : '
+        first = templatelite.Renderer(template_str=text + ''.join(['{{ a }}']), compact=True)
+        second = templatelite.Renderer(template_str=text + ''.join(['{{ b }}']), compact=True)
+        literal = lambda renderer: [const for const in renderer.template._render.__code__.co_consts
+                                    if const == text][0]
+        self.assertIs(literal(first), literal(second))
+
+    def test_130_004_filter_errors_reported(self):
+        """Filter errors in a compact template are reported against the token"""
+        renderer = templatelite.Renderer(template_str='{{ v|len 1 }}', compact=True)
+        with six.assertRaisesRegex(self, templatelite.UnexpectedFilterArguments,
+                                   r"Unexpected filter arguments in '{{ v\|len 1 }}'"):
+            renderer.from_context({'v': 'abc'})
+
+
+class MemoryMappedTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'report.txt')
+        self.body = 'Line of a large static report\n' * 5000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, text):
+        with io.open(self.path, 'w', encoding='utf-8', newline='') as fp:
+            fp.write(text)
+
+    def test_140_000_large_literal_span(self):
+        """Large literal text is kept as offsets into the file, and rendered the same"""
+        template = u'Report for {{ name }}\n{% if show %}\n' + self.body + u'{% endif %}Total {{ total }}\n'
+        self._write(template)
+        mapped = templatelite.Renderer(template_file=self.path, use_mmap=True)
+        self.assertIn('span_1', mapped.template.source)
+        self.assertIsNone(mapped.template_str)
+        self.assertNotIn(self.body, mapped.template.source)
+
+        context = {'name': 'Tony', 'show': True, 'total': 3}
+        expected = templatelite.Renderer(template_str=template).from_context(context)
+        self.assertEqual(mapped.from_context(context), expected)
+
+        stream = io.BytesIO()
+        mapped.render_to(stream, context)
+        self.assertEqual(stream.getvalue(), expected.encode('utf-8'))
+
+    def test_140_001_whitespace_control(self):
+        """Whitespace trimming markers adjust the span"""
+        template = u'{{ name -}}\n\n' + self.body + u'\n  {{- total }}'
+        self._write(template)
+        mapped = templatelite.Renderer(template_file=self.path, use_mmap=True)
+        self.assertIn('span_1', mapped.template.source)
+        context = {'name': 'Tony', 'total': 3}
+        self.assertEqual(mapped.from_context(context),
+                         templatelite.Renderer(template_str=template).from_context(context))
+
+    def test_140_002_indented_text(self):
+        """Indented text is copied into the template when indentation is removed"""
+        template = u'{{ name }}\n' + '  indented line\n' * 5000
+        self._write(template)
+        mapped = templatelite.Renderer(template_file=self.path, use_mmap=True)
+        self.assertNotIn('span_1', mapped.template.source)
+        self.assertEqual(mapped.from_context({'name': 'Tony'}), 'Tony\n' + 'indented line\n' * 5000)
+
+        kept = templatelite.Renderer(template_file=self.path, use_mmap=True, remove_indentation=False)
+        self.assertIn('span_1', kept.template.source)
+        self.assertEqual(kept.from_context({'name': 'Tony'}), template.replace('{{ name }}', 'Tony'))
+
+    def test_140_003_non_ascii(self):
+        """Text in the file is decoded with the encoding"""
+        template = u'{{ name }}:\u00a3\u20ac\n' + self.body
+        self._write(template)
+        mapped = templatelite.Renderer(template_file=self.path, use_mmap=True)
+        self.assertEqual(mapped.from_context({'name': u'\u00e9'}), template.replace('{{ name }}', u'\u00e9'))
+
+    def test_140_004_errors(self):
+        """A memory mapped template needs a non empty file with an ascii compatible encoding"""
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_str='{{ name }}', use_mmap=True)
+        self._write(u'')
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_file=self.path, use_mmap=True)
+        self._write(u'{{ name }}')
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_file=self.path, use_mmap=True, encoding='utf-16')
+
+
+class BytesOutput(unittest.TestCase):
+    template = u'<p>{{ name }}</p>\n{% for n in items %}{{ n }}:{{ n|len }},{% endfor %}\n{% cache \'footer\' %}\u00a9{% endcache %}'
+    context = {'name': u'<\u00e9>', 'items': [u'a', u'\u20ac\u20ac']}
+
+    def test_150_000_bytes_output(self):
+        """The template produces the encoded text"""
+        text = templatelite.Renderer(template_str=self.template).from_context(self.context)
+        renderer = templatelite.Renderer(template_str=self.template, as_bytes=True)
+        self.assertEqual(renderer.from_context(self.context), text.encode('utf-8'))
+        self.assertIn("b'<p>'", renderer.template.source)
+
+    def test_150_001_encoding_and_autoescape(self):
+        """Literals and values are encoded with the encoding, and escaped"""
+        text = templatelite.Renderer(template_str=self.template, autoescape='html').from_context(self.context)
+        renderer = templatelite.Renderer(template_str=self.template, autoescape='html', as_bytes=True, encoding='latin-1')
+        self.assertEqual(renderer.from_context(self.context.copy(), {'items': [u'a', u'\u00e8']}),
+                         text.replace(u'\u20ac\u20ac:2', u'\u00e8:1').encode('latin-1'))
+
+    def test_150_002_render_to_stream(self):
+        """The encoded segments are written to a binary stream"""
+        renderer = templatelite.Renderer(template_str=self.template, as_bytes=True)
+        stream = io.BytesIO()
+        renderer.render_to(stream, self.context)
+        self.assertEqual(stream.getvalue(), renderer.from_context(self.context))
+
+    def test_150_003_file_cache(self):
+        """Rendered bytes can be stored in a FileCache"""
+        directory = tempfile.mkdtemp()
+        try:
+            cache = templatelite.FileCache(directory)
+            renderer = templatelite.Renderer(template_str=self.template, as_bytes=True, fragment_cache=cache)
+            first = renderer.from_context(self.context)
+            self.assertEqual(cache.get(('footer',)), u'\u00a9'.encode('utf-8'))
+            self.assertEqual(renderer.from_context(self.context), first)
+            cache.set('text', u'\u00a9')
+            self.assertEqual(cache.get('text'), u'\u00a9')
+        finally:
+            shutil.rmtree(directory)
+
+
+class IncrementalRender(unittest.TestCase):
+    template = """<h1>{{ title }}</h1>
+{% for row in rows %}{{ row.name }}={{ row.value }},{% endfor %}
+Updated {{ clock }}
+{% if alert %}ALERT {{ alert }}{% endif %}"""
+
+    def setUp(self):
+        self.renderer = templatelite.Renderer(template_str=self.template, incremental=True)
+        self.context = {'title': 'Dash', 'rows': [{'name': 'a', 'value': 1}], 'clock': 1, 'alert': None}
+
+    def test_160_000_same_output(self):
+        """An incremental template renders the same output"""
+        expected = templatelite.Renderer(template_str=self.template).from_context(self.context)
+        self.assertEqual(self.renderer.from_context(self.context), expected)
+        self.assertEqual(self.renderer.incremental().render(self.context), expected)
+
+    def test_160_001_changed_segments(self):
+        """Only the segments which use changed context variables are rendered again"""
+        session = self.renderer.incremental()
+        session.render(self.context)
+        self.assertEqual([index for index, output in session.changes], [0, 1, 2, 3])
+
+        calls = []
+
+        class Row(object):
+            @property
+            def name(self):
+                calls.append('name')
+                return 'b'
+            value = 2
+
+        context = dict(self.context, rows=[Row()])
+        self.assertEqual(session.render(context), '<h1>Dash</h1>\nb=2,Updated 1\n')
+        lookups = len(calls)
+        context['clock'] = 2
+        self.assertEqual(session.render(context), '<h1>Dash</h1>\nb=2,Updated 2\n')
+        self.assertEqual(session.changes, [(2, 'Updated 2\n')])
+        self.assertEqual(len(calls), lookups)
+
+    def test_160_002_explicit_changes(self):
+        """The changed context variables can be named explicitly"""
+        session = self.renderer.incremental()
+        session.render(self.context)
+        self.context['rows'].append({'name': 'c', 'value': 3})
+        self.assertEqual(session.render(self.context), '<h1>Dash</h1>\na=1,Updated 1\n')
+        self.assertEqual(session.render(self.context, changed=['rows']), '<h1>Dash</h1>\na=1,c=3,Updated 1\n')
+        self.assertEqual(session.changes, [(1, 'a=1,c=3,')])
+
+    def test_160_003_not_incremental(self):
+        """Only an incremental Renderer can create a session"""
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_str=self.template).incremental()
+
+
+class Specialise(unittest.TestCase):
+    template = """<title>{{ site.name|escape }}</title>
+{% if flags.beta %}Beta {{ user }}{% elif user %}Hi {{ user }}{% else %}Anonymous{% endif %}
+{% for item in items %}{% if flags.legacy %}{{ item.old }}{% endif %}{{ item }},{% endfor %}
+{{ static }}/logo.png"""
+    constants = {'site': {'name': 'A&B'}, 'flags': {'beta': False, 'legacy': False}, 'static': '/static'}
+
+    def test_170_000_same_output(self):
+        """A specialised template renders the same output"""
+        renderer = templatelite.Renderer(template_str=self.template)
+        specialised = renderer.specialise(self.constants)
+        for context in ({'user': 'Tony', 'items': [1, 2]}, {'user': None, 'items': []}):
+            self.assertEqual(specialised.from_context(context),
+                             renderer.from_context(dict(context, **self.constants)))
+
+    def test_170_001_constants_folded(self):
+        """Displayed constants become literal text, and branches which are never taken are removed"""
+        specialised = templatelite.Renderer(template_str=self.template).specialise(self.constants)
+        source = specialised.template.source
+        self.assertIn("'A&amp;B'", source)
+        self.assertIn("'/static'", source)
+        self.assertNotIn('Beta', source)
+        self.assertNotIn('item.old', source)
+        self.assertNotIn('flags', source)
+        self.assertNotIn('site', source)
+
+    def test_170_002_constant_branch_taken(self):
+        """A branch which is always taken removes the rest of the if statement"""
+        specialised = templatelite.Renderer(template_str=self.template).specialise(
+            dict(self.constants, flags={'beta': True, 'legacy': True}))
+        self.assertNotIn('Anonymous', specialised.template.source)
+        self.assertEqual(specialised.from_context({'user': 'Tony', 'items': [{'old': 'x'}]}),
+                         "<title>A&amp;B</title>\nBeta Tonyx{'old': 'x'},/static/logo.png")
+
+    def test_170_003_constants_used_at_render(self):
+        """Constants which can't be folded are still available when the template is rendered"""
+        renderer = templatelite.Renderer(template_str='{% for n in numbers %}{{ n }},{% endfor %}', errors=True)
+        self.assertEqual(renderer.specialise({'numbers': [1, 2]}).from_context({}), '1,2,')
+
+    def test_170_004_specialise_again(self):
+        """A specialised Renderer can be specialised with more constants"""
+        renderer = templatelite.Renderer(template_str='{{ a }}-{{ b }}').specialise({'a': 1}).specialise({'b': 2})
+        self.assertEqual(renderer.template.source.count('_dodots'), 0)
+        self.assertEqual(renderer.from_context({}), '1-2')
+
+    def test_170_005_compact_cannot_specialise(self):
+        """The template text is needed to specialise"""
+        with self.assertRaises(ValueError):
+            templatelite.Renderer(template_str='{{ a }}', compact=True).specialise({'a': 1})
+
+    def test_170_006_str_subclass(self):
+        """A folded constant which is a str subclass (such as markupsafe's Markup) is written as plain text"""
+        class Markup(six.text_type):
+            def __repr__(self):
+                return 'Markup({})'.format(six.text_type.__repr__(self))
+
+        module = templatelite.templatelite
+        escape_html = module.escape_html
+        module.escape_html = lambda value: Markup(escape_html(value))
+        try:
+            for as_bytes in (False, True):
+                renderer = templatelite.Renderer(template_str='{{ site }}', autoescape='html',
+                                                 as_bytes=as_bytes).specialise({'site': 'A&B'})
+                self.assertNotIn('Markup(', renderer.template.source)
+                self.assertEqual(renderer.from_context({}), b'A&amp;B' if as_bytes else 'A&amp;B')
+        finally:
+            module.escape_html = escape_html
+
+
+class ContextSchema(unittest.TestCase):
+    schema = {'user.name': 'attr', 'user.greeting': 'call', 'settings.title': 'item', 'row.amount': 'item'}
+    template = """{{ settings.title }}:{{ user.name }}:{{ user.greeting }}
+{% for row in rows %}{{ row.amount }},{% endfor %}"""
+
+    class User(object):
+        def __init__(self, name):
+            self.name = name
+
+        def greeting(self):
+            return 'Hi ' + self.name
+
+    def context(self, **changes):
+        return dict({'user': self.User('Tony'), 'settings': {'title': 'Home'},
+                     'rows': [{'amount': 1}, {'amount': 2}]}, **changes)
+
+    def test_180_000_same_output(self):
+        """A template with a schema renders the same output"""
+        renderer = templatelite.Renderer(template_str=self.template, schema=self.schema)
+        self.assertEqual(renderer.from_context(self.context()),
+                         templatelite.Renderer(template_str=self.template).from_context(self.context()))
+
+    def test_180_001_direct_access(self):
+        """Declared names are compiled into direct accesses"""
+        source = templatelite.Renderer(template_str=self.template, schema=self.schema).template.source
+        self.assertNotIn('_dodots(token=\'{{ user', source)
+        self.assertIn("settings['title']", source)
+        self.assertIn('user.name', source)
+        self.assertIn('user.greeting()', source)
+        self.assertIn("row['amount']", source)
+
+    def test_180_002_undeclared_names(self):
+        """Names which aren't fully declared are resolved as normal"""
+        renderer = templatelite.Renderer(template_str='{{ user.name }}{{ user.address.town }}',
+                                         schema={'user.name': 'item', 'user.address.town': 'item'})
+        self.assertIn('_dodots', renderer.template.source)
+        self.assertEqual(renderer.from_context({'user': {'name': 'Tony', 'address': {'town': 'Leeds'}}}),
+                         'TonyLeeds')
+
+    def test_180_003_context_checked(self):
+        """A context which doesn't match the schema is rejected before rendering"""
+        renderer = templatelite.Renderer(template_str=self.template, schema=self.schema)
+        for context in (self.context(settings={}), self.context(user={'name': 'Tony'}),
+                        self.context(user=None), self.context(rows=[{'amount': 1}, {}])):
+            with self.assertRaises(templatelite.ContextSchemaError):
+                renderer.from_context(context)
+
+        del_user = self.context()
+        del del_user['user']
+        with six.assertRaisesRegex(self, templatelite.ContextSchemaError, 'Missing context variable \'user\''):
+            renderer.from_context(del_user)
+
+    def test_180_004_checked_once(self):
+        """Each declared value is checked once per render, and loop items once before the loop"""
+        lookups = []
+
+        class Row(object):
+            @property
+            def amount(self):
+                lookups.append(1)
+                return 5
+
+        renderer = templatelite.Renderer(template_str='{% for row in rows %}{{ row.amount }}{{ row.amount }}{% endfor %}',
+                                         schema={'row.amount': 'attr'})
+        self.assertEqual(renderer.from_context({'rows': [Row(), Row()]}), '5555')
+        self.assertEqual(len(lookups), 6)
+
+    def test_180_005_invalid_schema(self):
+        """The schema must use dotted names and known accesses"""
+        for schema in ({'user': 'item'}, {'user.name': 'key'}, {'user.1st': 'item'}):
+            with self.assertRaises(ValueError):
+                templatelite.Renderer(template_str='{{ user.name }}', schema=schema)
+
+
+class RepeatedLookups(unittest.TestCase):
+    template = """{{ user.name }} {% if user.name %}Hi {{ user.name }}{% endif %}
+{% for item in items %}{{ user.name }}:{{ item.value }},{% endfor %}"""
+
+    class User(object):
+        def __init__(self):
+            self.calls = 0
+
+        def name(self):
+            self.calls += 1
+            return 'Tony'
+
+    def test_190_000_looked_up_once(self):
+        """A repeated dotted name is looked up (and its method called) once per render"""
+        user = self.User()
+        renderer = templatelite.Renderer(template_str=self.template)
+        self.assertEqual(renderer.from_context({'user': user, 'items': [{'value': 1}, {'value': 2}]}),
+                         'TonyHi TonyTony:1,Tony:2,')
+        self.assertEqual(user.calls, 2)
+
+    def test_190_001_volatile(self):
+        """A volatile name is looked up every time it is used"""
+        user = self.User()
+        renderer = templatelite.Renderer(template_str=self.template, volatile=['user'])
+        renderer.from_context({'user': user, 'items': [{'value': 1}, {'value': 2}]})
+        self.assertEqual(user.calls, 5)
+
+    def test_190_002_not_before_first_use(self):
+        """A name first used inside a block is only looked up if the block is rendered"""
+        user = self.User()
+        renderer = templatelite.Renderer(template_str='{% if show %}{{ user.name }}{% endif %}{{ user.name }}')
+        self.assertEqual(renderer.from_context({'user': user, 'show': False}), 'Tony')
+        self.assertEqual(user.calls, 1)
+
+    def test_190_003_loop_targets(self):
+        """Names derived from a loop target are looked up for each item"""
+        renderer = templatelite.Renderer(template_str='{% for item in items %}{{ item.value }}{{ item.value }}{% endfor %}')
+        self.assertNotIn('lookup_', renderer.template.source)
+        self.assertEqual(renderer.from_context({'items': [{'value': 1}, {'value': 2}]}), '1122')
+
+    def test_190_004_missing_values(self):
+        """Each token still gets its own value when the name is missing"""
+        renderer = templatelite.Renderer(template_str='{{ user.name }}|{{user.name}}|{% if user.name %}yes{% endif %}')
+        self.assertEqual(renderer.from_context({'user': {}}), '{{ user.name }}|{{user.name}}|')
+        self.assertEqual(templatelite.Renderer(template_str='{{ user.name }}|{{user.name}}',
+                                               default='?').from_context({'user': {}}), '?|?')
+
+    def test_190_005_expressions_not_kept(self):
+        """Names in directive expressions are looked up where they are used - so 'and' still short circuits"""
+        renderer = templatelite.Renderer(template_str='{% if user and user.name %}Hi {{ user.name }}{% endif %}'
+                                                      '{% if user and user.name %}!{% endif %}', errors=True)
+        self.assertEqual(renderer.from_context({'user': None}), '')
+        self.assertEqual(renderer.from_context({'user': {'name': 'Tony'}}), 'Hi Tony!')
+
+
+class FilterArguments(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        @templatelite.registerModifier('test_arguments')
+        def arguments(var, *args, **kwargs):
+            return repr((args, sorted(kwargs.items())))
+
+    def test_200_000_typed_arguments(self):
+        """Filter arguments are converted to python values when the template is compiled"""
+        renderer = templatelite.Renderer(template_str="{{ v|test_arguments 1 -2.5 'a b' \"c\" True None x }}")
+        self.assertEqual(renderer.from_context({'v': 1}), repr(((1, -2.5, 'a b', 'c', True, None, 'x'), [])))
+        self.assertIn("1, -2.5, 'a b', 'c', True, None, 'x'", renderer.template.source)
+
+    def test_200_001_keyword_arguments(self):
+        """Keyword arguments are passed without the colon"""
+        renderer = templatelite.Renderer(template_str="{{ v|test_arguments width:10 sep:',' class:'x' }}")
+        self.assertEqual(renderer.from_context({'v': 1}),
+                         repr(((), [('class', 'x'), ('sep', ','), ('width', 10)])))
+
+    def test_200_002_context_arguments(self):
+        """Dotted names are context variables looked up when the filter is called"""
+        renderer = templatelite.Renderer(
+            template_str="{% for row in rows %}{{ row.text|cut row.char }}{{ row.text|cut settings.char }},{% endfor %}")
+        self.assertEqual(renderer.from_context({'rows': [{'text': 'a-b_c', 'char': '-'}, {'text': 'd_e', 'char': 'e'}],
+                                                'settings': {'char': '_'}}),
+                         'ab_ca-bc,d_de,')
+
+    def test_200_003_batch_context_arguments(self):
+        """A batch filter can't be used when an argument is derived from the loop target"""
+        @templatelite.registerModifier('test_scale')
+        def scale(var, *args, **kwargs):
+            return var * args[0]
+
+        @templatelite.registerBatchModifier('test_scale')
+        def scale_column(values, *args, **kwargs):
+            return [value * args[0] for value in values]
+
+        renderer = templatelite.Renderer(
+            template_str="{% for row in rows %}{{ row.n|test_scale 2 }}{{ row.n|test_scale row.by }},{% endfor %}")
+        self.assertEqual(renderer.template.source.count('batch_test_scale'), 1)
+        self.assertEqual(renderer.from_context({'rows': [{'n': 1, 'by': 3}, {'n': 2, 'by': 4}]}), '23,48,')
+
+
+class BuiltinFilters(unittest.TestCase):
+    def render(self, template, **context):
+        return templatelite.Renderer(template_str=template).from_context(context)
+
+    def test_210_000_case(self):
+        """upper, lower and title change the case of the value"""
+        self.assertEqual(self.render('{{ v|upper }}|{{ v|lower }}|{{ v|title }}', v='hello World'),
+                         'HELLO WORLD|hello world|Hello World')
+
+    def test_210_001_case_inline(self):
+        """Built in filters without arguments are compiled inline - unless they have been replaced"""
+        source = templatelite.Renderer(template_str='{{ v|upper }}{{ v|len }}').template.source
+        self.assertIn(').upper()', source)
+        self.assertNotIn('filter_upper', source)
+        self.assertNotIn('filter_len', source)
+
+        env = templatelite.Environment()
+        env.register_filter('upper', lambda var, *args, **kwargs: 'replaced')
+        self.assertEqual(env.from_string('{{ v|upper }}').from_context({'v': 'x'}), 'replaced')
+
+    def test_210_002_truncate(self):
+        """truncate shortens long values"""
+        self.assertEqual(self.render("{{ v|truncate 8 }}|{{ v|truncate 8 end:'~' }}|{{ v|truncate 20 }}",
+                                     v='Hello World'), 'Hello...|Hello W~|Hello World')
+
+    def test_210_003_join_and_default(self):
+        """join joins the items, and default replaces empty values"""
+        self.assertEqual(self.render("{{ v|join ', ' }}|{{ e|default 'none' }}|{{ v|default 'none' }}",
+                                     v=[1, 2], e=''), '1, 2|none|[1, 2]')
+
+    def test_210_004_dates(self):
+        """date and strftime format dates"""
+        import datetime
+        self.assertEqual(self.render("{{ d|date }}|{{ d|date '%Y-%m-%d' }}|{{ d|strftime '%m/%y' }}",
+                                     d=datetime.date(2020, 1, 2)), '02 Jan 2020|2020-01-02|01/20')
+        with self.assertRaises(templatelite.UnexpectedFilterArguments):
+            self.render('{{ d|strftime }}', d=datetime.date(2020, 1, 2))
+
+    def test_210_005_numbers(self):
+        """number and currency format numbers - in loops as well"""
+        self.assertEqual(self.render("{{ n|number }}|{{ n|number 1 }}|{{ m|currency }}|{{ m|currency '£' 0 }}",
+                                     n=1234567.891, m=-1234.5), '1,234,567.891|1,234,567.9|-$1,234.50|-£1,234')
+        self.assertEqual(self.render("{% for n in numbers %}{{ n|currency }},{{ n|number 2 }};{% endfor %}",
+                                     numbers=[1, 1000.5]), '$1.00,1.00;$1,000.50,1,000.50;')
+
+    def test_210_006_center_and_urlencode(self):
+        """center pads the value, and urlencode quotes it"""
+        self.assertEqual(self.render("{{ v|center 9 '*' }}|{{ v|urlencode }}|{{ q|urlencode }}",
+                                     v='a b&c', q=[('a', 1), ('b', 'x y')]), '**a b&c**|a+b%26c|a=1&b=x+y')
+
+    def test_210_007_json(self):
+        """json output is safe within html"""
+        renderer = templatelite.Renderer(template_str='{{ v|json }}', autoescape='html')
+        self.assertEqual(renderer.from_context({'v': {'a': "</script>'"}}), '{"a": "\\u003c/script\\u003e\\u0027"}')
+
+    def test_210_008_unexpected_arguments(self):
+        """The built in filters reject unexpected arguments"""
+        for template in ('{{ v|upper 1 }}', '{{ v|truncate }}', '{{ v|center 1 2 3 }}', '{{ v|join x:1 }}',
+                         '{{ v|number 1.5 }}', "{{ v|truncate 'x' }}", '{{ v|truncate 2.5 }}',
+                         "{{ v|center 'x' }}", "{{ v|center 9 '**' }}"):
+            with self.assertRaises(templatelite.UnexpectedFilterArguments):
+                self.render(template, v='value')
+
+    def test_210_009_default_missing(self):
+        """default replaces a missing value - unless errors are requested"""
+        self.assertEqual(self.render("{{ name|default 'anon' }}|{{ user.name|default 'anon' }}|{{ name }}", user={}),
+                         'anon|anon|{{ name }}')
+        renderer = templatelite.Renderer(template_str="{{ name|default 'anon' }}", errors=True)
+        with self.assertRaises(templatelite.UnknownContextValue):
+            renderer.from_context({})
+
+    def test_210_010_dates_in_zones(self):
+        """Dates which are the same instant in different time zones are formatted separately"""
+        import datetime
+
+        class Zone(datetime.tzinfo):
+            def __init__(self, hours, name):
+                self.hours, self.name = hours, name
+
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=self.hours)
+
+            def tzname(self, dt):
+                return self.name
+
+            def dst(self, dt):
+                return datetime.timedelta(0)
+
+        a = datetime.datetime(2020, 1, 2, 12, 0, tzinfo=Zone(0, 'UTC'))
+        b = datetime.datetime(2020, 1, 2, 13, 0, tzinfo=Zone(1, 'CET'))
+        self.assertEqual(a, b)
+        self.assertEqual(self.render("{{ a|date '%H:%M %Z' }}|{{ b|date '%H:%M %Z' }}|{{ b|strftime '%H %Z' }}",
+                                     a=a, b=b), '12:00 UTC|13:00 CET|13 CET')
+
+
+class FilterChains(unittest.TestCase):
+    def test_220_000_chain(self):
+        """Filters are applied in turn from left to right"""
+        renderer = templatelite.Renderer(template_str="{{ v|split ','|join ' & '|upper|escape }}")
+        self.assertEqual(renderer.from_context({'v': 'a,b'}), 'A &amp; B')
+
+    def test_220_001_nested_calls(self):
+        """A chain is compiled into nested direct calls"""
+        source = templatelite.Renderer(template_str="{{ v|split ','|join '-' }}").template.source
+        self.assertIn("filter_join(filter_split(", source)
+        self.assertNotIn('execute_filter', source)
+
+    def test_220_002_quoted_separator(self):
+        """A '|' within a quoted argument doesn't split the chain"""
+        renderer = templatelite.Renderer(template_str="{{ v|cut 'a|b'|upper }}")
+        self.assertEqual(renderer.from_context({'v': 'xa|by'}), 'XY')
+
+    def test_220_003_chain_in_expression(self):
+        """Chains can be used in if conditions"""
+        renderer = templatelite.Renderer(template_str="{% if v|split|len %}{{ v|split|len }}{% endif %}")
+        self.assertEqual(renderer.from_context({'v': 'a b c'}), '3')
+
+    def test_220_004_chain_in_loop(self):
+        """Chains within loops are applied to each item"""
+        renderer = templatelite.Renderer(template_str="{% for r in rows %}{{ r|lower|truncate 4 }},{% endfor %}")
+        self.assertEqual(renderer.from_context({'rows': ['ABCDEF', 'AB']}), 'a...,ab,')
+
+    def test_220_005_arguments_error(self):
+        """An argument error in a chain is reported against the token"""
+        renderer = templatelite.Renderer(template_str="{{ v|upper|len 1 }}")
+        with six.assertRaisesRegex(self, templatelite.UnexpectedFilterArguments, r"'{{ v\|upper\|len 1 }}'"):
+            renderer.from_context({'v': 'a'})
+
+    def test_220_006_unknown_filter(self):
+        """Every filter in the chain must be known"""
+        with self.assertRaises(templatelite.UnrecognisedFilter):
+            templatelite.Renderer(template_str="{{ v|upper|no_such_filter }}")
+
+
+class Macros(unittest.TestCase):
+    template = """{% macro row(item, label) %}<tr><td>{{ label }}</td><td>{{ item.name }}</td><td>{{ site }}</td></tr>
+{% endmacro %}
+{% for item in items %}{{ row(item, 'Item') }}{% endfor %}{{ row(total, 'Total') }}"""
+    context = {'items': [{'name': 'a'}, {'name': 'b'}], 'total': {'name': 'c'}, 'site': 'S'}
+    expected = ('<tr><td>Item</td><td>a</td><td>S</td></tr>\n<tr><td>Item</td><td>b</td><td>S</td></tr>\n'
+                '<tr><td>Total</td><td>c</td><td>S</td></tr>\n')
+
+    def test_230_000_macro(self):
+        """A macro is rendered wherever it is called"""
+        self.assertEqual(templatelite.Renderer(template_str=self.template).from_context(self.context), self.expected)
+
+    def test_230_001_function(self):
+        """A macro is compiled into a function"""
+        source = templatelite.Renderer(template_str=self.template).template.source
+        self.assertIn('def macro_row(template, context, item, label, ', source)
+        self.assertIn("macro_row(template, context, ", source)
+
+    def test_230_002_modes(self):
+        """Macros work with autoescape, bytes output and incremental templates"""
+        context = dict(self.context, site='<S>')
+        self.assertIn('<td>&lt;S&gt;</td>', templatelite.Renderer(template_str=self.template,
+                                                                   autoescape='html').from_context(context))
+        self.assertEqual(templatelite.Renderer(template_str=self.template, as_bytes=True).from_context(self.context),
+                         self.expected.encode('utf-8'))
+        session = templatelite.Renderer(template_str=self.template, incremental=True).incremental()
+        self.assertEqual(session.render(self.context), self.expected)
+        self.assertIn('<td>T</td>', session.render(self.context, {'site': 'T'}))
+
+    def test_230_003_parameter_names(self):
+        """A parameter name can also be used as a context variable outside the macro"""
+        renderer = templatelite.Renderer(template_str='{% macro m(item) %}[{{ item }}]{% endmacro %}{{ m(1) }}{{ item }}')
+        self.assertEqual(renderer.from_context({'item': 'x'}), '[1]x')
+
+    def test_230_004_unknown_macro(self):
+        """A macro must be defined before it is called"""
+        with six.assertRaisesRegex(self, templatelite.TemplateSyntaxError, "Unknown macro 'm'"):
+            templatelite.Renderer(template_str='{{ m(1) }}{% macro m(item) %}{{ item }}{% endmacro %}')
+
+    def test_230_005_invalid_macros(self):
+        """Macros must be defined correctly at the top level"""
+        for template in ('{% macro m(1) %}{% endmacro %}', '{% macro m %}{% endmacro %}',
+                         '{% if x %}{% macro m() %}{% endmacro %}{% endif %}', '{% endmacro %}',
+                         '{% macro m() %}'):
+            with self.assertRaises(templatelite.TemplateSyntaxError):
+                templatelite.Renderer(template_str=template)
+
+    def test_230_006_string_arguments(self):
+        """Names within string arguments aren't context variables - in either quoting style"""
+        renderer = templatelite.Renderer(template_str='{% macro m(x) %}[{{ x }}]{% endmacro %}'
+                                                      '{{ m("q") }}{{ m(\'hello world\') }}{{ m("it\'s") }}{{ m(q) }}')
+        self.assertEqual(renderer.from_context({'q': 1}), "[q][hello world][it's][1]")
+        renderer = templatelite.Renderer(template_str='{% if n == "a b" %}yes{% endif %}')
+        self.assertEqual(renderer.from_context({'n': 'a b'}), 'yes')
+
+    def test_230_007_parameters_are_local(self):
+        """A missing variable with the same name as a macro parameter is still missing outside the macro"""
+        renderer = templatelite.Renderer(template_str='{% macro m(x) %}[{{ x }}]{% endmacro %}{{ m(1) }}{{ x }}')
+        self.assertEqual(renderer.from_context({}), '[1]{{ x }}')
+        self.assertNotIn('x', renderer.template._targets)
+        with self.assertRaises(templatelite.UnknownContextValue):
+            templatelite.Renderer(template_str='{% macro m(x) %}{{ x }}{% endmacro %}{{ x }}',
+                                  errors=True).from_context({})
+
+
+class Observers(unittest.TestCase):
+    class Recorder(templatelite.RenderObserver):
+        def __init__(self):
+            self.events = []
+
+        def compiled(self, name, seconds):
+            self.events.append(('compiled', name))
+
+        def rendered(self, name, seconds, size):
+            self.events.append(('rendered', name, size))
+
+        def failed(self, name, seconds, exception):
+            self.events.append(('failed', name, exception.__class__))
+
+        def cache_lookup(self, name, hit):
+            self.events.append(('cache_lookup', name, hit))
+
+    def test_240_000_renderer(self):
+        """Observers of a Renderer are told about the compile and each render"""
+        recorder = self.Recorder()
+        renderer = templatelite.Renderer(template_str='Hello {{ name }}', name='hello', observers=[recorder])
+        renderer.from_context({'name': 'Tony'})
+        renderer.render_to(io.BytesIO(), {'name': 'Tony'})
+        self.assertEqual(recorder.events, [('compiled', 'hello'), ('rendered', 'hello', 10), ('rendered', 'hello', 10)])
+
+    def test_240_001_failed(self):
+        """Observers are told about renders which fail - and the exception is still raised"""
+        recorder = self.Recorder()
+        renderer = templatelite.Renderer(template_str='{{ name }}', errors=True, observers=[recorder])
+        with self.assertRaises(templatelite.UnknownContextValue):
+            renderer.from_context({})
+        self.assertEqual(recorder.events[-1], ('failed', None, templatelite.UnknownContextValue))
+
+    def test_240_002_environment(self):
+        """Observers of an Environment are told about every template - including the template cache lookups"""
+        recorder = self.Recorder()
+        env = templatelite.Environment(loader=templatelite.DictLoader({'page': '{{ title }}'}))
+        first = env.get_template('page')
+        env.add_observer(recorder)
+        env.get_template('page').from_context({'title': 'Home'})
+        first.from_context({'title': 'Home'})
+        self.assertEqual(recorder.events, [('cache_lookup', 'page', True), ('rendered', 'page', 4),
+                                           ('rendered', 'page', 4)])
+        env.remove_observer(recorder)
+        first.from_context({'title': 'Home'})
+        self.assertEqual(len(recorder.events), 3)
+
+    def test_240_003_histogram_collector(self):
+        """The histogram collector summarises the metrics for each template"""
+        collector = templatelite.HistogramCollector()
+        env = templatelite.Environment(loader=templatelite.DictLoader({'page': '{{ title }}'}), observers=[collector])
+        for title in ('a', 'bb', 'ccc'):
+            env.get_template('page').from_context({'title': title})
+
+        stats = collector.stats()['page']
+        self.assertEqual(stats['compile']['count'], 1)
+        self.assertEqual(stats['render']['count'], 3)
+        self.assertEqual((stats['size']['min'], stats['size']['max'], stats['size']['mean']), (1, 3, 2))
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']), (2, 1))
+        self.assertAlmostEqual(stats['cache_hit_rate'], 2 / 3.0)
+        self.assertIsNotNone(stats['render']['p95'])
+        collector.reset()
+        self.assertEqual(collector.stats(), {})
+
+    def test_240_004_histogram(self):
+        """A histogram estimates percentiles from its buckets"""
+        from templatelite.metrics import Histogram
+        histogram = Histogram(bounds=(1, 2, 5))
+        for value in (0.5, 1.5, 1.5, 4, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual((histogram.percentile(50), histogram.percentile(80), histogram.percentile(100)), (2, 5, 10))
+
+    def test_240_005_render_to_size(self):
+        """The size of a render_to is the number of bytes written to the stream"""
+        collector = templatelite.HistogramCollector()
+        renderer = templatelite.Renderer(template_str=u'{% for i in items %}\u00e9{{ i }}{% endfor %}', name='page',
+                                         observers=[collector])
+        stream = io.BytesIO()
+        renderer.render_to(stream, {'items': [1, 2]})
+        self.assertEqual(len(stream.getvalue()), 6)
+        self.assertEqual(collector.stats()['page']['size']['max'], 6)
+        renderer = templatelite.Renderer(template_str='{{ a }}', as_bytes=True, observers=[collector], name='bytes')
+        renderer.render_to(io.BytesIO(), {'a': 'abc'})
+        self.assertEqual(collector.stats()['bytes']['size']['max'], 3)
+
+
+class Lint(unittest.TestCase):
+    def codes(self, template, **options):
+        from templatelite import lint
+        return [(message.line, message.code) for message in lint.check_template(template, **options)]
+
+    def test_250_000_loop_invariant(self):
+        """Dotted names which don't depend on a loop target are reported once per loop"""
+        template = """{{ site.name }}
+{% for item in items %}
+{{ site.name }} {{ item.name }} {{ site.name }}
+{% endfor %}"""
+        self.assertEqual(self.codes(template), [(3, 'W001')])
+
+    def test_250_001_callable_in_loop(self):
+        """Callables which are called for each iteration are reported when there is a sample context"""
+        class Item(object):
+            name = 'a'
+
+            def total(self):
+                return 1
+
+        template = """{% for item in items %}
+{{ item.name }} {{ item.total }}
+{% endfor %}"""
+        self.assertEqual(self.codes(template), [])
+        self.assertEqual(self.codes(template, context={'items': [Item()]}), [(2, 'W002')])
+
+    def test_250_002_filters_in_loop(self):
+        """Filters called for each iteration are reported - batched and inlined filters aren't"""
+        template = """{% for item in items %}
+{{ item.name|upper }} {{ item.name|title }} {{ item.name|truncate 10 }}
+{% if item.tags|len %}{{ item.when|date }}{% endif %}
+{% endfor %}"""
+        self.assertEqual(self.codes(template), [(2, 'W003'), (3, 'W003')])
+        self.assertEqual(self.codes(template, context={'items': [{'name': 'a'}]}), [])
+
+    def test_250_003_for_else(self):
+        """The else of a loop without a break is reported"""
+        self.assertEqual(self.codes('{% for i in items %}{{ i }}\n{% else %}none{% endfor %}'), [(2, 'W004')])
+        self.assertEqual(self.codes('{% for i in items %}{% if i %}{% break %}{% endif %}'
+                                    '{% else %}none{% endfor %}'), [])
+
+    def test_250_004_large_literal(self):
+        """Huge blocks of literal text are reported"""
+        self.assertEqual(self.codes('{{ a }}\n' + 'x' * 100, large_literal=50), [(2, 'W005')])
+        self.assertEqual(self.codes('{{ a }}\n' + 'x' * 100), [])
+
+    def test_250_005_syntax_error(self):
+        """Templates which don't compile are reported at the failing token"""
+        from templatelite import lint
+        self.assertEqual(self.codes('a\n{% if a %}\nb'), [(2, 'E001')])
+        self.assertEqual(self.codes('a\n{% for i in items %}\n{% if i %}{% endif %}'), [(2, 'E001')])
+        self.assertEqual(self.codes('a\n\n{% if x == %}b{% endif %}'), [(3, 'E001')])
+        self.assertEqual(self.codes('a\n{{ a b }}'), [(2, 'E001')])
+        self.assertEqual(lint.check_template('{{ a|no_such_filter }}')[0].message, "Unknown filter 'no_such_filter'")
+        self.assertEqual(lint.check_template('{{ a b }}')[0].message, "Syntax Error : Invalid expression in '{{ a b }}'")
+
+    def test_250_006_command(self):
+        """The check command reports each problem with the file and line - and fails if there are any"""
+        from templatelite.__main__ import main
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fp:
+                fp.write('{% for i in items %}\n{{ site.name }}\n{% endfor %}')
+            with open(os.path.join(tmpdir, 'clean.html'), 'w') as fp:
+                fp.write('{{ site.name }}')
+            output = six.StringIO()
+            stdout, sys.stdout = sys.stdout, output
+            try:
+                self.assertEqual(main(['check', tmpdir]), 1)
+                self.assertEqual(main(['check', '--ignore', 'W001', tmpdir]), 0)
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(output.getvalue().splitlines(),
+                             [os.path.join(tmpdir, 'page.html') + ':2: W001 Loop invariant \'site.name\' is looked up '
+                              'for every iteration of the loop at line 1 - pass the value in the context, '
+                              'or declare it in a schema'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_250_007_filters_in_jumping_loop(self):
+        """Batch filters in a loop with a break or continue are reported - the compiler doesn't batch those loops"""
+        for jump in ('break', 'continue'):
+            template = """{{% for item in items %}}
+{{{{ item.price|number }}}}
+{{% if item.last %}}{{% {} %}}{{% endif %}}
+{{% endfor %}}""".format(jump)
+            self.assertNotIn('batch_number', templatelite.Renderer(template).template.source)
+            self.assertEqual(self.codes(template), [(2, 'W003')])
+        self.assertEqual(self.codes('{% for item in items %}\n{{ item.price|number }}\n{% endfor %}'), [])
+
+
+class Sandbox(unittest.TestCase):
+    class Order(object):
+        name = 'Widget'
+        _secret = 'hidden'
+
+        def total(self):
+            return 42
+
+        def delete(self):
+            pass
+        delete.alters_data = True
+
+    def test_260_000_allowed_expressions(self):
+        """Comparisons, boolean operators, arithmetic and literals are allowed in sandboxed expressions"""
+        renderer = templatelite.Renderer("{% if order.name == 'Widget' and (count + 1) * 2 > 4 and count in (2, 3) %}"
+                                         "yes{% endif %}", sandbox=True)
+        self.assertEqual(renderer.from_context({'order': self.Order(), 'count': 2}), 'yes')
+
+    def test_260_001_disallowed_expressions(self):
+        """Calls, subscripts, powers and repeated sequences are rejected when the template is compiled"""
+        for template in ('{% if name.upper() %}x{% endif %}', '{% if items[0] %}x{% endif %}',
+                         '{% if 10 ** 100000 %}x{% endif %}', "{% if 'x' * 100000000 %}x{% endif %}",
+                         '{% if lambda: 1 %}x{% endif %}', '{% for x in items[1] %}x{% endfor %}'):
+            with self.assertRaises(templatelite.SandboxError):
+                templatelite.Renderer(template, sandbox=True)
+            templatelite.Renderer(template)
+
+    def test_260_002_private_names(self):
+        """Names beginning with an underscore can't be used in a sandboxed template"""
+        with six.assertRaisesRegex(self, templatelite.SandboxError, r"Private names are not allowed in 'order._secret'"):
+            templatelite.Renderer('{{ order._secret }}', sandbox=True)
+
+    def test_260_003_calls(self):
+        """Methods are only called if the sandbox policy allows it"""
+        context = {'order': self.Order()}
+        with six.assertRaisesRegex(self, templatelite.SandboxError, r"Calling 'total' is not allowed in '{{ order.total }}'"):
+            templatelite.Renderer('{{ order.total }}', sandbox=True).from_context(context)
+
+        policy = templatelite.SandboxPolicy(allow_calls=True)
+        self.assertEqual(templatelite.Renderer('{{ order.total }}', sandbox=policy).from_context(context), '42')
+        with self.assertRaises(templatelite.SandboxError):
+            templatelite.Renderer('{{ order.delete }}', sandbox=policy).from_context(context)
+
+    def test_260_004_custom_policy(self):
+        """A subclass of the policy decides which attributes can be accessed"""
+        class NoNames(templatelite.SandboxPolicy):
+            def allow_attribute(self, value, name):
+                return name != 'name'
+
+        renderer = templatelite.Renderer('{{ order.name }}', sandbox=NoNames())
+        with self.assertRaises(templatelite.SandboxError):
+            renderer.from_context({'order': self.Order()})
+        self.assertEqual(renderer.from_context({'order': {'name': 'Widget'}}), 'Widget')
+
+    def test_260_005_iteration_limit(self):
+        """A loop which runs for more than max_iterations iterations is stopped"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}', max_iterations=3)
+        self.assertEqual(renderer.from_context({'items': [1, 2, 3]}), '123')
+        with six.assertRaisesRegex(self, templatelite.IterationLimitExceeded,
+                                   r"more than 3 iterations of '{% for i in items %}'"):
+            renderer.from_context({'items': [1, 2, 3, 4]})
+
+    def test_260_006_iteration_limit_endless(self):
+        """No more than one item past the limit is taken from an endless iterable - even in a loop of batch columns"""
+        import itertools
+        renderer = templatelite.Renderer('{% for i in items %}{{ i|escape }}{% endfor %}', max_iterations=5)
+        with self.assertRaises(templatelite.RenderLimitExceeded):
+            renderer.from_context({'items': itertools.count()})
+
+    def test_260_007_nested_loops(self):
+        """The limit applies to each run of a loop"""
+        renderer = templatelite.Renderer('{% for row in rows %}{% for i in row %}{{ i }}{% endfor %}{% endfor %}',
+                                         max_iterations=2)
+        self.assertEqual(renderer.from_context({'rows': [[1, 2], [3, 4]]}), '1234')
+
+    def test_260_008_environment(self):
+        """An Environment can sandbox and limit all of its templates"""
+        env = templatelite.Environment(loader=templatelite.DictLoader({'page': '{{ order.total }}'}),
+                                       sandbox=True, max_iterations=10)
+        with self.assertRaises(templatelite.SandboxError):
+            env.get_template('page').from_context({'order': self.Order()})
+
+    def test_260_009_invalid_names(self):
+        """Loop targets and the parts of dotted names must be plain names in a sandboxed template"""
+        for template in ("{% for context[getattr(__import__('os'),'getpid')()] in items %}x{% endfor %}",
+                         "{{ context[getattr(__import__('os'),'getpid')()] }}"):
+            with self.assertRaises(templatelite.SandboxError):
+                templatelite.Renderer(template, sandbox=True)
+
+    def test_260_010_string_formatting(self):
+        """Formatting a literal string is rejected - the width could allocate a huge string"""
+        for template in ("{% if '%50000000d' % 1 %}x{% endif %}", "{% if b'%5d' % count %}x{% endif %}"):
+            with six.assertRaisesRegex(self, templatelite.SandboxError, r'String formatting is not allowed'):
+                templatelite.Renderer(template, sandbox=True)
+        renderer = templatelite.Renderer('{% if count % 2 %}odd{% endif %}', sandbox=True)
+        self.assertEqual(renderer.from_context({'count': 3}), 'odd')
+
+
+class OutputLimit(unittest.TestCase):
+    def test_270_000_within_limit(self):
+        """Output up to the limit is rendered"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }},{% endfor %}', max_output=6)
+        self.assertEqual(renderer.from_context({'items': [1, 2, 3]}), '1,2,3,')
+
+    def test_270_001_exceeded(self):
+        """Output over the limit raises OutputLimitExceeded - even from an endless loop"""
+        import itertools
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }},{% endfor %}', max_output=6)
+        with six.assertRaisesRegex(self, templatelite.OutputLimitExceeded, r'larger than 6'):
+            renderer.from_context({'items': [1, 2, 3, 4]})
+        with self.assertRaises(templatelite.RenderLimitExceeded):
+            renderer.from_context({'items': itertools.count()})
+
+    def test_270_002_each_render(self):
+        """Each render has its own budget"""
+        renderer = templatelite.Renderer('{{ a }}{{ b }}', max_output=4)
+        for _ in range(3):
+            self.assertEqual(renderer.from_context({'a': 'ab', 'b': 'cd'}), 'abcd')
+
+    def test_270_003_macros_and_cache(self):
+        """The output of macros and cached fragments is only counted once"""
+        template = ('{% macro item(x) %}[{{ x }}]{% endmacro %}'
+                    '{% cache \'header\' %}HEAD{% endcache %}{% for i in items %}{{ item(i) }}{% endfor %}')
+        renderer = templatelite.Renderer(template, max_output=13)
+        self.assertEqual(renderer.from_context({'items': [1, 2, 3]}), 'HEAD[1][2][3]')
+        self.assertEqual(renderer.from_context({'items': [1, 2, 3]}), 'HEAD[1][2][3]')
+        with self.assertRaises(templatelite.OutputLimitExceeded):
+            renderer.from_context({'items': [1, 2, 3, 4]})
+
+    def test_270_004_bytes(self):
+        """Bytes output is limited by the number of bytes"""
+        renderer = templatelite.Renderer(u'{{ name }}', as_bytes=True, max_output=4)
+        self.assertEqual(renderer.from_context({'name': u'\u00e9\u00e9'}), u'\u00e9\u00e9'.encode('utf-8'))
+        with self.assertRaises(templatelite.OutputLimitExceeded):
+            renderer.from_context({'name': u'\u00e9\u00e9\u00e9'})
+
+    def test_270_005_environment(self):
+        """An Environment can limit the output of all of its templates"""
+        env = templatelite.Environment(loader=templatelite.DictLoader({'page': '{{ name }}'}), max_output=4)
+        self.assertEqual(env.get_template('page').from_context({'name': 'abcd'}), 'abcd')
+        with self.assertRaises(templatelite.OutputLimitExceeded):
+            env.get_template('page').from_context({'name': 'abcde'})
+
+    def test_270_006_batch_filters(self):
+        """A loop using a batch filter still stops as soon as the limit is exceeded"""
+        read = []
+
+        def rows():
+            for i in range(1000):
+                read.append(i)
+                yield i
+
+        renderer = templatelite.Renderer('{% for row in rows %}{{ row|escape }},{% endfor %}', max_output=20)
+        with self.assertRaises(templatelite.OutputLimitExceeded):
+            renderer.from_context({'rows': rows()})
+        self.assertLess(len(read), 20)
+
+    def test_270_007_context_key(self):
+        """The output budget isn't kept in the context - a context key of the same name has no effect"""
+        renderer = templatelite.Renderer('{{ a }}', max_output=4)
+        self.assertEqual(renderer.from_context({'a': 'abcd', '_output_budget': None}), 'abcd')
+        with self.assertRaises(templatelite.OutputLimitExceeded):
+            renderer.from_context({'a': 'abcde', '_output_budget': templatelite.templatelite._OutputBudget(100)})
+
+
+class RenderDeadline(unittest.TestCase):
+    class Slow(object):
+        def __init__(self, delay):
+            self.delay = delay
+
+        def __iter__(self):
+            while True:
+                time.sleep(self.delay)
+                yield 1
+
+    def test_280_000_within_deadline(self):
+        """A render which finishes before the deadline is unaffected"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}')
+        deadline = templatelite.templatelite._monotonic() + 60
+        self.assertEqual(renderer.from_context({'items': [1, 2]}, deadline=deadline), '12')
+
+    def test_280_001_timeout(self):
+        """A loop still running after the deadline raises RenderTimeout"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}')
+        deadline = templatelite.templatelite._monotonic() + 0.05
+        with six.assertRaisesRegex(self, templatelite.RenderTimeout, r"deadline exceeded in '{% for i in items %}'"):
+            renderer.from_context({'items': self.Slow(0.01)}, deadline=deadline)
+
+    def test_280_002_nested_and_macros(self):
+        """The deadline is checked by loops within macros, and by render_to"""
+        renderer = templatelite.Renderer('{% macro row(r) %}{% for i in r %}{{ i }}{% endfor %}{% endmacro %}'
+                                         '{% for r in rows %}{{ row(r) }}{% endfor %}', observers=[templatelite.HistogramCollector()])
+        past = templatelite.templatelite._monotonic() - 1
+        with self.assertRaises(templatelite.RenderLimitExceeded):
+            renderer.from_context({'rows': [[1]]}, deadline=past)
+        with self.assertRaises(templatelite.RenderTimeout):
+            renderer.render_to(io.BytesIO(), {'rows': [[1]]}, deadline=past)
+        self.assertEqual(renderer.from_context({'rows': [[1], [2]]}), '12')
+
+    def test_280_003_incremental(self):
+        """An incremental session accepts a deadline"""
+        session = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}', incremental=True).incremental()
+        with self.assertRaises(templatelite.RenderTimeout):
+            session.render({'items': [1]}, deadline=templatelite.templatelite._monotonic() - 1)
+
+    def test_280_004_unexpected_argument(self):
+        """Only the deadline can be given as a keyword argument"""
+        renderer = templatelite.Renderer('{{ a }}')
+        with self.assertRaises(TypeError):
+            renderer.from_context({'a': 1}, timeout=1)
+
+    def test_280_005_batch_filters(self):
+        """The deadline is checked while the items of a loop using a batch filter are read"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i|len }}{% endfor %}')
+        self.assertIn('_deadline_items', renderer.template.source)
+        deadline = templatelite.templatelite._monotonic() + 0.05
+        with six.assertRaisesRegex(self, templatelite.RenderTimeout, r"deadline exceeded in '{% for i in items %}'"):
+            renderer.from_context({'items': self.Slow(0.01)}, deadline=deadline)
+        self.assertEqual(renderer.from_context({'items': ['a', 'bb']}), '12')
+
+    def test_280_006_context_keys(self):
+        """The deadline is not taken from the context"""
+        renderer = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}')
+        self.assertEqual(renderer.from_context({'items': [1, 2], '_deadline': 0}), '12')
+        session = templatelite.Renderer('{% for i in items %}{{ i }}{% endfor %}', incremental=True).incremental()
+        self.assertEqual(session.render({'items': [1], '_deadline': 0}), '1')
+
+
+class WarmTemplates(unittest.TestCase):
+    class Compiles(templatelite.RenderObserver):
+        def __init__(self):
+            self.names = []
+
+        def compiled(self, name, seconds):
+            self.names.append(name)
+
+    def test_290_000_warm_all(self):
+        """Warming compiles every template the loader lists - get_template then reuses them"""
+        compiles = self.Compiles()
+        env = templatelite.Environment(loader=templatelite.DictLoader({'a': '{{ x }}', 'b': 'B{{ x }}'}),
+                                       cache_size=1, observers=[compiles])
+        self.assertEqual(env.warm(), ['a', 'b'])
+        self.assertEqual(compiles.names, ['a', 'b'])
+        for _ in range(3):
+            self.assertEqual(env.get_template('a').from_context({'x': 1}), '1')
+            self.assertEqual(env.get_template('b').from_context({'x': 2}), 'B2')
+        self.assertEqual(compiles.names, ['a', 'b'])
+
+    def test_290_001_warm_names(self):
+        """Only the named templates are warmed - and warming again doesn't recompile them"""
+        compiles = self.Compiles()
+        env = templatelite.Environment(loader=templatelite.DictLoader({'a': '{{ x }}', 'b': 'B{{ x }}'}),
+                                       observers=[compiles])
+        env.warm(['a'])
+        env.warm(['a', 'b'])
+        self.assertEqual(compiles.names, ['a', 'b'])
+        env.clear_cache()
+        env.get_template('a')
+        self.assertEqual(compiles.names, ['a', 'b', 'a'])
+
+    def test_290_002_no_listing(self):
+        """Every template can only be warmed if the loader lists its templates"""
+        class Loader(object):
+            def get_source(self, name):
+                return '{{ x }}'
+
+        env = templatelite.Environment(loader=Loader())
+        with self.assertRaises(ValueError):
+            env.warm()
+        self.assertEqual(env.warm(['page']), ['page'])
+        with self.assertRaises(ValueError):
+            templatelite.Environment().warm(['page'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs os.fork')
+    def test_290_003_forked_children(self):
+        """Children forked after warming render the parent's compiled templates without compiling them again"""
+        compiles = self.Compiles()
+        env = templatelite.Environment(loader=templatelite.DictLoader({'page': '{% for i in items %}{{ i }}{% endfor %}'}),
+                                       observers=[compiles])
+        env.warm(freeze=True)
+        self.addCleanup(getattr(gc, 'unfreeze', lambda: None))
+        parent_template = id(env.get_template('page').template)
+
+        children = []
+        for child in range(2):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(read_fd)
+                    renderer = env.get_template('page')
+                    result = {'output': renderer.from_context({'items': [child, child]}),
+                              'compiled': compiles.names[1:],
+                              'shared': id(renderer.template) == parent_template}
+                    os.write(write_fd, json.dumps(result).encode('utf-8'))
+                finally:
+                    os._exit(0)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+
+        for child, (pid, read_fd) in enumerate(children):
+            with os.fdopen(read_fd, 'rb') as fp:
+                result = json.loads(fp.read().decode('utf-8'))
+            os.waitpid(pid, 0)
+            self.assertEqual(result, {'output': '{0}{0}'.format(child), 'compiled': [], 'shared': True})
+
+
+class Benchmarks(unittest.TestCase):
+    def test_120_000_quick_run(self):
+        """Every scenario runs and reports its speed and memory"""
+        from templatelite import bench
+
+        results = bench.run(quick=True)
+        self.assertEqual(set(results['scenarios']), set(bench._SCENARIOS))
+        for scenario in results['scenarios'].values():
+            for value in scenario.values():
+                if isinstance(value, dict):
+                    self.assertGreater(value['ops_per_sec'], 0)
+                    self.assertIn('peak_bytes', value)
+
+    def test_120_001_json_output(self):
+        """The results are written as JSON"""
+        from templatelite import bench
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'results.json')
+            self.assertEqual(bench.main(['--quick', '--output', path, 'compile_small']), 0)
+            with open(path) as fp:
+                results = json.load(fp)
+            self.assertEqual(list(results['scenarios']), ['compile_small'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 class ErrorConditions(unittest.TestCase):
 
     def test_100_000_invalid_directive(self):